@@ -45,6 +45,12 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    # 放在第一个, 统计整个请求, 见 users/metrics.py
+    'users.metrics.MetricsMiddleware',
+    # 按 Accept-Encoding 压缩响应, 见 users/compression.py
+    'users.compression.CompressionMiddleware',
+    # 读请求使用从库, 写请求之后短时间内使用主库, 见 users/routers.py
+    'users.routers.ReplicaRoutingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -87,9 +93,25 @@ DATABASES = {
         'PASSWORD': 'mysql',
         'HOST': '127.0.0.1',
         'PORT': '3306',
-    }
+        # 持久连接: 请求之间复用连接(秒), 空闲的连接在使用前检查, 见 users/routers.py
+        'CONN_MAX_AGE': 60,
+    },
+    # 从库, 同时加入 USERS_DATABASE_ROUTING['REPLICAS']
+    # 'replica': {
+    #     'ENGINE': 'django.db.backends.mysql',
+    #     'NAME': 'db_django_c09',
+    #     'USER': 'root',
+    #     'PASSWORD': 'mysql',
+    #     'HOST': '127.0.0.2',
+    #     'PORT': '3306',
+    #     'CONN_MAX_AGE': 60,
+    #     'TEST': {'MIRROR': 'default'},
+    # },
 }
 
+# users 应用的读写分离, 见 users/routers.py
+DATABASE_ROUTERS = ['users.routers.ReplicaRouter']
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/1.8/topics/i18n/
@@ -109,3 +131,92 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/1.8/howto/static-files/
 
 STATIC_URL = '/static/'
+
+
+# users 序列化器的编译模式(只读快速路径), 见 users/compiled.py
+USERS_COMPILED_SERIALIZERS = False
+
+# 调试模式: 查询次数随返回行数增长(N+1)时记录警告, 见 users/planning.py
+USERS_QUERY_PLAN_DEBUG = DEBUG
+
+# 部门接口的响应缓存, 见 users/cache.py
+# 多进程部署时使用 'django' 后端, 进程之间共享缓存和失效
+USERS_RESPONSE_CACHE = {
+    'BACKEND': 'lru',
+    'MAX_ENTRIES': 1000,
+}
+
+# 接口性能统计(GET /metrics), 见 users/metrics.py
+# SAMPLE_RATE: 采样比例, 未采样的请求几乎没有额外开销
+USERS_METRICS = {
+    'ENABLED': True,
+    'SAMPLE_RATE': 0.1,
+}
+
+# 员工批量导入, 见 users/importer.py
+# WORKERS: 校验的进程数, 0 表示在当前进程中校验
+USERS_IMPORT = {
+    'BATCH_SIZE': 1000,
+    'WORKERS': 2,
+}
+
+# 响应压缩(gzip / deflate), 见 users/compression.py
+# MIN_SIZE 以下不压缩, LARGE_SIZE 以上(以及流式响应)用 FAST_LEVEL
+USERS_COMPRESSION = {
+    'ENABLED': True,
+    'MIN_SIZE': 1024,
+    'LARGE_SIZE': 1024 * 1024,
+    'LEVEL': 6,
+    'FAST_LEVEL': 1,
+}
+
+# 批量请求(POST /batch), 见 users/batch.py
+# WORKERS: 并发执行 GET 子请求的线程数, 0 表示依次执行
+USERS_BATCH = {
+    'MAX_REQUESTS': 20,
+    'WORKERS': 4,
+}
+
+# 增量同步(GET /departments5/changes/?since=), 见 users/changes.py
+# OVERLAP: 最近几秒的变化下次同步时再返回一次(秒), TOMBSTONE_DAYS: 删除记录保留的天数
+USERS_CHANGES = {
+    'PAGE_SIZE': 500,
+    'MAX_PAGE_SIZE': 5000,
+    'OVERLAP': 5,
+    'TOMBSTONE_DAYS': 30,
+}
+
+# 最新部门 / 最近入职员工的内存列表, 见 users/topn.py
+# CAPACITY: 每个列表保存的对象数(?n= 的上限), TTL: 多少秒后重新查询(其他进程的修改)
+USERS_TOP_N = {
+    'CAPACITY': 100,
+    'TTL': 60,
+}
+
+# wsgi 进程启动预热, 见 users/warmup.py
+# PHASES: 要执行的阶段(gunicorn --preload 时去掉 database 和 requests), PATHS: requests 阶段 GET 的路径
+USERS_WARMUP = {
+    'ENABLED': False,
+    'PHASES': ('settings', 'urls', 'serializers', 'database', 'requests'),
+    'PATHS': ['/departments5/latest/', '/employee5/latest/'],
+}
+
+# 按接口的准入控制(限流, 限并发), 每个接口的限制在 users/views.py 的视图类中声明, 见 users/admission.py
+# RETRY_AFTER: 并发已满(503)时的 Retry-After 秒数, LIMITS: '视图类名.动作' -> 覆盖视图类中的限制
+USERS_ADMISSION = {
+    'ENABLED': True,
+    'RETRY_AFTER': 1,
+    'LIMITS': {
+        # 'EmployeeViewSet.list': {'concurrency': 2, 'rate': 20, 'burst': 40},
+    },
+}
+
+# 读写分离, 见 users/routers.py
+# REPLICAS: 从库的别名(DATABASES 中的键), 为空时只使用主库
+# PIN_SECONDS: 写请求之后该客户端使用主库的时间(秒), 应大于从库的复制延迟
+USERS_DATABASE_ROUTING = {
+    'REPLICAS': [],
+    'PIN_SECONDS': 5,
+    'HEALTH_CHECK_INTERVAL': 30,
+    'RETRY_SECONDS': 30,
+}
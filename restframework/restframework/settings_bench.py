@@ -0,0 +1,28 @@
+"""
+性能测试使用的配置: 用内存中的 SQLite 代替 MySQL, 不需要数据库服务即可运行
+
+    python manage.py bench --settings=restframework.settings_bench
+"""
+from restframework.settings import *  # noqa
+
+DEBUG = False
+
+ALLOWED_HOSTS = ['*']
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    },
+    # 读写分离的测试使用(见 users/routers.py), USERS_DATABASE_ROUTING 中没有配置, 平时不使用
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    },
+}
+
+# 性能测试时不统计每个请求的查询次数
+USERS_QUERY_PLAN_DEBUG = False
+
+# 性能测试连续请求同一个接口, 不限流(准入控制的测试中单独开启)
+USERS_ADMISSION = {'ENABLED': False}
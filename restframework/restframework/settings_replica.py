@@ -0,0 +1,33 @@
+"""
+在本地用两个 SQLite 文件代替主库和从库, 测试读写分离(见 users/routers.py)
+
+    python manage.py migrate --settings=restframework.settings_replica
+    python manage.py migrate --database=replica --settings=restframework.settings_replica
+    python manage.py runserver --settings=restframework.settings_replica
+
+从库不会自动同步: 写入只进入 primary.sqlite3, 复制文件模拟一次复制
+    cp primary.sqlite3 replica.sqlite3
+"""
+from restframework.settings import *  # noqa
+
+DEBUG = True
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'primary.sqlite3'),
+        'CONN_MAX_AGE': 60,
+    },
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'replica.sqlite3'),
+        'CONN_MAX_AGE': 60,
+    },
+}
+
+USERS_DATABASE_ROUTING = {
+    'REPLICAS': ['replica'],
+    'PIN_SECONDS': 5,
+    'HEALTH_CHECK_INTERVAL': 30,
+    'RETRY_SECONDS': 30,
+}
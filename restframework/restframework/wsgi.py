@@ -8,9 +8,23 @@ https://docs.djangoproject.com/en/1.8/howto/deployment/wsgi/
 """
 
 import os
+import time
 
-from django.core.wsgi import get_wsgi_application
+# 启动预热的 setup 阶段从这里开始计时(见 users/warmup.py)
+_started = time.perf_counter()
+
+from django.core.wsgi import get_wsgi_application  # noqa: E402
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "restframework.settings")
 
 application = get_wsgi_application()
+
+# settings.USERS_WARMUP['ENABLED'] 为 True 时, 在处理第一个请求之前预热
+from users.warmup import warm_up  # noqa: E402
+
+warm_up(started=_started)
+
+# settings.USERS_ADMISSION['LIMITS'] 中没有对应视图的键写入警告日志(见 users/admission.py)
+from users.admission import check_limits  # noqa: E402
+
+check_limits()
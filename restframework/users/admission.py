@@ -0,0 +1,276 @@
+"""
+按接口的准入控制(限流, 限并发): 超出容量的请求立即拒绝, 不排队
+
+突发流量时, 不分页的 GET /department 或 GET /employee5/?format=csv 这样的慢请求会占满所有 worker 线程,
+GET /employee5/<pk>/ 这样的快请求只能排在后面等待. AdmissionControlMixin 对每个视图的每个动作分别限制:
+    - concurrency: 同时处理的请求数, 已满时返回 503, Retry-After 为 RETRY_AFTER 秒
+    - rate / burst: 令牌桶, 每秒补充 rate 个令牌, 最多积累 burst 个; 没有令牌时返回 429,
+      Retry-After 为下一个令牌到来的秒数(向上取整)
+被拒绝的请求不执行认证, 不访问数据库. 没有配置的动作不限制(快请求始终能进入).
+
+限制在视图类中声明, 键为视图集的 action 或 APIView 的请求方法(小写):
+    class EmployeeViewSet(AdmissionControlMixin, ...):
+        admission_limits = {
+            'list': Limit(concurrency=4, rate=50, burst=100),
+        }
+settings.USERS_ADMISSION['LIMITS'] 中的 '视图类名.动作' 覆盖视图类中的声明(部署时调整, 不用改代码).
+只对使用 AdmissionControlMixin 的视图生效; restframework/wsgi.py 加载应用时检查 LIMITS,
+路由中没有对应的视图和动作的键写入警告日志 users.admission(拼写错误的配置不会被静默忽略).
+
+计数器(GET /metrics 的 admission): 每个 '视图类名.动作' 的通过数, 因限流/并发被拒绝的数量, 当前和最大并发数.
+限制和计数都在进程内, 多个 worker 进程各自计算; 流式响应在内容全部输出后才释放并发名额.
+批量接口(POST /batch)的每个子请求分别计算.
+
+配置(settings.USERS_ADMISSION):
+    {
+        'ENABLED': True,
+        'RETRY_AFTER': 1,      # 并发已满时的 Retry-After(秒)
+        'LIMITS': {'EmployeeViewSet.list': {'concurrency': 2, 'rate': 20, 'burst': 40}},
+    }
+"""
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from rest_framework.exceptions import APIException, Throttled
+
+logger = logging.getLogger('users.admission')
+
+DEFAULTS = {
+    'ENABLED': True,
+    'RETRY_AFTER': 1,
+    'LIMITS': {},
+}
+
+# concurrency: 最大并发数; rate: 每秒补充的令牌数; burst: 令牌桶的容量(默认与 rate 相同); None 表示不限制
+Limit = namedtuple('Limit', ['concurrency', 'rate', 'burst'])
+Limit.__new__.__defaults__ = (None, None, None)
+
+
+class Overloaded(APIException):
+    status_code = 503
+    default_detail = '服务繁忙, 请稍后重试'
+    default_code = 'overloaded'
+
+    def __init__(self, wait, detail=None, code=None):
+        super(Overloaded, self).__init__(detail, code)
+        # DRF 的异常处理按 wait 设置 Retry-After
+        self.wait = wait
+
+
+def get_options():
+    options = dict(DEFAULTS)
+    options.update(getattr(settings, 'USERS_ADMISSION', {}))
+    return options
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        """取一个令牌, 返回 0; 没有令牌时返回需要等待的秒数"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+class Gate(object):
+    """一个 '视图类名.动作' 的令牌桶, 并发数和计数器"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.bucket = TokenBucket(limit.rate, limit.burst) if limit.rate else None
+        self.in_flight = 0
+        self.peak = 0
+        self.admitted = 0
+        self.rejected_rate = 0
+        self.rejected_concurrency = 0
+        self._lock = threading.Lock()
+
+    def enter(self, retry_after):
+        """通过时返回 Slot, 否则抛出 Throttled(429) 或 Overloaded(503)"""
+        # 先检查并发: 并发已满时不消耗令牌
+        with self._lock:
+            if self.limit.concurrency is not None and self.in_flight >= self.limit.concurrency:
+                self.rejected_concurrency += 1
+                raise Overloaded(retry_after)
+            self.in_flight += 1
+        wait = self.bucket.take() if self.bucket is not None else 0
+        with self._lock:
+            if wait:
+                self.in_flight -= 1
+                self.rejected_rate += 1
+            else:
+                self.admitted += 1
+                self.peak = max(self.peak, self.in_flight)
+        if wait:
+            raise Throttled(wait=int(math.ceil(wait)))
+        return Slot(self)
+
+    def leave(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def snapshot(self):
+        with self._lock:
+            total = self.admitted + self.rejected_rate + self.rejected_concurrency
+            return OrderedDict([
+                ('limit', OrderedDict(self.limit._asdict())),
+                ('admitted', self.admitted),
+                ('rejected_rate', self.rejected_rate),
+                ('rejected_concurrency', self.rejected_concurrency),
+                ('shed_ratio', (self.rejected_rate + self.rejected_concurrency) / total if total else 0.0),
+                ('in_flight', self.in_flight),
+                ('peak_in_flight', self.peak),
+            ])
+
+
+class Slot(object):
+    """一个并发名额, 多次 release / close 只释放一次"""
+
+    def __init__(self, gate):
+        self.gate = gate
+        self._released = False
+        self._lock = threading.Lock()
+
+    def release(self):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self.gate.leave()
+
+    # 放入 response._closable_objects, 响应关闭时释放
+    close = release
+
+
+class GateRegistry(object):
+
+    def __init__(self):
+        self._gates = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, limit):
+        gate = self._gates.get(key)
+        if gate is None or gate.limit != limit:
+            with self._lock:
+                gate = self._gates.get(key)
+                if gate is None or gate.limit != limit:
+                    # 限制改变时(如测试中修改配置)重新开始计数
+                    gate = self._gates[key] = Gate(limit)
+        return gate
+
+    def snapshot(self):
+        with self._lock:
+            gates = sorted(self._gates.items())
+        return OrderedDict((key, gate.snapshot()) for key, gate in gates)
+
+    def reset(self):
+        with self._lock:
+            self._gates.clear()
+
+
+registry = GateRegistry()
+
+
+def _release_after(chunks, slot):
+    try:
+        for chunk in chunks:
+            yield chunk
+    finally:
+        slot.release()
+
+
+class AdmissionControlMixin(object):
+    """
+    DRF 视图使用, 放在最前面: 在认证, 缓存等之前检查, 被拒绝的请求不做其他处理
+    admission_limits: 动作(action 或小写的请求方法) -> Limit
+    """
+    admission_limits = {}
+
+    def get_admission_key(self, request):
+        action = getattr(self, 'action', None) or request.method.lower()
+        return '%s.%s' % (self.__class__.__name__, action), action
+
+    def get_admission_limit(self, key, action, options):
+        override = options['LIMITS'].get(key)
+        if override is not None:
+            return Limit(**override)
+        return self.admission_limits.get(action)
+
+    def initial(self, request, *args, **kwargs):
+        self._admission_slot = None
+        options = get_options()
+        if options['ENABLED']:
+            key, action = self.get_admission_key(request)
+            limit = self.get_admission_limit(key, action, options)
+            if limit is not None:
+                self._admission_slot = registry.get(key, limit).enter(options['RETRY_AFTER'])
+        super(AdmissionControlMixin, self).initial(request, *args, **kwargs)
+
+    def handle_exception(self, exc):
+        try:
+            return super(AdmissionControlMixin, self).handle_exception(exc)
+        except Exception:
+            # 没有处理的异常不会再调用 finalize_response
+            slot = getattr(self, '_admission_slot', None)
+            if slot is not None:
+                self._admission_slot = None
+                slot.release()
+            raise
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super(AdmissionControlMixin, self).finalize_response(request, response, *args, **kwargs)
+        slot = getattr(self, '_admission_slot', None)
+        if slot is None:
+            return response
+        self._admission_slot = None
+        if getattr(response, 'streaming', False):
+            # 流式响应在内容输出完(或响应关闭)时释放
+            response.streaming_content = _release_after(response.streaming_content, slot)
+            response._closable_objects.append(slot)
+        else:
+            slot.release()
+        return response
+
+
+def admission_keys(urlconf=None):
+    """路由中使用 AdmissionControlMixin 的视图的所有 '视图类名.动作'"""
+    from django.urls import get_resolver
+    from users.warmup import iter_patterns
+
+    keys = set()
+    for pattern in iter_patterns(get_resolver(urlconf).url_patterns):
+        view_class = getattr(pattern.callback, 'cls', None)
+        if view_class is None or not issubclass(view_class, AdmissionControlMixin):
+            continue
+        actions = getattr(pattern.callback, 'actions', None)
+        if actions:
+            names = actions.values()
+        else:
+            names = [method for method in view_class.http_method_names if hasattr(view_class, method)]
+        keys.update('%s.%s' % (view_class.__name__, name) for name in names)
+    return keys
+
+
+def check_limits(urlconf=None):
+    """LIMITS 中没有对应视图和动作的键写入警告日志, 返回这些键"""
+    unknown = sorted(set(get_options()['LIMITS']) - admission_keys(urlconf))
+    for key in unknown:
+        logger.warning('USERS_ADMISSION LIMITS 中的 %s 没有对应的视图和动作(视图需要使用 AdmissionControlMixin), '
+                       '不会生效', key)
+    return unknown
@@ -2,4 +2,13 @@ from django.apps import AppConfig
 
 
 class UsersConfig(AppConfig):
-    name = 'users'
\ No newline at end of file
+    name = 'users'
+
+    def ready(self):
+        # 注册信号接收者
+        from users import cache  # noqa
+        from users import changes  # noqa
+        from users import routers  # noqa
+        from users import search  # noqa
+        from users import summary  # noqa
+        from users import topn  # noqa
@@ -0,0 +1,212 @@
+"""
+批量请求: 一次 HTTP 请求执行多个 users/urls.py 中的接口
+
+前端打开部门页面要分别请求 /department/<pk>, /departments5/latest/ 和多个 /employee5/<pk>/,
+延迟高的网络上主要时间花在往返上. 合并成一个请求:
+
+    POST /batch
+    {"requests": [
+        {"method": "GET", "path": "/department/1"},
+        {"method": "GET", "path": "/departments5/latest/"},
+        {"method": "PATCH", "path": "/employee5/bulk/", "body": {"ids": [1, 2], "changes": {"age": 30}}},
+        {"method": "GET", "path": "/employee5/1/", "headers": {"If-None-Match": "..."}}
+    ]}
+    ->
+    {"responses": [
+        {"status": 200, "headers": {"Content-Type": "application/json"}, "body": {...}},
+        ...
+    ]}
+
+子请求在当前进程中直接调用视图(不经过中间件), 按顺序执行:
+    - 连续的 GET / HEAD 互不依赖, 在线程池中并发执行, 每个线程使用自己的数据库连接
+      (与普通请求一样, 执行前后按 CONN_MAX_AGE 关闭过期的连接)
+    - 其他方法在当前线程中依次执行, 之后的 GET 能读到它修改的数据
+    - 当前线程在事务中时(ATOMIC_REQUESTS 等), 其他线程读不到未提交的数据, 全部在当前线程中执行;
+      每个连接都是独立数据库的 SQLite :memory: 也在当前线程中执行
+子请求使用外层请求的用户, 会话和 Cookie(CSRF 校验与直接请求时相同), 响应格式为 JSON;
+外层的 If-None-Match, Accept-Encoding 等请求头不传给子请求, 需要时写在子请求的 headers 中.
+每个子请求的响应单独给出状态码, 一个子请求失败不影响其他子请求. 非 JSON 的响应体作为字符串返回.
+
+配置(settings.USERS_BATCH):
+    {
+        'MAX_REQUESTS': 20,    # 每个批量请求最多的子请求数
+        'WORKERS': 4,          # 线程池的线程数(所有批量请求共用), 0 表示不并发
+    }
+"""
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from urllib.parse import unquote_to_bytes
+
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIRequest
+from django.db import close_old_connections, connection
+from django.urls import Resolver404, resolve
+from rest_framework import serializers
+
+logger = logging.getLogger('users.batch')
+
+# 可以并发执行的请求方法
+CONCURRENT_METHODS = ('GET', 'HEAD')
+# 子请求的响应中返回的响应头
+RESPONSE_HEADERS = ('Content-Type', 'ETag', 'Location', 'Retry-After')
+# 不传给子请求的外层请求头
+OUTER_ONLY_HEADERS = (
+    'HTTP_IF_NONE_MATCH',
+    'HTTP_IF_MODIFIED_SINCE',
+    'HTTP_ACCEPT_ENCODING',
+    'HTTP_CONTENT_ENCODING',
+)
+# 批量接口的 url 名称, 子请求不能再是批量请求
+URL_NAME = 'batch'
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_options():
+    options = getattr(settings, 'USERS_BATCH', {})
+    return options.get('MAX_REQUESTS', 20), options.get('WORKERS', 4)
+
+
+def get_executor(workers):
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='users-batch')
+        return _executor
+
+
+class BatchItemSerializer(serializers.Serializer):
+    method = serializers.ChoiceField(
+        label='请求方法', choices=('GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE'), default='GET')
+    path = serializers.RegexField(r'^/', label='路径(可以带查询参数)', max_length=2000)
+    body = serializers.JSONField(label='请求体', required=False)
+    headers = serializers.DictField(label='请求头', child=serializers.CharField(), required=False)
+
+
+class BatchSerializer(serializers.Serializer):
+    requests = BatchItemSerializer(many=True)
+
+    def validate_requests(self, value):
+        max_requests = get_options()[0]
+        if not value:
+            raise serializers.ValidationError('至少需要一个子请求')
+        if len(value) > max_requests:
+            raise serializers.ValidationError('最多 %d 个子请求' % max_requests)
+        return value
+
+
+def build_request(request, item):
+    """用外层请求的环境变量构造子请求"""
+    path, _, query = item['path'].partition('?')
+    body = b'' if item.get('body') is None else json.dumps(item['body']).encode('utf-8')
+    environ = dict(request.META)
+    for name in OUTER_ONLY_HEADERS:
+        environ.pop(name, None)
+    environ.update({
+        'REQUEST_METHOD': item['method'],
+        # WSGI 的环境变量是按 ISO-8859-1 解码的字节, PATH_INFO 不含百分号编码
+        'PATH_INFO': unquote_to_bytes(path).decode('iso-8859-1'),
+        'QUERY_STRING': query.encode('utf-8').decode('iso-8859-1'),
+        'CONTENT_TYPE': 'application/json',
+        'CONTENT_LENGTH': str(len(body)),
+        'HTTP_ACCEPT': 'application/json',
+        'wsgi.input': BytesIO(body),
+    })
+    for name, value in item.get('headers', {}).items():
+        environ['HTTP_' + name.upper().replace('-', '_')] = value
+    sub_request = WSGIRequest(environ)
+    # 中间件在外层请求上设置的属性
+    sub_request.user = request.user
+    if hasattr(request, 'session'):
+        sub_request.session = request.session
+    return sub_request
+
+
+def error_item(status, detail):
+    return b'{"status":%d,"headers":{},"body":%s}' % (
+        status, json.dumps({'detail': detail}, ensure_ascii=False).encode('utf-8'))
+
+
+def encode_item(response):
+    """子请求的响应 -> 信封中的一项(JSON 字节串), JSON 响应体直接拼接, 不再解析"""
+    content = b''.join(response.streaming_content) if response.streaming else response.content
+    content_type = response.get('Content-Type', '')
+    if not content:
+        body = b'null'
+    elif content_type.startswith('application/json'):
+        body = content
+    else:
+        body = json.dumps(content.decode(response.charset or 'utf-8', 'replace'), ensure_ascii=False).encode('utf-8')
+    headers = dict((name, response[name]) for name in RESPONSE_HEADERS if response.has_header(name))
+    return b'{"status":%d,"headers":%s,"body":%s}' % (
+        response.status_code, json.dumps(headers, ensure_ascii=False).encode('utf-8'), body)
+
+
+def dispatch(request, item):
+    """在当前线程中执行一个子请求"""
+    sub_request = build_request(request, item)
+    try:
+        match = resolve(sub_request.path_info, urlconf='users.urls')
+    except Resolver404:
+        return error_item(404, '路径不存在: %s' % item['path'])
+    if match.url_name == URL_NAME:
+        return error_item(400, '子请求不能是批量请求')
+    try:
+        response = match.func(sub_request, *match.args, **match.kwargs)
+        if hasattr(response, 'render') and callable(response.render):
+            response = response.render()
+        return encode_item(response)
+    except Exception:
+        logger.exception('批量请求的子请求出错: %s %s', item['method'], item['path'])
+        return error_item(500, '服务器错误')
+
+
+def _dispatch_in_worker(request, item):
+    close_old_connections()
+    try:
+        return dispatch(request, item)
+    finally:
+        close_old_connections()
+
+
+def can_run_concurrently():
+    if connection.in_atomic_block:
+        return False
+    # 普通的 SQLite :memory: 每个连接都是独立的数据库(测试数据库使用共享缓存, 不受影响)
+    return not (connection.vendor == 'sqlite' and connection.settings_dict['NAME'] == ':memory:')
+
+
+def execute(request, items):
+    """按顺序执行子请求, 返回每个子请求的响应(JSON 字节串)"""
+    workers = get_options()[1]
+    concurrent = workers > 0 and can_run_concurrently()
+    results = [None] * len(items)
+    pending = []
+
+    def flush():
+        if concurrent and len(pending) > 1:
+            executor = get_executor(workers)
+            futures = [(index, executor.submit(_dispatch_in_worker, request, items[index])) for index in pending]
+            for index, future in futures:
+                results[index] = future.result()
+        else:
+            for index in pending:
+                results[index] = dispatch(request, items[index])
+        del pending[:]
+
+    for index, item in enumerate(items):
+        if item['method'] in CONCURRENT_METHODS:
+            pending.append(index)
+            continue
+        flush()
+        results[index] = dispatch(request, item)
+    flush()
+    return results
+
+
+def encode_envelope(results):
+    return b'{"responses":[' + b','.join(results) + b']}'
@@ -0,0 +1,514 @@
+"""
+批量新增, 批量修改, 批量删除
+
+POST /employee5/ 或 /departments5/ 时, 请求体为列表则批量新增:
+    1. 所有外键 id 先用一条 IN (...) 查询确认存在, 不再每行查询一次
+    2. 唯一性检查对整批数据只执行一条 IN (...) 查询, 并检查批次内部的重复
+    3. 在同一个事务中分批写入; 数据库不返回主键时(SQLite, MySQL)由多行 INSERT 的 lastrowid 推算新行的主键
+       (自增主键不连续时逐行 INSERT), 响应和 bulk_changed 都带有真实的 id
+校验失败时返回 400, 错误信息是与请求列表一一对应的列表(通过的行为 {}).
+
+PATCH /departments5/bulk/ 批量修改, 两种请求体:
+    {"ids": [1, 2, 3], "changes": {"is_delete": true}}     所有行改成相同的值
+    [{"id": 1, "name": "研发部"}, {"id": 2, "name": "测试部"}]  每行不同的值
+DELETE /departments5/bulk/ 批量删除:
+    {"ids": [1, 2, 3]}
+修改和删除都用 UPDATE/DELETE ... WHERE id IN (...) 分批执行, 不逐行 save() / delete(),
+只返回受影响的 id: {"ids": [1, 2]}
+    - 视图的 soft_delete_field(如部门的 is_delete)不为空时软删除: UPDATE 该字段为 True, 员工不会被级联删除
+    - 否则直接 DELETE, 不逐行发送 post_delete; 汇总, 搜索索引, Tombstone 等由 bulk_changing / bulk_changed
+      (deleted=True) 按整批主键处理, SQL 条数与行数无关
+    - 有其他表的外键指向该模型(需要级联删除)时, 仍然用 QuerySet.delete() 逐行处理
+
+序列化器的配置:
+    class Meta:
+        model = Department                        # bulk_create 使用的模型类
+        list_serializer_class = BulkListSerializer
+        unique_fields = ('name',)                 # 可选, 默认为模型中 unique=True 的字段
+        soft_delete_field = 'is_delete'           # 可选, 由 True 改为 False(恢复)时检查未修改的唯一字段
+序列化器继承 UniqueFieldsMixin 时, 单个对象新增/修改也检查 unique_fields(每个字段一条查询),
+批量时不逐行查询, 由 BulkListSerializer 对整批检查.
+"""
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import DatabaseError, connections, router, transaction
+from django.db.models import AutoField, Case, F, Value, When
+from django.db.models import sql
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.mixins import CreateModelMixin
+from rest_framework.relations import PrimaryKeyRelatedField
+from rest_framework.response import Response
+from rest_framework.serializers import ListSerializer
+
+from users.metrics import InstrumentedSerializerMixin
+from users.signals import bulk_changed, bulk_changing
+
+# context 中保存批量查询结果的键
+RELATED_CACHE_KEY = 'bulk_related_cache'
+# context 中的标记: 唯一性由 BulkListSerializer.check_unique 对整批检查, 单个序列化器不再检查
+UNIQUE_DEFERRED_KEY = 'bulk_unique_deferred'
+
+
+def get_unique_fields(serializer, model):
+    """序列化器 Meta.unique_fields, 默认为模型中 unique=True 的字段"""
+    unique_fields = getattr(getattr(serializer, 'Meta', None), 'unique_fields', None)
+    if unique_fields is not None:
+        return unique_fields
+    return tuple(
+        field.name for field in model._meta.concrete_fields
+        if field.unique and not field.primary_key
+    )
+
+
+def get_soft_delete_field(serializer):
+    """序列化器 Meta.soft_delete_field(如部门的 is_delete), 没有时为 None"""
+    return getattr(getattr(serializer, 'Meta', None), 'soft_delete_field', None)
+
+
+def unique_error(field_name, value):
+    return '%s "%s" 已存在' % (field_name, value)
+
+
+# 各数据库连接的多行 INSERT 自增主键是否连续: {别名: True / False}
+_consecutive_ids = {}
+
+
+def has_consecutive_ids(using):
+    """
+    一条多行 INSERT 生成的自增主键是否连续, 可以从 lastrowid 推算:
+        - SQLite: 写入串行执行, lastrowid 为最后一行的主键
+        - MySQL: lastrowid(LAST_INSERT_ID())为第一行的主键, innodb_autoinc_lock_mode <= 1
+          且 auto_increment_increment = 1 时连续(每个连接查询一次)
+    其他数据库返回 False
+    """
+    if using not in _consecutive_ids:
+        connection = connections[using]
+        consecutive = connection.features.has_bulk_insert and connection.vendor in ('sqlite', 'mysql')
+        if consecutive and connection.vendor == 'mysql':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT @@innodb_autoinc_lock_mode, @@auto_increment_increment')
+                lock_mode, increment = cursor.fetchone()
+            consecutive = int(lock_mode) <= 1 and int(increment) == 1
+        _consecutive_ids[using] = consecutive
+    return _consecutive_ids[using]
+
+
+def insert_with_pks(model, instances, fields, using):
+    """
+    数据库不返回主键时(SQLite, MySQL)写入并设置主键:
+    自增主键连续时每批一条多行 INSERT, 由 lastrowid 得到这一批的主键; 否则逐行 INSERT, 每行取回自己的主键
+    不按列值对应新行, 并发写入相同的行时也不会对应错
+    """
+    connection = connections[using]
+    if not has_consecutive_ids(using):
+        for instance in instances:
+            query = sql.InsertQuery(model)
+            query.insert_values(fields, [instance])
+            instance.pk = query.get_compiler(using=using).execute_sql(return_id=True)
+        return
+    query = sql.InsertQuery(model)
+    query.insert_values(fields, instances)
+    statements = query.get_compiler(using=using).as_sql()
+    assert len(statements) == 1
+    with connection.cursor() as cursor:
+        cursor.execute(*statements[0])
+        if cursor.rowcount != len(instances):
+            raise DatabaseError('%s: 写入 %d 行, 实际 %d 行' % (model._meta.label, len(instances), cursor.rowcount))
+        last_id = connection.ops.last_insert_id(cursor, model._meta.db_table, model._meta.pk.column)
+    first_id = last_id if connection.vendor == 'mysql' else last_id - len(instances) + 1
+    for offset, instance in enumerate(instances):
+        instance.pk = first_id + offset
+
+
+def bulk_create_with_pks(model, instances, batch_size=None):
+    """在一个事务中 bulk_create, 返回后所有对象都有主键"""
+    using = router.db_for_write(model)
+    connection = connections[using]
+    with transaction.atomic(using=using):
+        if connection.features.can_return_ids_from_bulk_insert or not instances:
+            model._base_manager.using(using).bulk_create(instances, batch_size=batch_size)
+            return instances
+        fields = [field for field in model._meta.concrete_fields if not isinstance(field, AutoField)]
+        batch_size = min(batch_size or len(instances), max(connection.ops.bulk_batch_size(fields, instances), 1))
+        for start in range(0, len(instances), batch_size):
+            insert_with_pks(model, instances[start:start + batch_size], fields, using)
+        for instance in instances:
+            instance._state.adding = False
+            instance._state.db = using
+    return instances
+
+
+class BulkPrimaryKeyRelatedField(PrimaryKeyRelatedField):
+    """批量校验时, 从 BulkListSerializer 一次查询出的结果中查找关联对象"""
+
+    def to_internal_value(self, data):
+        cache = self.context.get(RELATED_CACHE_KEY, {}).get(self.field_name)
+        if cache is None:
+            return super(BulkPrimaryKeyRelatedField, self).to_internal_value(data)
+        if self.pk_field is not None:
+            data = self.pk_field.to_internal_value(data)
+        # 只需要模型类, 不用 get_queryset() 复制查询集(每行都会执行)
+        queryset = self.queryset if self.queryset is not None else self.get_queryset()
+        try:
+            return cache[queryset.model._meta.pk.to_python(data)]
+        except (TypeError, ValueError, DjangoValidationError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        except KeyError:
+            self.fail('does_not_exist', pk_value=data)
+
+
+class BulkListSerializer(InstrumentedSerializerMixin, ListSerializer):
+    """批量校验 + bulk_create, 序列化耗时计入性能统计"""
+    # bulk_create 每批写入的行数
+    batch_size = 500
+
+    @property
+    def model(self):
+        return self.child.Meta.model
+
+    def get_unique_fields(self):
+        return get_unique_fields(self.child, self.model)
+
+    def load_related(self, data):
+        """所有 BulkPrimaryKeyRelatedField 的 id 各用一条 IN (...) 查询取出"""
+        cache = {}
+        for field in self.child.fields.values():
+            if field.read_only or not isinstance(field, BulkPrimaryKeyRelatedField):
+                continue
+            pk_field = field.get_queryset().model._meta.pk
+            pks = set()
+            for item in data:
+                if not isinstance(item, dict) or item.get(field.field_name) is None:
+                    continue
+                try:
+                    pks.add(pk_field.to_python(item[field.field_name]))
+                except (TypeError, ValueError, DjangoValidationError):
+                    # 类型错误由字段自己的校验报告
+                    continue
+            cache[field.field_name] = field.get_queryset().in_bulk(list(pks)) if pks else {}
+        self.context[RELATED_CACHE_KEY] = cache
+
+    def check_unique(self, validated, errors, pks=None):
+        """
+        唯一性: 每个字段一条 name__in 查询 + 批次内的重复检查
+        pks: 批量修改时每一行对应的主键; 本次修改了该字段的行, 数据库中原来的值不算重复(包括互换名称)
+        """
+        if pks is not None:
+            validated = self.with_restored_values(validated, pks)
+        for field_name in self.get_unique_fields():
+            values = {}
+            for index, item in enumerate(validated):
+                if item is None or item.get(field_name) is None:
+                    continue
+                values.setdefault(item[field_name], []).append(index)
+            if not values:
+                continue
+            released = set()
+            if pks is not None:
+                released = set(pks[index] for indexes in values.values() for index in indexes)
+
+            lookup = {field_name + '__in': list(values)}
+            owners = {}
+            for value, pk in self.model._default_manager.filter(**lookup).values_list(field_name, 'pk'):
+                owners.setdefault(value, set()).add(pk)
+            for value, indexes in values.items():
+                others = owners.get(value, set())
+                others = others - released
+                if others:
+                    message = unique_error(field_name, value)
+                elif len(indexes) > 1:
+                    message = '%s "%s" 在本次提交中重复' % (field_name, value)
+                else:
+                    continue
+                for index in indexes:
+                    errors[index].setdefault(field_name, []).append(message)
+
+    def with_restored_values(self, validated, pks):
+        """
+        恢复软删除的行(Meta.soft_delete_field 由 True 改为 False)时, 没有修改的唯一字段也要检查:
+        一条查询取出这些行在数据库中现在的值, 与本次修改的值合并后再检查(只用于检查, 不写入)
+        """
+        soft_delete_field = get_soft_delete_field(self.child)
+        unique_fields = self.get_unique_fields()
+        if soft_delete_field is None or not unique_fields:
+            return validated
+        restoring = [
+            index for index, item in enumerate(validated)
+            if item is not None and item.get(soft_delete_field) is False
+            and any(field_name not in item for field_name in unique_fields)
+        ]
+        if not restoring:
+            return validated
+
+        current = {}
+        restoring_pks = [pks[index] for index in restoring]
+        for start in range(0, len(restoring_pks), self.batch_size):
+            rows = self.model._base_manager.filter(
+                pk__in=restoring_pks[start:start + self.batch_size], **{soft_delete_field: True}
+            ).values_list('pk', *unique_fields)
+            for row in rows:
+                current[row[0]] = dict(zip(unique_fields, row[1:]))
+        validated = list(validated)
+        for index in restoring:
+            if pks[index] in current:
+                item = current[pks[index]]
+                item.update(validated[index])
+                validated[index] = item
+        return validated
+
+    def to_internal_value(self, data):
+        if not isinstance(data, list):
+            return super(BulkListSerializer, self).to_internal_value(data)
+
+        self.load_related(data)
+        try:
+            validated = []
+            errors = []
+            for item in data:
+                try:
+                    validated.append(self.child.run_validation(item))
+                    errors.append({})
+                except ValidationError as exc:
+                    validated.append(None)
+                    errors.append(exc.detail)
+        finally:
+            self.context.pop(RELATED_CACHE_KEY, None)
+
+        if not self.context.get(UNIQUE_DEFERRED_KEY):
+            # 批量修改时由 bulk_update 按主键检查(每行自己原来的值不算重复)
+            self.check_unique(validated, errors)
+        if any(errors):
+            raise ValidationError(errors)
+        return validated
+
+    def create(self, validated_data):
+        model = self.model
+        with transaction.atomic(using=router.db_for_write(model)):
+            instances = bulk_create_with_pks(model, [model(**item) for item in validated_data], self.batch_size)
+            # bulk_create 不发送 post_save; 与写入在同一个事务中累加汇总等
+            bulk_changed.send(sender=model, pks=[instance.pk for instance in instances], objs=instances)
+        return instances
+
+
+class UniqueFieldsMixin(object):
+    """
+    序列化器使用: 单个对象新增/修改时检查 Meta.unique_fields, 每个字段一条查询
+    many=True 的 child 和批量修改(context 中有 UNIQUE_DEFERRED_KEY)时不检查,
+    由 BulkListSerializer.check_unique 对整批只执行一条 IN (...) 查询
+    """
+
+    def validate(self, attrs):
+        attrs = super(UniqueFieldsMixin, self).validate(attrs)
+        if isinstance(self.parent, BulkListSerializer) or self.context.get(UNIQUE_DEFERRED_KEY):
+            return attrs
+
+        model = self.Meta.model
+        soft_delete_field = get_soft_delete_field(self)
+        # 恢复软删除的对象时, 没有修改的唯一字段按现在的值检查
+        restoring = (self.instance is not None and soft_delete_field is not None
+                     and attrs.get(soft_delete_field) is False and getattr(self.instance, soft_delete_field))
+        errors = {}
+        for field_name in get_unique_fields(self, model):
+            value = attrs.get(field_name)
+            if value is None and restoring:
+                value = getattr(self.instance, field_name)
+            if value is None:
+                continue
+            queryset = model._default_manager.filter(**{field_name: value})
+            if self.instance is not None:
+                queryset = queryset.exclude(pk=self.instance.pk)
+            if queryset.exists():
+                errors[field_name] = [unique_error(field_name, value)]
+        if errors:
+            raise ValidationError(errors)
+        return attrs
+
+
+class BulkCreateModelMixin(CreateModelMixin):
+    """请求体为列表时批量新增, 否则与 CreateModelMixin 相同"""
+
+    def create(self, request, *args, **kwargs):
+        if not isinstance(request.data, list):
+            return super(BulkCreateModelMixin, self).create(request, *args, **kwargs)
+        serializer = self.get_serializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        self.perform_create(serializer)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+
+def has_dependents(model):
+    """是否有其他模型的外键 / 一对一 / 多对多指向该模型(删除时需要级联处理)"""
+    return any(
+        model_field.auto_created and not model_field.concrete and model_field.is_relation
+        for model_field in model._meta.get_fields(include_hidden=True)
+    )
+
+
+class BulkUpdateDestroyMixin(object):
+    """视图集使用: PATCH/DELETE {prefix}/bulk/ 批量修改, 批量删除"""
+    # 每条 UPDATE/DELETE 语句处理的行数
+    bulk_batch_size = 500
+    # 软删除的字段(如 is_delete), 为 None 时批量删除直接删除行
+    soft_delete_field = None
+
+    def get_serializer_context(self):
+        context = super(BulkUpdateDestroyMixin, self).get_serializer_context()
+        if getattr(self, 'action', None) == 'bulk':
+            # 批量修改的唯一性在 bulk_update 中对整批检查(排除这些行自己的值)
+            context[UNIQUE_DEFERRED_KEY] = True
+        return context
+
+    @action(methods=['patch', 'delete'], detail=False)
+    def bulk(self, request):
+        if request.method == 'DELETE':
+            return self.bulk_destroy(request)
+        return self.bulk_update(request)
+
+    def get_bulk_ids(self, ids):
+        if not isinstance(ids, list) or not ids:
+            raise ValidationError({'ids': ['必须是非空的 id 列表']})
+        pk_field = self.get_queryset().model._meta.pk
+        try:
+            ids = [pk_field.to_python(pk) for pk in ids]
+        except (TypeError, ValueError, DjangoValidationError):
+            raise ValidationError({'ids': ['id 类型错误']})
+        if None in ids:
+            raise ValidationError({'ids': ['id 不能为空']})
+        # 列表形式中同一个 id 的多个修改只有第一个生效(CASE WHEN), 直接拒绝
+        seen = set()
+        duplicates = set()
+        for pk in ids:
+            (duplicates if pk in seen else seen).add(pk)
+        if duplicates:
+            raise ValidationError({'ids': ['id 重复: %s' % ', '.join(str(pk) for pk in sorted(duplicates))]})
+        return ids
+
+    def get_affected_ids(self, ids):
+        """
+        一条查询: 过滤后实际存在的 id
+        之后的 UPDATE/DELETE 只按这些 id 执行(使用 _base_manager, 不再重复过滤)
+        """
+        queryset = self.filter_queryset(self.get_queryset())
+        return list(queryset.filter(pk__in=ids).order_by().values_list('pk', flat=True))
+
+    def _batches(self, ids):
+        for start in range(0, len(ids), self.bulk_batch_size):
+            yield ids[start:start + self.bulk_batch_size]
+
+    def _column_value(self, model, name, value):
+        """序列化器字段名 -> (数据库列名, 值, 字段)"""
+        model_field = model._meta.get_field(name)
+        if model_field.is_relation:
+            return model_field.attname, getattr(value, 'pk', value), model_field.target_field
+        return model_field.attname, value, model_field
+
+    def bulk_update(self, request):
+        data = request.data
+        model = self.get_queryset().model
+        if isinstance(data, dict):
+            # 所有行改成相同的值
+            ids = self.get_bulk_ids(data.get('ids'))
+            serializer = self.get_serializer(data=data.get('changes'), partial=True)
+            serializer.is_valid(raise_exception=True)
+            if not serializer.validated_data:
+                raise ValidationError({'changes': ['没有要修改的字段']})
+            affected = self.get_affected_ids(ids)
+            rows = [serializer.validated_data] * len(affected)
+        elif isinstance(data, list):
+            # 每行不同的值, 用 CASE id WHEN ... THEN ... 在一条 UPDATE 中完成
+            if not all(isinstance(item, dict) for item in data):
+                raise ValidationError({'non_field_errors': ['列表中的每一项必须是对象']})
+            ids = self.get_bulk_ids([item.get('id') for item in data])
+            affected = set(self.get_affected_ids(ids))
+            items = [(pk, item) for pk, item in zip(ids, data) if pk in affected]
+            affected = [pk for pk, item in items]
+            serializer = self.get_serializer(data=[item for pk, item in items], many=True, partial=True)
+            serializer.is_valid(raise_exception=True)
+            rows = serializer.validated_data
+        else:
+            raise ValidationError({'non_field_errors': ['请求体必须是对象或列表']})
+
+        if not affected:
+            return Response({'ids': []})
+
+        # QuerySet.update() 不处理 auto_now(如增量同步使用的 updated_at), 与修改的列一起更新
+        auto_now = self._auto_now_values(model)
+        with transaction.atomic(using=router.db_for_write(model)):
+            # 唯一性检查与 UPDATE 在同一个事务中
+            errors = [{} for _ in rows]
+            self.get_serializer(many=True).check_unique(rows, errors, pks=affected)
+            if any(errors):
+                raise ValidationError(dict(
+                    (str(pk), error) for pk, error in zip(affected, errors) if error
+                ))
+            # 修改前的值(如部门汇总需要减去员工原来的工资)
+            bulk_changing.send(sender=model, pks=affected)
+            if isinstance(data, dict):
+                values = dict(self._column_value(model, name, value)[:2] for name, value in rows[0].items())
+                if values:
+                    values.update(auto_now)
+                    for batch in self._batches(affected):
+                        model._base_manager.filter(pk__in=batch).update(**values)
+            else:
+                for batch in self._batches(list(zip(affected, rows))):
+                    columns = {}
+                    for pk, row in batch:
+                        for name, value in row.items():
+                            column, value, model_field = self._column_value(model, name, value)
+                            columns.setdefault(column, (model_field, []))[1].append(
+                                When(pk=pk, then=Value(value, output_field=model_field)))
+                    updates = dict(
+                        (column, Case(*whens, default=F(column), output_field=model_field))
+                        for column, (model_field, whens) in columns.items()
+                    )
+                    if updates:
+                        updates.update(auto_now)
+                        model._base_manager.filter(pk__in=[pk for pk, row in batch]).update(**updates)
+            # QuerySet.update() 不发送 post_save; 与修改在同一个事务中累加汇总等
+            bulk_changed.send(sender=model, pks=affected)
+        return Response({'ids': affected})
+
+    def _auto_now_values(self, model):
+        now = timezone.now()
+        return dict((model_field.attname, now) for model_field in model._meta.concrete_fields
+                    if getattr(model_field, 'auto_now', False))
+
+    def bulk_destroy(self, request):
+        data = request.data
+        ids = self.get_bulk_ids(data.get('ids') if isinstance(data, dict) else data)
+        affected = self.get_affected_ids(ids)
+        model = self.get_queryset().model
+        if not affected:
+            return Response({'ids': []})
+
+        if self.soft_delete_field is not None:
+            # 软删除: 与批量修改相同, 只 UPDATE 删除标记(和 updated_at)
+            values = self._auto_now_values(model)
+            values[self.soft_delete_field] = True
+            with transaction.atomic(using=router.db_for_write(model)):
+                bulk_changing.send(sender=model, pks=affected)
+                for batch in self._batches(affected):
+                    model._base_manager.filter(pk__in=batch).update(**values)
+                bulk_changed.send(sender=model, pks=affected)
+        elif has_dependents(model):
+            # 需要级联删除, 由 Django 逐行收集并发送 post_delete
+            with transaction.atomic(using=router.db_for_write(model)):
+                for batch in self._batches(affected):
+                    model._base_manager.filter(pk__in=batch).delete()
+        else:
+            # 汇总, 缓存等监听了 post_delete, QuerySet.delete() 会逐行取出对象并发送信号(与 bulk_changed 重复),
+            # 所以直接执行 DELETE ... WHERE id IN (...), 不收集对象
+            using = router.db_for_write(model)
+            with transaction.atomic(using=using):
+                bulk_changing.send(sender=model, pks=affected)
+                table = connections[using].ops.quote_name(model._meta.db_table)
+                column = connections[using].ops.quote_name(model._meta.pk.column)
+                with connections[using].cursor() as cursor:
+                    for batch in self._batches(affected):
+                        cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (
+                            table, column, ', '.join(['%s'] * len(batch))), batch)
+                # 与删除在同一个事务中写入 Tombstone 等
+                bulk_changed.send(sender=model, pks=affected, deleted=True)
+        return Response({'ids': affected})
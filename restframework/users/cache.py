@@ -0,0 +1,236 @@
+"""
+部门/员工接口的响应缓存
+
+部门数据读多写少, 但每次 GET 都要查询数据库并重新序列化.
+CachedResponseMixin 把渲染好的响应内容按 (视图, 请求路径和参数, 响应格式) 缓存起来:
+    - 缓存后端: 进程内 LRU(lru) 或 Django 缓存(django, 多个进程共享)
+    - Department / Employee 的 post_save / post_delete 以及批量接口的 bulk_changed
+      信号会让相关缓存失效(每个模型一个版本号, 修改时版本号加一, 旧的缓存不再被读到);
+      修改在事务中时, 提交后再加一次: 提交前其他请求读到旧数据存入的缓存也会失效
+    - 响应带强 ETag, 请求头 If-None-Match 匹配时直接返回 304, 不访问数据库
+    - 读写分离时(见 users/routers.py), 未命中缓存的请求从主库读取, 缓存中不会存入从库的旧数据
+
+配置(settings.USERS_RESPONSE_CACHE):
+    {
+        'BACKEND': 'lru',        # 'lru' 或 'django'
+        'MAX_ENTRIES': 1000,     # lru: 最多缓存的响应数
+        'ALIAS': 'default',      # django: 使用的 CACHES 别名
+        'TIMEOUT': 300,          # django: 过期时间(秒)
+    }
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import router, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.encoding import force_bytes
+from django.utils.http import parse_etags, quote_etag
+from rest_framework.response import Response
+
+from users import routers
+from users.models import Department, Employee
+from users.signals import bulk_changed
+
+
+class LRUBackend(object):
+    """进程内 LRU 缓存, 只适合单进程部署, 多进程时各进程的失效互不可见"""
+
+    def __init__(self, max_entries=1000, **kwargs):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_versions(self, names):
+        return [self._versions.get(name, 0) for name in names]
+
+    def bump_version(self, name):
+        with self._lock:
+            self._versions[name] = self._versions.get(name, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+
+
+class DjangoCacheBackend(object):
+    """使用 Django 的缓存(如 memcached, redis), 多个进程共享缓存和版本号"""
+    version_prefix = 'users:version:'
+
+    def __init__(self, alias='default', timeout=300, **kwargs):
+        self.cache = caches[alias]
+        self.timeout = timeout
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value):
+        self.cache.set(key, value, self.timeout)
+
+    def get_versions(self, names):
+        keys = [self.version_prefix + name for name in names]
+        values = self.cache.get_many(keys)
+        return [values.get(key, 0) for key in keys]
+
+    def bump_version(self, name):
+        key = self.version_prefix + name
+        # 版本号不过期, 否则旧缓存可能重新生效
+        if self.cache.add(key, 1, None):
+            return
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            self.cache.set(key, 1, None)
+
+    def clear(self):
+        self.cache.clear()
+
+
+BACKENDS = {
+    'lru': LRUBackend,
+    'django': DjangoCacheBackend,
+}
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                options = dict(getattr(settings, 'USERS_RESPONSE_CACHE', {}))
+                backend_class = BACKENDS[options.pop('BACKEND', 'lru')]
+                _backend = backend_class(**dict((key.lower(), value) for key, value in options.items()))
+    return _backend
+
+
+def model_name(model):
+    return model._meta.label_lower
+
+
+def invalidate(model):
+    """让依赖这个模型的缓存全部失效"""
+    get_backend().bump_version(model_name(model))
+
+
+@receiver(post_save, sender=Department)
+@receiver(post_save, sender=Employee)
+@receiver(post_delete, sender=Department)
+@receiver(post_delete, sender=Employee)
+@receiver(bulk_changed, sender=Department)
+@receiver(bulk_changed, sender=Employee)
+def invalidate_on_change(sender, **kwargs):
+    invalidate(sender)
+    # 不在事务中时立即执行(再加一次没有影响)
+    transaction.on_commit(lambda: invalidate(sender), using=router.db_for_write(sender))
+
+
+class _CacheHit(Exception):
+    """在 initial() 中命中缓存时, 跳过视图方法直接返回缓存的响应"""
+
+    def __init__(self, response):
+        self.response = response
+
+
+class CachedResponseMixin(object):
+    """
+    缓存 GET 请求的响应, 用于 APIView / 视图集
+    认证, 权限检查和内容协商仍然每次执行, 命中缓存时不访问数据库
+    """
+    # 缓存依赖的模型, 其中任意一个修改后缓存失效
+    cache_models = (Department, Employee)
+    # 视图集中需要缓存的 action, APIView 没有 action, 缓存所有 GET 请求
+    cache_actions = ('list', 'retrieve')
+
+    def is_cacheable(self, request):
+        if request.method not in ('GET', 'HEAD'):
+            return False
+        action = getattr(self, 'action', None)
+        return action is None or action in self.cache_actions
+
+    def get_cache_key(self, request):
+        versions = get_backend().get_versions([model_name(model) for model in self.cache_models])
+        query = sorted((key, value) for key in request.GET for value in request.GET.getlist(key))
+        raw = '|'.join([
+            self.__class__.__module__, self.__class__.__name__,
+            # 分页链接等内容包含域名, 所以用完整的 URL
+            str(getattr(self, 'action', None)), request.build_absolute_uri(request.path), repr(query),
+            str(request.accepted_media_type), repr(versions),
+        ])
+        return 'users:response:' + hashlib.md5(force_bytes(raw)).hexdigest()
+
+    def _if_none_match(self, request, etag):
+        header = request.META.get('HTTP_IF_NONE_MATCH')
+        if not header:
+            return False
+        # 弱比较: 压缩后的响应带弱 ETag(W/"..."), 见 users/compression.py
+        etags = [tag[2:] if tag.startswith('W/') else tag for tag in parse_etags(header)]
+        return etag in etags or '*' in etags
+
+    def _not_modified(self, etag):
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+
+    def initial(self, request, *args, **kwargs):
+        super(CachedResponseMixin, self).initial(request, *args, **kwargs)
+        self._cache_key = None
+        if not self.is_cacheable(request):
+            return
+
+        self._cache_key = self.get_cache_key(request)
+        entry = get_backend().get(self._cache_key)
+        if entry is None:
+            # 从库可能还没有复制到最新的修改, 要存入缓存的响应从主库读取
+            routers.use_primary()
+            return
+        if self._if_none_match(request, entry['etag']):
+            raise _CacheHit(self._not_modified(entry['etag']))
+        response = HttpResponse(entry['content'], content_type=entry['content_type'])
+        response['ETag'] = entry['etag']
+        raise _CacheHit(response)
+
+    def handle_exception(self, exc):
+        if isinstance(exc, _CacheHit):
+            return exc.response
+        return super(CachedResponseMixin, self).handle_exception(exc)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super(CachedResponseMixin, self).finalize_response(request, response, *args, **kwargs)
+        cache_key = getattr(self, '_cache_key', None)
+        if cache_key is None or not isinstance(response, Response) or response.status_code != 200:
+            return response
+
+        response.render()
+        etag = quote_etag(hashlib.sha1(response.content).hexdigest())
+        get_backend().set(cache_key, {
+            'content': response.content,
+            'content_type': response['Content-Type'],
+            'etag': etag,
+        })
+        if self._if_none_match(request, etag):
+            return self._not_modified(etag)
+        response['ETag'] = etag
+        return response
@@ -0,0 +1,204 @@
+"""
+部门/员工的增量同步(变化流)
+
+同步通讯录的客户端每次刷新都重新下载整个列表. 增量同步只返回客户端上次同步之后变化的行:
+
+    GET /departments5/changes/                   第一次: 所有行(包括已删除的部门)
+    GET /departments5/changes/?since=<游标>       上次之后新增, 修改, 删除的行
+    GET /employee5/changes/?since=<游标>&page_size=1000
+    ->
+    {"changed": [...], "deleted": [id, ...], "since": "<下次使用的游标>", "more": false}
+
+客户端按 id 更新 changed 中的行, 删除 deleted 中的 id; more 为 true 时立即用新的游标继续请求.
+    - 新增, 修改: Department / Employee 的 updated_at(auto_now; 批量修改时 bulk.py 也会设置)
+    - 删除: post_delete 时写入 Tombstone(包括级联删除); 批量删除时 bulk_changed(deleted=True) 整批一条 INSERT
+    - 软删除的部门(is_delete=True)也在 deleted 中, 恢复后重新出现在 changed 中
+行和 Tombstone 分别按 (updated_at, id), (model, deleted_at, id) 索引读取, 一次同步的耗时与变化的行数成正比.
+
+游标记录已经返回的位置: 时间, 以及该时间上最后返回的行 id 和 Tombstone id(同一时间修改的多行可能分在两页).
+时间由写入时的 timezone.now() 决定, 而事务提交有先后: 先取时间的事务可能在同步之后才提交.
+所以一次同步结束时(more 为 false), 游标最多只记到 OVERLAP 秒之前, 最近 OVERLAP 秒内的变化下次会再返回一次
+(客户端按 id 更新, 重复收到没有影响). 事务的执行时间和服务器之间的时钟误差都要小于 OVERLAP.
+
+Tombstone 保留 TOMBSTONE_DAYS 天, 游标早于这个时间时返回 410, 客户端需要重新全量同步:
+    python manage.py purge_tombstones
+
+配置(settings.USERS_CHANGES):
+    {
+        'PAGE_SIZE': 500,
+        'MAX_PAGE_SIZE': 5000,
+        'OVERLAP': 5,             # 秒
+        'TOMBSTONE_DAYS': 30,
+    }
+"""
+import datetime
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import namedtuple
+
+from django.conf import settings
+from django.db.models import Q
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework.decorators import action
+from rest_framework.exceptions import APIException, ValidationError
+from rest_framework.response import Response
+
+from users.models import Department, Employee, Tombstone
+from users.signals import bulk_changed
+
+# time: 已经返回到的时间, 为 None 表示从头开始; row_id / tombstone_id: 该时间上最后返回的 id
+Cursor = namedtuple('Cursor', ['time', 'row_id', 'tombstone_id'])
+START = Cursor(None, 0, 0)
+DEFAULTS = {
+    'PAGE_SIZE': 500,
+    'MAX_PAGE_SIZE': 5000,
+    'OVERLAP': 5,
+    'TOMBSTONE_DAYS': 30,
+}
+
+
+class ResyncRequired(APIException):
+    status_code = 410
+    default_detail = '同步游标已过期, 请重新全量同步'
+    default_code = 'resync_required'
+
+
+def get_options():
+    options = dict(DEFAULTS)
+    options.update(getattr(settings, 'USERS_CHANGES', {}))
+    return options
+
+
+def model_key(model):
+    return model._meta.model_name
+
+
+def encode_cursor(cursor):
+    tokens = {'t': cursor.time.isoformat() if cursor.time else None, 'r': cursor.row_id, 'd': cursor.tombstone_id}
+    return urlsafe_b64encode(json.dumps(tokens, separators=(',', ':')).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(encoded):
+    try:
+        tokens = json.loads(urlsafe_b64decode(encoded.encode('ascii')).decode('utf-8'))
+        time = parse_datetime(tokens['t']) if tokens['t'] is not None else None
+        cursor = Cursor(time, int(tokens['r']), int(tokens['d']))
+    except (TypeError, ValueError, KeyError, AttributeError):
+        raise ValidationError({'since': ['游标无效']})
+    if tokens['t'] is not None and (time is None or timezone.is_naive(time)):
+        raise ValidationError({'since': ['游标无效']})
+    return cursor
+
+
+def read_changes(queryset, cursor, limit):
+    """
+    queryset: 包含软删除的行的查询集; 按时间顺序读取游标之后最多 limit 个变化
+    返回 (变化的对象, 删除的 id, 新的游标, 是否还有)
+    """
+    tombstones = Tombstone.objects.filter(model=model_key(queryset.model))
+    if cursor.time is not None:
+        queryset = queryset.filter(Q(updated_at__gt=cursor.time) | Q(updated_at=cursor.time, id__gt=cursor.row_id))
+        tombstones = tombstones.filter(
+            Q(deleted_at__gt=cursor.time) | Q(deleted_at=cursor.time, id__gt=cursor.tombstone_id))
+    # 两边各多取一条, 合并后判断是否还有
+    rows = list(queryset.order_by('updated_at', 'id')[:limit + 1])
+    deletions = list(tombstones.order_by('deleted_at', 'id').values_list('deleted_at', 'id', 'object_id')[:limit + 1])
+    events = sorted(
+        [(row.updated_at, 0, row.id, row) for row in rows] +
+        [(deleted_at, 1, tombstone_id, object_id) for deleted_at, tombstone_id, object_id in deletions],
+        key=lambda event: event[:3],
+    )
+    more = len(events) > limit
+    events = events[:limit]
+
+    if events:
+        time = events[-1][0]
+        row_id = cursor.row_id if time == cursor.time else 0
+        tombstone_id = cursor.tombstone_id if time == cursor.time else 0
+        for event_time, kind, event_id, _ in events:
+            if event_time == time:
+                if kind == 0:
+                    row_id = event_id
+                else:
+                    tombstone_id = event_id
+        cursor = Cursor(time, row_id, tombstone_id)
+    if not more:
+        # 最近 OVERLAP 秒内的变化下次再返回一次, 避免漏掉之后才提交的事务
+        safe = timezone.now() - datetime.timedelta(seconds=get_options()['OVERLAP'])
+        if cursor.time is None or cursor.time > safe:
+            cursor = Cursor(safe, 0, 0)
+
+    changed = []
+    deleted = []
+    for _, kind, _, value in events:
+        if kind == 1:
+            deleted.append(value)
+        elif getattr(value, 'is_delete', False):
+            deleted.append(value.id)
+        else:
+            changed.append(value)
+    return changed, deleted, cursor, more
+
+
+def purge_tombstones():
+    """删除超过保留天数的 Tombstone, 返回删除的行数"""
+    expired = timezone.now() - datetime.timedelta(days=get_options()['TOMBSTONE_DAYS'])
+    return Tombstone.objects.filter(deleted_at__lt=expired).delete()[0]
+
+
+@receiver(post_delete, sender=Department)
+@receiver(post_delete, sender=Employee)
+def record_deletion(sender, instance, **kwargs):
+    Tombstone.objects.create(model=model_key(sender), object_id=instance.pk, deleted_at=timezone.now())
+
+
+@receiver(bulk_changed, sender=Department)
+@receiver(bulk_changed, sender=Employee)
+def record_bulk_deletion(sender, pks=None, deleted=False, **kwargs):
+    if not deleted or not pks:
+        return
+    now = timezone.now()
+    Tombstone.objects.bulk_create(
+        [Tombstone(model=model_key(sender), object_id=pk, deleted_at=now) for pk in pks], batch_size=500)
+
+
+class ChangeFeedMixin(object):
+    """视图集使用: GET {prefix}/changes/?since=<游标> 增量同步"""
+    changes_query_param = 'since'
+    changes_page_size_query_param = 'page_size'
+
+    def get_changes_queryset(self):
+        """包含软删除的行, 不使用 get_queryset() 的过滤"""
+        return self.get_queryset().model._base_manager.all()
+
+    def get_changes_page_size(self, request):
+        options = get_options()
+        try:
+            page_size = int(request.query_params.get(self.changes_page_size_query_param, options['PAGE_SIZE']))
+        except ValueError:
+            raise ValidationError({self.changes_page_size_query_param: ['必须是正整数']})
+        if page_size < 1:
+            raise ValidationError({self.changes_page_size_query_param: ['必须是正整数']})
+        return min(page_size, options['MAX_PAGE_SIZE'])
+
+    @action(methods=['get'], detail=False)
+    def changes(self, request):
+        """自定义action: 游标之后变化和删除的行(见 users/changes.py)"""
+        encoded = request.query_params.get(self.changes_query_param)
+        cursor = decode_cursor(encoded) if encoded else START
+        if cursor.time is not None:
+            expired = timezone.now() - datetime.timedelta(days=get_options()['TOMBSTONE_DAYS'])
+            if cursor.time < expired:
+                raise ResyncRequired()
+        changed, deleted, cursor, more = read_changes(
+            self.get_changes_queryset(), cursor, self.get_changes_page_size(request))
+        serializer = self.get_serializer(changed, many=True)
+        return Response({
+            'changed': serializer.data,
+            'deleted': deleted,
+            'since': encode_cursor(cursor),
+            'more': more,
+        })
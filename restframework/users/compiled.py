@@ -0,0 +1,271 @@
+"""
+序列化器的"编译"模式(只读快速路径)
+
+DRF 的 Serializer.to_representation 对每一行都要遍历字段、调用
+field.get_attribute / field.to_representation, many=True 序列化大量数据时
+大部分 CPU 都花在这些通用的分发上.
+
+编译模式在第一次序列化某个模型类的对象时, 根据序列化器声明的字段
+生成一个专用的 "模型对象 -> 字典" 函数, 之后每一行只执行这个函数.
+生成的函数按 (序列化器类, 字段名, 模型类) 缓存, 每个类只编译一次.
+
+支持快速路径的字段: IntegerField, CharField, DateField, DecimalField,
+ChoiceField, PrimaryKeyRelatedField. 其他字段(如嵌套序列化器, BooleanField)
+仍然走 DRF 的通用逻辑, 所以输出与普通模式完全一致.
+
+使用方式:
+    class DepartmentSerializer(CompiledSerializerMixin, serializers.Serializer):
+        compiled = True     # 或者在 settings 中设置 USERS_COMPILED_SERIALIZERS = True
+
+values() 查询出的字典(见 mapping_columns)总是使用编译后的函数, 按列名从字典中取值;
+只有 context 中有 VALUES_CONTEXT_KEY(QueryPlanMixin 使用 values() 时设置)才按字典处理,
+其他字典(如 validated_data)仍然走 DRF 的通用逻辑.
+"""
+import datetime
+import decimal
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+from django.db import models
+from rest_framework import fields as drf_fields
+from rest_framework import relations
+from rest_framework.fields import SkipField
+from rest_framework.relations import ManyRelatedField, PKOnlyObject, RelatedField
+from rest_framework.serializers import BaseSerializer
+from rest_framework.settings import ISO_8601, api_settings
+
+
+# (序列化器类, 字段名元组, 模型类, 是否为字典) -> 编译后的函数
+_compiled_cache = {}
+# context 中的标记: 要序列化的是 values() 查询出的字典
+VALUES_CONTEXT_KEY = 'values_rows'
+
+
+def _generic_field(ret, field, instance):
+    """与 Serializer.to_representation 中单个字段的处理逻辑相同"""
+    try:
+        attribute = field.get_attribute(instance)
+    except SkipField:
+        return
+    check_for_none = attribute.pk if isinstance(attribute, PKOnlyObject) else attribute
+    if check_for_none is None:
+        ret[field.field_name] = None
+    else:
+        ret[field.field_name] = field.to_representation(attribute)
+
+
+def _concrete_field(model, name):
+    """返回模型中名为 name 的普通(非多对多)字段, 没有则返回 None"""
+    try:
+        model_field = model._meta.get_field(name)
+    except FieldDoesNotExist:
+        return None
+    if not getattr(model_field, 'concrete', False) or model_field.many_to_many:
+        return None
+    return model_field
+
+
+_FAST_FIELD_CLASSES = (
+    drf_fields.IntegerField,
+    drf_fields.CharField,
+    drf_fields.ChoiceField,
+    drf_fields.DateField,
+    drf_fields.DecimalField,
+    relations.PrimaryKeyRelatedField,
+)
+
+
+def _plain_field_class(field):
+    """
+    返回字段对应的快速路径类型; 子类只改变了校验逻辑(没有重写
+    get_attribute / to_representation)时, 输出与父类相同, 也可以走快速路径
+    """
+    field_class = type(field)
+    # 声明了输出与某个快速路径类型相同的字段(如 identity.MemoizedChoiceField)
+    compiled_as = getattr(field_class, 'compiled_as', None)
+    if compiled_as in _FAST_FIELD_CLASSES:
+        return compiled_as
+    for base in _FAST_FIELD_CLASSES:
+        if field_class is base:
+            return base
+        if issubclass(field_class, base) \
+                and field_class.get_attribute is base.get_attribute \
+                and field_class.to_representation is base.to_representation:
+            return base
+    return None
+
+
+def _fast_expression(field, model, slot, namespace):
+    """
+    返回 (取值的属性名, 转换表达式) ; 不能走快速路径时返回 None.
+    表达式中用 v 表示取到的属性值(已保证不为 None).
+    """
+    source_attrs = field.source_attrs
+    if field.source == '*' or len(source_attrs) != 1:
+        return None
+    model_field = _concrete_field(model, source_attrs[0])
+    if model_field is None:
+        return None
+
+    field_class = _plain_field_class(field)
+    if field_class is relations.PrimaryKeyRelatedField:
+        if not model_field.is_relation or field.pk_field is not None:
+            return None
+        # 与 use_pk_only_optimization 一致: 直接读取外键列, 不查询关联对象
+        return model_field.attname, 'v'
+
+    if model_field.is_relation:
+        return None
+    attname = model_field.attname
+
+    if field_class is drf_fields.IntegerField:
+        return attname, 'int(v)'
+
+    if field_class is drf_fields.CharField:
+        return attname, 'str(v)'
+
+    if field_class is drf_fields.ChoiceField:
+        if '' in field.choice_strings_to_values:
+            return None
+        namespace['_choices%d' % slot] = field.choice_strings_to_values
+        return attname, "(v if v == '' else _choices%d.get(str(v), v))" % slot
+
+    if field_class is drf_fields.DateField:
+        output_format = getattr(field, 'format', api_settings.DATE_FORMAT)
+        if output_format is None or output_format.lower() != ISO_8601:
+            return None
+        namespace['_to_repr%d' % slot] = field.to_representation
+        return attname, '(v.isoformat() if v.__class__ is _date else _to_repr%d(v))' % slot
+
+    if field_class is drf_fields.DecimalField:
+        coerce_to_string = getattr(field, 'coerce_to_string', api_settings.COERCE_DECIMAL_TO_STRING)
+        if not coerce_to_string or field.localize or field.decimal_places is None:
+            return None
+        context = decimal.getcontext().copy()
+        if field.max_digits is not None:
+            context.prec = field.max_digits
+        namespace['_quantum%d' % slot] = decimal.Decimal('.1') ** field.decimal_places
+        namespace['_context%d' % slot] = context
+        namespace['_rounding%d' % slot] = field.rounding
+        namespace['_to_repr%d' % slot] = field.to_representation
+        return attname, (
+            "(format(v.quantize(_quantum{0}, rounding=_rounding{0}, context=_context{0}), 'f') "
+            "if v.__class__ is _Decimal else _to_repr{0}(v))".format(slot)
+        )
+
+    return None
+
+
+def column_converter(field, model):
+    """
+    字段的值可以直接由一列得到时, 返回 (列名, 转换函数), 否则返回 None.
+    转换函数与编译模式的输出一致, 为 None 表示不需要转换; 列的值为 None 时不调用.
+    """
+    namespace = {'_date': datetime.date, '_Decimal': decimal.Decimal}
+    fast = _fast_expression(field, model, 0, namespace)
+    if fast is None:
+        return None
+    attname, expression = fast
+    if expression in ('v', 'int(v)', 'str(v)'):
+        # 数据库驱动返回的已经是 int / str
+        return attname, None
+    return attname, eval('lambda v: ' + expression, namespace)
+
+
+def mapping_columns(serializer, model):
+    """
+    序列化器的所有可读字段都能从 values() 查询出的字典中取值时, 返回要查询的列名(attname),
+    否则(关联对象, 嵌套序列化器, 模型的属性/方法等)返回 None
+    """
+    columns = []
+    for slot, field in enumerate(serializer._readable_fields):
+        fast = _fast_expression(field, model, slot, {})
+        if fast is not None:
+            columns.append(fast[0])
+            continue
+        if isinstance(field, (BaseSerializer, RelatedField, ManyRelatedField)) \
+                or field.source == '*' or len(field.source_attrs) != 1:
+            return None
+        model_field = _concrete_field(model, field.source_attrs[0])
+        if model_field is None or model_field.is_relation:
+            return None
+        # 普通的列走通用逻辑, DRF 的 get_attribute 也支持从字典中取值
+        columns.append(model_field.attname)
+    return columns
+
+
+def compile_serializer(serializer, model, mapping=False):
+    """
+    为序列化器生成 row(instance, fields) 函数,
+    fields 为序列化器当前的可读字段列表(供走通用逻辑的字段使用)
+    mapping 为 True 时 instance 是 values() 查询出的字典, 按列名取值
+    """
+    namespace = {
+        '_OrderedDict': OrderedDict,
+        '_date': datetime.date,
+        '_Decimal': decimal.Decimal,
+        '_generic_field': _generic_field,
+    }
+    lines = ['def row(instance, fields):', '    ret = _OrderedDict()']
+    for slot, field in enumerate(serializer._readable_fields):
+        fast = _fast_expression(field, model, slot, namespace)
+        if fast is None:
+            lines.append('    _generic_field(ret, fields[%d], instance)' % slot)
+            continue
+        attname, expression = fast
+        if mapping:
+            lines.append('    v = instance[%r]' % attname)
+        else:
+            lines.append('    v = instance.%s' % attname)
+        lines.append('    ret[%r] = None if v is None else %s' % (field.field_name, expression))
+    lines.append('    return ret')
+
+    source = '\n'.join(lines)
+    exec(compile(source, '<compiled %s>' % type(serializer).__name__, 'exec'), namespace)
+    row = namespace['row']
+    row.source = source
+    return row
+
+
+def get_compiled_row(serializer, model, mapping=False):
+    """按 (序列化器类, 字段名, 模型类, 是否为字典) 获取编译后的函数, 每个类只编译一次"""
+    fields = serializer._readable_fields
+    key = (type(serializer), tuple(field.field_name for field in fields), model, mapping)
+    row = _compiled_cache.get(key)
+    if row is None:
+        row = _compiled_cache[key] = compile_serializer(serializer, model, mapping=mapping)
+    return row
+
+
+class CompiledSerializerMixin(object):
+    """
+    为 Serializer 增加编译模式
+    compiled 为 None 时使用 settings.USERS_COMPILED_SERIALIZERS(默认 False)
+    """
+    compiled = None
+
+    def is_compiled(self):
+        if self.compiled is not None:
+            return self.compiled
+        return getattr(settings, 'USERS_COMPILED_SERIALIZERS', False)
+
+    def to_representation(self, instance):
+        model = instance.__class__
+        cached = getattr(self, '_compiled_row', None)
+        if cached is not None and cached[0] is model:
+            return cached[1](instance, cached[2])
+
+        fields = self._readable_fields
+        if isinstance(instance, dict) and self.context.get(VALUES_CONTEXT_KEY) \
+                and getattr(getattr(self, 'Meta', None), 'model', None) is not None:
+            # values() 查询出的字典
+            row = get_compiled_row(self, self.Meta.model, mapping=True)
+        elif self.is_compiled() and isinstance(instance, models.Model):
+            row = get_compiled_row(self, model)
+        else:
+            return super(CompiledSerializerMixin, self).to_representation(instance)
+
+        # 同一个序列化器对象(例如 many=True 时的 child)只查找一次
+        self._compiled_row = (model, row, fields)
+        return row(instance, fields)
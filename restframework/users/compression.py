@@ -0,0 +1,142 @@
+"""
+按请求头 Accept-Encoding 压缩响应(gzip / deflate)
+
+员工列表等 JSON 响应中字段名每行重复一次, 压缩后通常只有原来的 10% ~ 20%.
+Django 的 GZipMiddleware 只支持 gzip, 压缩级别固定; CompressionMiddleware:
+    - 按 Accept-Encoding 的 q 值选择 gzip 或 deflate(相同时优先 gzip), q=0 表示不接受
+    - 小于 MIN_SIZE 的响应不压缩(压缩的头部和 CPU 开销不值得); 压缩后没有变小时返回原文
+    - 大于 LARGE_SIZE 的响应用 FAST_LEVEL 压缩, 否则用 LEVEL:
+      大的响应压缩时间与大小成正比, 用低级别限制 CPU 时间, 压缩率相差不多
+    - 流式响应(?stream=, 导出)逐块压缩, 每块之后 flush, 客户端仍然能边接收边解析
+    - 只压缩 CONTENT_TYPES 中的类型; 已经有 Content-Encoding 的响应不处理
+    - 强 ETag 改为弱 ETag(压缩前后的内容不同), users/cache.py 比较 If-None-Match 时忽略 W/
+
+放在 MetricsMiddleware 之后, 压缩时间计入请求的总耗时.
+
+配置(settings.USERS_COMPRESSION):
+    {
+        'ENABLED': True,
+        'MIN_SIZE': 1024,              # 字节
+        'LARGE_SIZE': 1024 * 1024,     # 字节
+        'LEVEL': 6,
+        'FAST_LEVEL': 1,
+        'CONTENT_TYPES': ('application/json', ...),    # 前缀匹配
+    }
+"""
+import re
+import zlib
+
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from django.utils.deprecation import MiddlewareMixin
+
+# 支持的编码, 按优先顺序; 值为 zlib 的 wbits: gzip 格式, zlib 格式(HTTP 的 deflate)
+ENCODINGS = (
+    ('gzip', 16 + zlib.MAX_WBITS),
+    ('deflate', zlib.MAX_WBITS),
+)
+DEFAULTS = {
+    'ENABLED': True,
+    'MIN_SIZE': 1024,
+    'LARGE_SIZE': 1024 * 1024,
+    'LEVEL': 6,
+    'FAST_LEVEL': 1,
+    'CONTENT_TYPES': (
+        'application/json',
+        'application/x-ndjson',
+        'application/x-msgpack',
+        'application/x-users-columnar',
+        'text/',
+    ),
+}
+Q_VALUE = re.compile(r'^q=([0-9.]+)$')
+
+
+def get_options():
+    options = dict(DEFAULTS)
+    options.update(getattr(settings, 'USERS_COMPRESSION', {}))
+    return options
+
+
+def accepted_encoding(header):
+    """从 Accept-Encoding 中选择编码, 没有可用的编码时返回 None"""
+    weights = {}
+    for item in header.split(','):
+        parts = [part.strip() for part in item.split(';')]
+        name = parts[0].lower()
+        if not name:
+            continue
+        weight = 1.0
+        for param in parts[1:]:
+            match = Q_VALUE.match(param.replace(' ', ''))
+            if match:
+                try:
+                    weight = float(match.group(1))
+                except ValueError:
+                    weight = 0.0
+        weights[name] = weight
+    best, best_weight = None, 0.0
+    for name, wbits in ENCODINGS:
+        weight = weights.get(name, weights.get('*', 0.0))
+        if weight > best_weight:
+            best, best_weight = name, weight
+    return best
+
+
+def compressor(encoding, level):
+    return zlib.compressobj(level, zlib.DEFLATED, dict(ENCODINGS)[encoding])
+
+
+def compress(content, encoding, level):
+    obj = compressor(encoding, level)
+    return obj.compress(content) + obj.flush()
+
+
+def compress_stream(chunks, encoding, level):
+    obj = compressor(encoding, level)
+    for chunk in chunks:
+        data = obj.compress(chunk)
+        if chunk:
+            # 这一块立即发送给客户端, 不等后面的数据
+            data += obj.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield obj.flush()
+
+
+class CompressionMiddleware(MiddlewareMixin):
+
+    def process_response(self, request, response):
+        options = get_options()
+        if not options['ENABLED'] or response.has_header('Content-Encoding'):
+            return response
+        content_type = response.get('Content-Type', '')
+        if not content_type.startswith(tuple(options['CONTENT_TYPES'])):
+            return response
+        if not response.streaming and len(response.content) < options['MIN_SIZE']:
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        encoding = accepted_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None:
+            return response
+
+        if response.streaming:
+            # 不知道总大小, 用 FAST_LEVEL
+            response.streaming_content = compress_stream(
+                response.streaming_content, encoding, options['FAST_LEVEL'])
+            del response['Content-Length']
+        else:
+            size = len(response.content)
+            level = options['FAST_LEVEL'] if size >= options['LARGE_SIZE'] else options['LEVEL']
+            content = compress(response.content, encoding, level)
+            if len(content) >= size:
+                return response
+            response.content = content
+            response['Content-Length'] = str(len(content))
+
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        response['Content-Encoding'] = encoding
+        return response
@@ -0,0 +1,288 @@
+"""
+列表接口的导出格式: CSV, MessagePack, 列式二进制
+
+    GET /department?format=csv
+    GET /employee5/?format=msgpack
+    GET /employee5/?format=columnar&fields=id,name,salary
+
+导出整张表(不分页), 流式输出. 序列化器的字段都能直接由一列得到时
+(见 compiled.column_converter, 如 IntegerField, CharField, 外键 id)走快速路径:
+执行 values_list() 生成的 SQL, 直接从游标分块读取元组, 不创建模型对象,
+也不经过 ORM 逐行的类型转换和序列化器, 只做与序列化器输出相同的转换, 每块一起编码.
+否则每块仍然用序列化器生成字典, 再按列编码. 两种方式输出的值相同.
+
+格式:
+    csv       第一行为字段名, UTF-8
+    msgpack   第一个对象为字段名数组, 之后每行一个数组(需要安装 msgpack)
+    columnar  列式二进制, 整数均为小端:
+                  b'UCOL' + uint8 版本号(1)
+                  uint32 头部长度 + 头部(UTF-8 JSON): {"columns": [{"name": "id", "type": "int"}, ...]}
+                  若干个块: uint32 行数, 然后每一列依次为
+                      空值标记: 每行 1 字节(1 表示 None)
+                      int:  每行 int64
+                      bool: 每行 uint8
+                      str:  (行数 + 1) 个 uint32 偏移量 + UTF-8 数据
+                  uint32 0 表示结束
+"""
+import csv
+import io
+import json
+import struct
+import sys
+from array import array
+from itertools import accumulate
+
+from django.core.exceptions import EmptyResultSet, FieldDoesNotExist
+from django.db import connections
+from django.http import StreamingHttpResponse
+from rest_framework import fields as drf_fields
+from rest_framework.relations import PrimaryKeyRelatedField
+from rest_framework.renderers import BaseRenderer
+
+from users.compiled import column_converter
+from users.streaming import StreamingListMixin
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def _column_type(field):
+    """列式格式中的类型: int, bool 或 str(其他值用 JSON 编码成字符串)"""
+    if isinstance(field, (drf_fields.IntegerField, PrimaryKeyRelatedField)):
+        return 'int'
+    if isinstance(field, drf_fields.BooleanField):
+        return 'bool'
+    if isinstance(field, drf_fields.ChoiceField) \
+            and all(isinstance(key, int) and not isinstance(key, bool) for key in field.choices):
+        return 'int'
+    return 'str'
+
+
+def export_columns(serializer, model):
+    """
+    快速路径的列: [(字段名, 列名, 类型, 转换函数)];
+    有字段不能直接由一列得到时返回 None
+    """
+    columns = []
+    for field in serializer._readable_fields:
+        converter = column_converter(field, model)
+        if converter is None:
+            if not isinstance(field, drf_fields.BooleanField) or field.source == '*' \
+                    or len(field.source_attrs) != 1:
+                return None
+            # BooleanField: 有的数据库驱动返回 0 / 1
+            try:
+                model_field = model._meta.get_field(field.source_attrs[0])
+            except FieldDoesNotExist:
+                return None
+            if model_field.is_relation or not model_field.concrete:
+                return None
+            converter = model_field.attname, bool
+        attname, convert = converter
+        columns.append((field.field_name, attname, _column_type(field), convert))
+    return columns
+
+
+def row_converter(converters, width):
+    """
+    生成把一行(元组)转换成输出值的函数, converters 为 {列序号: 转换函数}
+    与 compiled.compile_serializer 一样生成代码, 避免每个值都判断一次
+    """
+    namespace = {}
+    values = []
+    for index in range(width):
+        if index in converters:
+            namespace['_convert%d' % index] = converters[index]
+            values.append('(None if r[{0}] is None else _convert{0}(r[{0}]))'.format(index))
+        else:
+            values.append('r[%d]' % index)
+    exec(compile('def convert(r):\n    return (%s,)' % ', '.join(values), '<export row>', 'exec'), namespace)
+    return namespace['convert']
+
+
+class ExportRenderer(BaseRenderer):
+    """
+    导出格式的基类, 子类实现 encode_header / encode_rows / encode_footer.
+    ExportListMixin 用它们流式输出整张表; 其他响应(详情, 错误信息等)通过 render() 编码
+    """
+    charset = None
+
+    def prepare_rows(self, types, rows):
+        """序列化器输出的行(值可能是嵌套的对象)转成可以编码的行"""
+        return rows
+
+    def encode_header(self, names, types):
+        return b''
+
+    def encode_rows(self, types, rows):
+        raise NotImplementedError
+
+    def encode_footer(self):
+        return b''
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if isinstance(data, dict) and isinstance(data.get('results'), list):
+            data = data['results']
+        if not isinstance(data, list):
+            data = [data]
+        rows = [item if isinstance(item, dict) else {'value': item} for item in data]
+        names = list(rows[0]) if rows else []
+        types = ['str'] * len(names)
+        values = self.prepare_rows(types, [tuple(row.get(name) for name in names) for row in rows])
+        return self.encode_header(names, types) + self.encode_rows(types, values) + self.encode_footer()
+
+
+def _text(value):
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+
+class CSVRenderer(ExportRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+    charset = 'utf-8'
+
+    def _write(self, rows):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        return buffer.getvalue().encode('utf-8')
+
+    def encode_header(self, names, types):
+        return self._write([names])
+
+    def prepare_rows(self, types, rows):
+        # 嵌套的对象等用 JSON 表示
+        return [tuple(_text(value) if kind == 'str' else value for kind, value in zip(types, row)) for row in rows]
+
+    def encode_rows(self, types, rows):
+        return self._write(rows)
+
+
+class MessagePackRenderer(ExportRenderer):
+    media_type = 'application/x-msgpack'
+    format = 'msgpack'
+
+    def encode_header(self, names, types):
+        return msgpack.packb(names, use_bin_type=True)
+
+    def encode_rows(self, types, rows):
+        packer = msgpack.Packer(use_bin_type=True, autoreset=False)
+        for row in rows:
+            packer.pack(row)
+        return packer.bytes()
+
+
+class ColumnarRenderer(ExportRenderer):
+    media_type = 'application/x-users-columnar'
+    format = 'columnar'
+    version = 1
+
+    def encode_header(self, names, types):
+        header = json.dumps({'columns': [{'name': name, 'type': kind} for name, kind in zip(names, types)]},
+                            ensure_ascii=False).encode('utf-8')
+        return b'UCOL' + struct.pack('<BI', self.version, len(header)) + header
+
+    def _little_endian(self, values):
+        if sys.byteorder != 'little':
+            values.byteswap()
+        return values.tobytes()
+
+    def encode_column(self, kind, values):
+        nulls = bytes([value is None for value in values])
+        if kind == 'int':
+            return nulls + self._little_endian(array('q', [0 if value is None else value for value in values]))
+        if kind == 'bool':
+            return nulls + bytes([bool(value) for value in values])
+        encoded = [b'' if value is None else _text(value).encode('utf-8') for value in values]
+        offsets = array('I', [0])
+        offsets.extend(accumulate(map(len, encoded)))
+        return nulls + self._little_endian(offsets) + b''.join(encoded)
+
+    def encode_rows(self, types, rows):
+        if not rows:
+            return b''
+        parts = [struct.pack('<I', len(rows))]
+        for kind, values in zip(types, zip(*rows)):
+            parts.append(self.encode_column(kind, values))
+        return b''.join(parts)
+
+    def encode_footer(self):
+        return struct.pack('<I', 0)
+
+
+def get_export_renderer_classes():
+    renderer_classes = [CSVRenderer, ColumnarRenderer]
+    if msgpack is not None:
+        renderer_classes.insert(1, MessagePackRenderer)
+    return renderer_classes
+
+
+class ExportListMixin(StreamingListMixin):
+    """
+    列表视图增加导出格式(?format=csv / msgpack / columnar 或者 Accept 请求头)
+    视图中判断 is_export(request), 用 export_response() 返回响应
+    """
+    export_renderer_classes = get_export_renderer_classes()
+
+    def get_renderers(self):
+        renderers = super(ExportListMixin, self).get_renderers()
+        return renderers + [renderer() for renderer in self.export_renderer_classes]
+
+    def is_export(self, request):
+        return isinstance(getattr(request, 'accepted_renderer', None), ExportRenderer)
+
+    def iter_rows(self, queryset, attnames):
+        """执行 values_list() 的 SQL, 从游标分块读取数据库驱动返回的元组"""
+        try:
+            sql, params = queryset.values_list(*attnames).query.get_compiler(queryset.db).as_sql()
+        except EmptyResultSet:
+            return
+        with connections[queryset.db].chunked_cursor() as cursor:
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(self.stream_chunk_size)
+                if not rows:
+                    return
+                yield rows
+
+    def iter_export(self, queryset, serializer, renderer):
+        model = queryset.model
+        columns = export_columns(serializer, model)
+        if columns is not None:
+            # 快速路径: 不创建模型对象, 不经过序列化器
+            names = [column[0] for column in columns]
+            types = [column[2] for column in columns]
+            converters = dict((index, column[3]) for index, column in enumerate(columns) if column[3] is not None)
+            convert = row_converter(converters, len(columns)) if converters else None
+            yield renderer.encode_header(names, types)
+            for rows in self.iter_rows(queryset, [column[1] for column in columns]):
+                yield renderer.encode_rows(types, list(map(convert, rows)) if convert else rows)
+            yield renderer.encode_footer()
+            return
+
+        # 有自定义的字段逻辑: 每块仍然由序列化器生成字典
+        fields = serializer._readable_fields
+        names = [field.field_name for field in fields]
+        types = [_column_type(field) for field in fields]
+        yield renderer.encode_header(names, types)
+        for chunk in self.iter_chunks(queryset):
+            data = type(serializer)(chunk, many=True, context=serializer.context).data
+            rows = renderer.prepare_rows(types, [tuple(item.get(name) for name in names) for item in data])
+            yield renderer.encode_rows(types, rows)
+        yield renderer.encode_footer()
+
+    def export_response(self, queryset, serializer):
+        """serializer: 决定导出哪些字段的序列化器对象(带 context, 支持 ?fields=)"""
+        renderer = self.request.accepted_renderer
+        content_type = renderer.media_type
+        if renderer.charset:
+            content_type += '; charset=%s' % renderer.charset
+        response = StreamingHttpResponse(self.iter_export(queryset, serializer, renderer), content_type=content_type)
+        response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (
+            queryset.model._meta.model_name, renderer.format)
+        return response
@@ -0,0 +1,218 @@
+"""
+请求内的身份映射(identity map): 关联对象每个只查询一次, 只序列化一次
+
+EmployeeSerializer2(depth = 1)序列化员工列表时, 嵌套的部门用 select_related 与员工 JOIN 查询,
+每个员工都带出一份部门的列, 创建一个 Department 对象, 再序列化一次; 而一页员工通常只属于少数几个部门.
+
+身份映射保存在请求上(没有请求时保存在最外层序列化器的 context 中), 同一请求内共用:
+    - 关联对象按 (模型, 主键) 保存, 列表序列化前收集整页的外键值, 缺少的对象用一条 in_bulk 查询取出
+    - 关联对象的输出按 (字段, 主键) 保存, 同一个部门只序列化一次, 之后的行直接使用同一个字典
+      (多行共用同一个字典对象, 修改一行的嵌套输出会影响其他行)
+    - 查询计划(users/planning.py)对这样的字段只查询外键列, 不再 select_related
+
+接口: GET /employee5/?expand=department(列表和详情)使用 EmployeeSerializer2.
+一页员工集中在少数部门时比 select_related 快; 每行都是不同的部门时多一条查询, 没有可复用的输出.
+
+使用方式:
+    class EmployeeSerializer2(IdentityMapModelSerializerMixin, serializers.ModelSerializer):
+        class Meta:
+            depth = 1
+            list_serializer_class = IdentityMapListSerializer
+
+    # 或者声明字段时使用
+    class DepartmentRefSerializer(IdentityMappedFieldMixin, serializers.Serializer): ...
+
+MemoizedChoiceField: 选项的输出按原始值缓存, 不用每行 str() 之后再查找.
+"""
+from collections import defaultdict
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db import models
+from rest_framework.fields import ChoiceField
+from rest_framework.serializers import BaseSerializer, ListSerializer
+
+from users.metrics import InstrumentedSerializerMixin
+
+# 请求上保存身份映射的属性名 / 没有请求时 context 中的键
+REQUEST_ATTRIBUTE = 'users_identity_map'
+CONTEXT_KEY = '_identity_map'
+# in_bulk 每条查询的主键数(SQLite 一条语句最多 999 个参数)
+BATCH_SIZE = 500
+
+
+class IdentityMap(object):
+    """(模型, 主键) -> 对象, (字段, 主键) -> 输出"""
+
+    def __init__(self):
+        self.objects = defaultdict(dict)
+        self.representations = {}
+
+    def add(self, obj):
+        self.objects[type(obj)].setdefault(obj.pk, obj)
+
+    def get_many(self, model, pks):
+        """返回该模型已加载的对象(主键 -> 对象), pks 中缺少的先用 in_bulk 查询"""
+        loaded = self.objects[model]
+        missing = list(set(pk for pk in pks if pk is not None and pk not in loaded))
+        # 与访问关联对象时一样使用 _base_manager(包括软删除的部门)
+        for start in range(0, len(missing), BATCH_SIZE):
+            loaded.update(model._base_manager.in_bulk(missing[start:start + BATCH_SIZE]))
+        return loaded
+
+    def get(self, model, pk):
+        return self.get_many(model, (pk,)).get(pk)
+
+    def representation(self, key, obj, func):
+        """同一个 key 和主键只调用一次 func(obj)"""
+        cache_key = (key, type(obj), obj.pk)
+        try:
+            return self.representations[cache_key]
+        except KeyError:
+            data = self.representations[cache_key] = func(obj)
+            return data
+
+
+def get_identity_map(context):
+    request = context.get('request')
+    if request is not None:
+        # DRF 的 Request 包装的 HttpRequest, 批量接口的子请求各有自己的映射
+        request = getattr(request, '_request', request)
+        identity_map = getattr(request, REQUEST_ATTRIBUTE, None)
+        if identity_map is None:
+            identity_map = IdentityMap()
+            setattr(request, REQUEST_ATTRIBUTE, identity_map)
+        return identity_map
+    identity_map = context.get(CONTEXT_KEY)
+    if identity_map is None:
+        identity_map = context[CONTEXT_KEY] = IdentityMap()
+    return identity_map
+
+
+def _forward_relation(field, model):
+    """字段对应的外键 / 一对一字段(正向), 没有则返回 None"""
+    if field.source == '*' or len(field.source_attrs) != 1:
+        return None
+    try:
+        model_field = model._meta.get_field(field.source_attrs[0])
+    except FieldDoesNotExist:
+        return None
+    if model_field.concrete and (model_field.many_to_one or model_field.one_to_one):
+        return model_field
+    return None
+
+
+class IdentityMappedFieldMixin(object):
+    """
+    嵌套序列化器或关联字段使用: 通过外键列从身份映射中取关联对象, 输出按主键缓存.
+    只支持正向的外键 / 一对一(source 为模型上的一个字段)
+    """
+    identity_mapped = True
+
+    def identity_key(self):
+        """输出的缓存键: 相同的键和主键输出一定相同"""
+        if isinstance(self, BaseSerializer):
+            return type(self), tuple(field.field_name for field in self._readable_fields)
+        return type(self), type(self.parent), self.field_name
+
+    def get_attribute(self, instance):
+        model_field = _forward_relation(self, type(instance)) if isinstance(instance, models.Model) else None
+        if model_field is None:
+            return super(IdentityMappedFieldMixin, self).get_attribute(instance)
+        identity_map = get_identity_map(self.context)
+        # 已经 select_related 的对象直接放入映射
+        cache_name = model_field.get_cache_name()
+        if hasattr(instance, cache_name):
+            obj = getattr(instance, cache_name)
+            if obj is not None:
+                identity_map.add(obj)
+            return obj
+        pk = getattr(instance, model_field.attname)
+        if pk is None:
+            return None
+        obj = identity_map.get(model_field.related_model, pk)
+        if obj is None:
+            raise model_field.related_model.DoesNotExist(
+                '%s matching id %r does not exist.' % (model_field.related_model.__name__, pk))
+        return obj
+
+    def to_representation(self, instance):
+        if not isinstance(instance, models.Model):
+            return super(IdentityMappedFieldMixin, self).to_representation(instance)
+        return get_identity_map(self.context).representation(
+            self.identity_key(), instance, super(IdentityMappedFieldMixin, self).to_representation)
+
+
+def prefetch_identities(serializer, instances):
+    """整页对象的 IdentityMappedFieldMixin 字段, 每个关联模型一条 in_bulk 查询, 并递归处理嵌套的序列化器"""
+    instances = [instance for instance in instances if isinstance(instance, models.Model)]
+    if not instances:
+        return
+    identity_map = get_identity_map(serializer.context)
+    model = type(instances[0])
+    for field in serializer._readable_fields:
+        if not getattr(field, 'identity_mapped', False):
+            continue
+        model_field = _forward_relation(field, model)
+        if model_field is None:
+            continue
+        cache_name = model_field.get_cache_name()
+        pks = set()
+        for instance in instances:
+            if hasattr(instance, cache_name):
+                obj = getattr(instance, cache_name)
+                if obj is not None:
+                    identity_map.add(obj)
+            else:
+                pks.add(getattr(instance, model_field.attname))
+        loaded = identity_map.get_many(model_field.related_model, pks)
+        if isinstance(field, BaseSerializer):
+            prefetch_identities(field, [loaded[pk] for pk in pks if pk in loaded])
+
+
+class IdentityMapListSerializerMixin(object):
+    """列表序列化前, 先一次取出整页的关联对象"""
+
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, models.Manager) else data
+        items = list(iterable)
+        prefetch_identities(self.child, items)
+        return super(IdentityMapListSerializerMixin, self).to_representation(items)
+
+
+class IdentityMapListSerializer(InstrumentedSerializerMixin, IdentityMapListSerializerMixin, ListSerializer):
+    """many=True 时使用, 序列化耗时计入性能统计"""
+
+
+class IdentityMapModelSerializerMixin(object):
+    """ModelSerializer 使用: depth 生成的正向嵌套序列化器使用身份映射"""
+
+    def build_nested_field(self, field_name, relation_info, nested_depth):
+        field_class, field_kwargs = super(IdentityMapModelSerializerMixin, self).build_nested_field(
+            field_name, relation_info, nested_depth)
+        if not relation_info.to_many and not relation_info.reverse:
+            field_class = type(field_class.__name__, (IdentityMappedFieldMixin, field_class), {})
+        return field_class, field_kwargs
+
+
+class MemoizedChoiceField(ChoiceField):
+    """
+    输出按原始值的类型和值缓存(每个字段对象一份, 序列化器每个请求创建一次), 输出与 ChoiceField 相同
+    键包含类型: 0 和 False, 1 和 True 的哈希值相等, ChoiceField 对它们的输出不同
+    """
+    # 编译模式(users/compiled.py)按 ChoiceField 处理
+    compiled_as = ChoiceField
+
+    def __init__(self, choices, **kwargs):
+        super(MemoizedChoiceField, self).__init__(choices, **kwargs)
+        self._display = {}
+
+    def to_representation(self, value):
+        key = (type(value), value)
+        try:
+            return self._display[key]
+        except KeyError:
+            display = self._display[key] = super(MemoizedChoiceField, self).to_representation(value)
+            return display
+        except TypeError:
+            # 不可哈希的值
+            return super(MemoizedChoiceField, self).to_representation(value)
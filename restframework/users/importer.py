@@ -0,0 +1,250 @@
+"""
+员工的批量导入: CSV / NDJSON 文件 -> 按 EmployeeSerializer 的规则校验 -> bulk_create
+
+通过 POST /employee5/ 逐条新增几十万员工需要几个小时, 导入流水线分为三个阶段:
+    读取: 逐行读取文件(不整个读入内存), 每 batch_size 行一批
+    校验: 在进程池中用 EmployeeSerializer 校验, 部门 id 在开始时查询一次,
+          校验时只在这个集合中查找, 不访问数据库
+    写入: 按读取的顺序, 每批一个事务 bulk_create
+最多有 max_pending 批在校验中, 写入跟不上时暂停读取(背压), 内存占用与文件大小无关.
+
+断点: ImportCheckpoint 记录已经处理到的行号, 与这一批数据(以及 bulk_changed 的汇总, 搜索索引等)在同一个事务中提交,
+重新执行时从断点之后继续, 已导入的行不会重复导入.
+被拒绝的行(行号, 原始数据, 错误信息)写入拒绝文件(每行一个 JSON 对象).
+拒绝记录在提交事务之前写入, 在两者之间中断时, 重新执行后这一批的拒绝记录可能重复.
+
+    python manage.py import_employees employees.csv --workers 4
+    POST /employee5/import/   (multipart, file=employees.csv 或 employees.ndjson, 在请求的进程中校验, 不使用进程池)
+"""
+import csv
+import io
+import json
+import multiprocessing
+from collections import deque
+
+import django
+from django.apps import apps
+from django.conf import settings
+from django.db import transaction
+from rest_framework.exceptions import ValidationError
+
+from users.bulk import RELATED_CACHE_KEY, bulk_create_with_pks
+from users.models import Department, Employee, ImportCheckpoint
+from users.serializers import EmployeeSerializer
+from users.signals import bulk_changed
+
+FORMATS = ('csv', 'ndjson')
+
+
+def get_options():
+    options = getattr(settings, 'USERS_IMPORT', {})
+    return options.get('BATCH_SIZE', 1000), options.get('WORKERS', 2)
+
+
+def guess_format(filename):
+    """根据扩展名判断文件格式, .ndjson / .jsonl 为 NDJSON, 其他为 CSV"""
+    if filename and filename.lower().endswith(('.ndjson', '.jsonl')):
+        return 'ndjson'
+    return 'csv'
+
+
+def iter_records(fileobj, file_format):
+    """
+    逐行读取文本文件, 返回 (行号, 记录)
+    CSV 的行号不包括表头; NDJSON 无法解析的行返回原始文本, 由校验报告错误
+    """
+    if file_format == 'csv':
+        for number, record in enumerate(csv.DictReader(fileobj), 1):
+            yield number, record
+        return
+    for number, line in enumerate(fileobj, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield number, json.loads(line)
+        except ValueError:
+            yield number, line
+
+
+def open_upload(uploaded_file):
+    """上传的文件(二进制)转成文本, 兼容带 BOM 的 UTF-8"""
+    return io.TextIOWrapper(uploaded_file.file, encoding='utf-8-sig', newline='')
+
+
+class BatchValidator(object):
+    """按 EmployeeSerializer 的规则校验一批记录, 不访问数据库"""
+
+    def __init__(self, department_ids):
+        # BulkPrimaryKeyRelatedField 从 context 中查找部门, 只需要主键
+        departments = dict((pk, Department(pk=pk)) for pk in department_ids)
+        self.serializer = EmployeeSerializer(context={RELATED_CACHE_KEY: {'department': departments}})
+        self.nullable = set(
+            name for name, field in self.serializer.fields.items() if getattr(field, 'allow_null', False)
+        )
+
+    def clean(self, record):
+        """CSV 中可以为空的字段, 空字符串表示 None"""
+        if not isinstance(record, dict):
+            return record
+        return dict(
+            (name, None if value == '' and name in self.nullable else value)
+            for name, value in record.items() if name is not None
+        )
+
+    def to_model_kwargs(self, validated_data):
+        """校验后的数据 -> Employee(**kwargs), 关联对象换成外键 id(可以在进程之间传递)"""
+        kwargs = {}
+        for name, value in validated_data.items():
+            if isinstance(value, Department):
+                kwargs[Employee._meta.get_field(name).attname] = value.pk
+            else:
+                kwargs[name] = value
+        return kwargs
+
+    def validate(self, batch):
+        """返回 (通过的行 [kwargs], 被拒绝的行 [(行号, 原始数据, 错误信息)])"""
+        valid = []
+        rejects = []
+        for number, record in batch:
+            try:
+                validated_data = self.serializer.run_validation(self.clean(record))
+            except ValidationError as exc:
+                rejects.append((number, record, json.loads(json.dumps(exc.detail))))
+            else:
+                valid.append(self.to_model_kwargs(validated_data))
+        return valid, rejects
+
+
+# 进程池中每个进程的校验器
+_validator = None
+
+
+def _init_worker(department_ids):
+    global _validator
+    if not apps.ready:
+        # 非 fork 方式启动的进程需要重新初始化 Django
+        django.setup()
+    _validator = BatchValidator(department_ids)
+
+
+def _validate_batch(batch):
+    return _validator.validate(batch)
+
+
+class _InlineResult(object):
+    """不使用进程池时, 与 AsyncResult 相同的接口"""
+
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+class EmployeeImporter(object):
+    """
+    导入员工, workers 为 0 时在当前进程中校验
+    checkpoint: 断点名称, 为 None 时不记录断点
+    reject_file: 拒绝记录写入的文本文件, 为 None 时只保留前 max_errors 条在结果中
+    """
+    max_errors = 100
+
+    def __init__(self, workers=None, batch_size=None, checkpoint=None, reject_file=None, progress=None):
+        default_batch_size, default_workers = get_options()
+        self.workers = default_workers if workers is None else workers
+        self.batch_size = batch_size or default_batch_size
+        # 最多同时校验的批数
+        self.max_pending = max(2, self.workers * 2)
+        self.checkpoint_name = checkpoint
+        self.reject_file = reject_file
+        self.progress = progress
+
+    def get_checkpoint(self):
+        if self.checkpoint_name is None:
+            return None
+        checkpoint, created = ImportCheckpoint.objects.get_or_create(name=self.checkpoint_name)
+        return checkpoint
+
+    def iter_batches(self, records, start):
+        batch = []
+        for number, record in records:
+            if number <= start:
+                continue
+            batch.append((number, record))
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def run(self, records):
+        """records: iter_records() 的结果, 返回导入结果的字典"""
+        checkpoint = self.get_checkpoint()
+        result = {
+            'position': checkpoint.position if checkpoint else 0,
+            'imported': 0,
+            'rejected': 0,
+            'errors': [],
+        }
+        department_ids = list(Department.objects.values_list('pk', flat=True))
+
+        self._pool = self._validator = None
+        if self.workers:
+            self._pool = multiprocessing.Pool(self.workers, _init_worker, (department_ids,))
+        else:
+            self._validator = BatchValidator(department_ids)
+
+        pending = deque()
+        try:
+            for batch in self.iter_batches(records, result['position']):
+                pending.append((batch[-1][0], self.submit(batch)))
+                # 背压: 校验中的批数达到上限时, 先写入最早的一批
+                if len(pending) >= self.max_pending:
+                    self.write(pending.popleft(), checkpoint, result)
+            while pending:
+                self.write(pending.popleft(), checkpoint, result)
+        finally:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool.join()
+        return result
+
+    def submit(self, batch):
+        if self._pool is not None:
+            return self._pool.apply_async(_validate_batch, (batch,))
+        return _InlineResult(self._validator.validate(batch))
+
+    def write(self, item, checkpoint, result):
+        position, async_result = item
+        valid, rejects = async_result.get()
+        self.write_rejects(rejects, result)
+
+        instances = [Employee(**kwargs) for kwargs in valid]
+        with transaction.atomic():
+            # 每条 INSERT 的行数由数据库后端决定(如 SQLite 的参数个数限制); 写入后所有对象都有主键
+            bulk_create_with_pks(Employee, instances)
+            if checkpoint is not None:
+                checkpoint.position = position
+                checkpoint.imported += len(instances)
+                checkpoint.rejected += len(rejects)
+                checkpoint.save()
+            # 汇总, 搜索索引等与数据和断点一起提交, 中断后不会跳过这一批的副作用
+            if instances:
+                bulk_changed.send(sender=Employee, pks=[instance.pk for instance in instances], objs=instances)
+
+        result['position'] = position
+        result['imported'] += len(instances)
+        result['rejected'] += len(rejects)
+        if self.progress is not None:
+            self.progress(result)
+
+    def write_rejects(self, rejects, result):
+        for number, record, errors in rejects:
+            reject = {'line': number, 'record': record, 'errors': errors}
+            if self.reject_file is not None:
+                self.reject_file.write(json.dumps(reject, ensure_ascii=False) + '\n')
+            elif len(result['errors']) < self.max_errors:
+                result['errors'].append(reject)
+        if self.reject_file is not None and rejects:
+            self.reject_file.flush()
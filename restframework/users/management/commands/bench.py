@@ -0,0 +1,363 @@
+import datetime
+import decimal
+import json
+import platform
+import time
+
+import django
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.core.signals import request_started
+from django.db import connection, reset_queries
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from rest_framework import serializers as rest_serializers
+
+from users import search, serializers, summary, topn, urls
+from users.export import get_export_renderer_classes
+from users.models import Department, Employee, User
+
+# 每个部门的员工数
+EMPLOYEES_PER_DEPARTMENT = 100
+
+
+def seed(rows, batch_size=5000):
+    """
+    生成 rows 个员工, 每 EMPLOYEES_PER_DEPARTMENT 个员工一个部门
+    batch_size 为每次构造的对象数, 每条 INSERT 的行数由数据库后端决定
+    """
+    Employee.objects.all().delete()
+    Department.all_objects.all().delete()
+    User.objects.all().delete()
+
+    department_count = max(1, rows // EMPLOYEES_PER_DEPARTMENT)
+    Department.all_objects.bulk_create([
+        Department(name='部门%d' % i, create_date=datetime.date(2018, 1, 1) + datetime.timedelta(days=i % 365))
+        for i in range(department_count)
+    ])
+    department_ids = list(Department.all_objects.order_by('id').values_list('id', flat=True))
+
+    for start in range(0, rows, batch_size):
+        Employee.objects.bulk_create([
+            Employee(
+                name='员工%d' % i,
+                age=20 + i % 40,
+                gender=i % 2,
+                salary=decimal.Decimal('%d.%02d' % (3000 + i % 5000, i % 100)),
+                comment=None if i % 3 else '备注%d' % i,
+                department_id=department_ids[i % department_count],
+            )
+            for i in range(start, min(start + batch_size, rows))
+        ])
+    # bulk_create 没有发送信号, 部门汇总和搜索索引重建(与迁移对已有数据的处理相同), 最新部门/员工的列表重新查询
+    summary.rebuild()
+    for model in search.SEARCH_FIELDS:
+        search.rebuild(model)
+    for top in topn.TOP_LISTS.values():
+        top.invalidate()
+    User.objects.create(password='123456')
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percent / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+class Command(BaseCommand):
+    """
+    序列化器, 导出格式和接口的性能测试, 只能在内存 SQLite 的配置下运行(会清空并重新生成数据):
+
+        python manage.py bench --settings=restframework.settings_bench \\
+            --rows 1000 100000 --output bench.json
+        # 与之前的结果比较, 变慢超过 20% 时返回错误
+        python manage.py bench --settings=restframework.settings_bench \\
+            --rows 1000 --baseline bench.json --tolerance 0.2
+    """
+    help = '序列化器吞吐量和接口延迟/查询次数的性能测试'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, nargs='+', default=[1000],
+                            help='员工数量, 可以指定多个, 如 1000 100000 1000000')
+        parser.add_argument('--sample', type=int, default=10000, help='测试序列化器时序列化的最大行数')
+        parser.add_argument('--requests', type=int, default=50, help='每个接口的请求次数')
+        parser.add_argument('--output', help='结果写入的 JSON 文件')
+        parser.add_argument('--baseline', help='用于比较的上一次结果(JSON 文件)')
+        parser.add_argument('--tolerance', type=float, default=0.2, help='允许变慢的比例')
+
+    def handle(self, *args, **options):
+        database = settings.DATABASES['default']
+        if database['ENGINE'] != 'django.db.backends.sqlite3' or database['NAME'] != ':memory:':
+            raise CommandError('性能测试会清空数据, 只能使用 --settings=restframework.settings_bench 运行')
+
+        call_command('migrate', verbosity=0, interactive=False)
+        results = {
+            'meta': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'time': datetime.datetime.now().isoformat(),
+            },
+            'volumes': {},
+        }
+        for rows in options['rows']:
+            self.stdout.write('生成 %d 个员工...' % rows)
+            seed(rows)
+            results['volumes'][str(rows)] = {
+                'serializers': self.bench_serializers(options['sample']),
+                'identity': self.bench_identity(options['sample']),
+                'exports': self.bench_exports(),
+                'routes': self.bench_routes(options['requests']),
+            }
+            self.report(rows, results['volumes'][str(rows)])
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+            self.stdout.write('结果已写入 %s' % options['output'])
+
+        if options['baseline']:
+            self.compare(results, options['baseline'], options['tolerance'])
+
+    def timed(self, func, repeat=3):
+        """执行 repeat 次, 返回最快的一次的耗时(秒)"""
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    def bench_serializers(self, sample):
+        employees = list(Employee.objects.select_related('department')[:sample])
+        departments = list(Department.objects.all()[:sample])
+        users = [{'password': '123456', 'password2': '123456'}] * len(employees)
+        cases = [
+            ('EmployeeSerializer', serializers.EmployeeSerializer, employees),
+            ('EmployeeSerializer2', serializers.EmployeeSerializer2, employees),
+            ('DepartmentSerializer', serializers.DepartmentSerializer, departments),
+            ('DepartmentNameSerializer', serializers.DepartmentNameSerializer, departments),
+            ('UserSerializer', serializers.UserSerializer, users),
+        ]
+        result = {}
+        for name, serializer_class, instances in cases:
+            elapsed = self.timed(lambda: serializer_class(instances, many=True).data)
+            result[name] = {
+                'rows': len(instances),
+                'rows_per_sec': len(instances) / elapsed if elapsed else None,
+            }
+        return result
+
+    def bench_identity(self, sample):
+        """
+        嵌套部门的员工列表(查询 + 序列化): select_related 每行序列化一次部门,
+        与身份映射(users/identity.py)每个部门只查询, 序列化一次对比
+        """
+        class Meta:
+            model = Employee
+            fields = '__all__'
+            depth = 1
+        plain_class = type('PlainEmployeeSerializer', (rest_serializers.ModelSerializer,), {'Meta': Meta})
+        cases = [
+            ('select_related', plain_class, lambda: Employee.objects.select_related('department')[:sample]),
+            ('identity_map', serializers.EmployeeSerializer2, lambda: Employee.objects.all()[:sample]),
+        ]
+        rows = min(sample, Employee.objects.count())
+        result = {}
+        for name, serializer_class, queryset in cases:
+            with CaptureQueriesContext(connection) as queries:
+                serializer_class(list(queryset()), many=True).data
+            elapsed = self.timed(lambda: serializer_class(list(queryset()), many=True).data)
+            result[name] = {
+                'rows': rows,
+                'rows_per_sec': rows / elapsed if elapsed else None,
+                'queries': len(queries),
+            }
+        return result
+
+    def fetch_json(self, client, url):
+        """按 next 链接取完所有分页的 JSON"""
+        while url:
+            data = json.loads(client.get(url).content.decode('utf-8'))
+            url = data.get('next') if isinstance(data, dict) else None
+
+    def bench_exports(self):
+        """
+        整张表导出的吞吐量, 都与 json(原来的 JSON 接口, 分页时每页取最大条数翻完所有页)比较
+        json-stream 为流式 JSON(?stream=json)
+        """
+        client = Client()
+        cases = [
+            ('employee5', '/employee5/', 'page_size=100', Employee.objects.count()),
+            ('department', '/department', '', Department.objects.count()),
+        ]
+        formats = [('json-stream', 'stream=json')] + [
+            (renderer.format, 'format=' + renderer.format) for renderer in get_export_renderer_classes()
+        ]
+        result = {}
+        for name, path, page_query, rows in cases:
+            elapsed = self.timed(lambda: self.fetch_json(client, '%s?%s' % (path, page_query)))
+            baseline = rows / elapsed if elapsed else None
+            result['%s-json' % name] = {'rows': rows, 'rows_per_sec': baseline, 'speedup': 1.0}
+            for export_format, query in formats:
+                url = '%s?%s' % (path, query)
+                elapsed = self.timed(lambda: b''.join(client.get(url).streaming_content))
+                rows_per_sec = rows / elapsed if elapsed else None
+                result['%s-%s' % (name, export_format)] = {
+                    'rows': rows,
+                    'rows_per_sec': rows_per_sec,
+                    'speedup': rows_per_sec / baseline if rows_per_sec and baseline else None,
+                }
+        return result
+
+    def route_cases(self):
+        """每个路由的测试请求: (名称, 方法, 路径, 请求体)"""
+        department = Department.objects.order_by('id').first()
+        employee = Employee.objects.order_by('id').first()
+        return [
+            ('index', 'get', '/index', None),
+            ('department-list', 'get', '/department', None),
+            ('department-detail', 'get', '/department/%d' % department.pk, None),
+            ('departments2-list', 'get', '/departments2', None),
+            ('departments3-list', 'get', '/departments3', None),
+            ('departments3-detail', 'get', '/departments3/%d' % department.pk, None),
+            ('departments4-list', 'get', '/departments4', None),
+            ('departments4-detail', 'get', '/departments4/%d' % department.pk, None),
+            ('departments5-list', 'get', '/departments5/', None),
+            ('departments5-detail', 'get', '/departments5/%d/' % department.pk, None),
+            ('departments5-latest', 'get', '/departments5/latest/', None),
+            ('departments5-latest-n', 'get', '/departments5/latest/?n=20', None),
+            ('departments5-latest-nested', 'get', '/departments5/latest/?n=100&employees=5', None),
+            ('departments5-stats', 'get', '/departments5/stats/', None),
+            ('departments5-nested', 'get', '/departments5/?employees=5', None),
+            ('departments5-changes', 'get', '/departments5/changes/', None),
+            # 修改为原来的值, 重复执行不改变数据
+            ('departments5-name', 'put', '/departments5/%d/name/' % department.pk, {'name': department.name}),
+            ('departments5-bulk', 'patch', '/departments5/bulk/',
+             {'ids': [department.pk], 'changes': {'name': department.name}}),
+            ('employee5-list', 'get', '/employee5/', None),
+            ('employee5-detail', 'get', '/employee5/%d/' % employee.pk, None),
+            # 嵌套部门: 部门整页一条 in_bulk 查询, 每个部门只序列化一次(见 users/identity.py)
+            ('employee5-expand', 'get', '/employee5/?expand=department&page_size=100', None),
+            ('employee5-changes', 'get', '/employee5/changes/', None),
+            ('employee5-latest', 'get', '/employee5/latest/', None),
+            ('employee5-latest-n', 'get', '/employee5/latest/?n=20', None),
+            ('employee5-search', 'get', '/employee5/?search=%E5%91%98%E5%B7%A512', None),
+            ('employee5-bulk', 'patch', '/employee5/bulk/', {'ids': [employee.pk], 'changes': {'age': employee.age}}),
+            # 没有上传文件, 返回 400(导入的吞吐量见 import_employees 命令的输出)
+            ('employee5-import', 'post', '/employee5/import/', {}),
+            # 未登录时返回 403
+            ('metrics', 'get', '/metrics', None),
+            ('batch', 'post', '/batch', {'requests': [
+                {'path': '/department/%d' % department.pk},
+                {'path': '/departments5/latest/'},
+                {'path': '/employee5/%d/' % employee.pk},
+            ]}),
+        ]
+
+    def check_coverage(self, cases):
+        """users/urls.py 中的每个路由都要有测试请求"""
+        paths = [path.lstrip('/') for name, method, path, data in cases]
+        for pattern in urls.urlpatterns:
+            if not any(pattern.regex.match(path) for path in paths):
+                self.stderr.write('路由 %s 没有性能测试' % pattern.regex.pattern)
+
+    def bench_routes(self, requests):
+        client = Client()
+        cases = self.route_cases()
+        self.check_coverage(cases)
+        result = {}
+        # 每个请求开始时 Django 会清空查询记录, 统计查询次数时需要先断开
+        request_started.disconnect(reset_queries)
+        try:
+            self._bench_routes(client, cases, requests, result)
+        finally:
+            request_started.connect(reset_queries)
+        return result
+
+    def _bench_routes(self, client, cases, requests, result):
+        for name, method, path, data in cases:
+            kwargs = {}
+            if data is not None:
+                kwargs = {'data': json.dumps(data), 'content_type': 'application/json'}
+            request = getattr(client, method)
+
+            try:
+                with CaptureQueriesContext(connection) as queries:
+                    response = request(path, **kwargs)
+                # captured_queries 每次访问时才从 connection.queries 中切片, 需要在后续请求之前取值
+                query_count = len(queries)
+            except Exception as exc:
+                # 接口本身出错时记录错误, 继续测试其他接口
+                result[name] = {'method': method.upper(), 'path': path, 'error': repr(exc)}
+                continue
+            timings = []
+            for _ in range(requests):
+                start = time.perf_counter()
+                request(path, **kwargs)
+                timings.append((time.perf_counter() - start) * 1000)
+            result[name] = {
+                'method': method.upper(),
+                'path': path,
+                'status': response.status_code,
+                'queries': query_count,
+                'p50_ms': percentile(timings, 50),
+                'p95_ms': percentile(timings, 95),
+                'mean_ms': sum(timings) / len(timings),
+            }
+
+    def report(self, rows, result):
+        self.stdout.write('== %d 个员工' % rows)
+        for name, item in sorted(result['serializers'].items()):
+            self.stdout.write('  %-26s %12.0f 行/秒' % (name, item['rows_per_sec'] or 0))
+        for name, item in sorted(result['identity'].items()):
+            self.stdout.write('  %-26s %12.0f 行/秒  %4d 条SQL' % (
+                'nested-' + name, item['rows_per_sec'] or 0, item['queries']))
+        for name, item in sorted(result['exports'].items()):
+            self.stdout.write('  %-26s %12.0f 行/秒  %5.1fx' % (name, item['rows_per_sec'] or 0, item['speedup'] or 0))
+        for name, item in sorted(result['routes'].items()):
+            if 'error' in item:
+                self.stdout.write('  %-22s %-6s 出错: %s' % (name, item['method'], item['error']))
+                continue
+            self.stdout.write('  %-22s %-6s %3d  p50 %8.2fms  p95 %8.2fms  %4d 条SQL' % (
+                name, item['method'], item['status'], item['p50_ms'], item['p95_ms'], item['queries']))
+
+    def compare(self, results, baseline_path, tolerance):
+        """与上一次结果比较: 吞吐量下降或延迟/查询次数增加超过 tolerance 视为退化"""
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+
+        regressions = []
+        for rows, volume in results['volumes'].items():
+            old = baseline.get('volumes', {}).get(rows)
+            if old is None:
+                continue
+            throughput = list(volume['serializers'].items()) + list(volume.get('exports', {}).items())
+            old_throughput = dict(old['serializers'], **old.get('exports', {}))
+            throughput += [('nested-' + name, item) for name, item in volume.get('identity', {}).items()]
+            old_throughput.update(('nested-' + name, item) for name, item in old.get('identity', {}).items())
+            for name, item in throughput:
+                before = old_throughput.get(name, {}).get('rows_per_sec')
+                if before and item['rows_per_sec'] < before * (1 - tolerance):
+                    regressions.append('%s 行 %s: %.0f -> %.0f 行/秒' % (rows, name, before, item['rows_per_sec']))
+            for name, item in volume['routes'].items():
+                before = old['routes'].get(name)
+                if 'error' in item:
+                    if before is not None and 'error' not in before:
+                        regressions.append('%s 行 %s: 出错 %s' % (rows, name, item['error']))
+                    continue
+                if before is None or 'error' in before:
+                    continue
+                if item['p50_ms'] > before['p50_ms'] * (1 + tolerance):
+                    regressions.append('%s 行 %s: p50 %.2fms -> %.2fms' % (
+                        rows, name, before['p50_ms'], item['p50_ms']))
+                if item['queries'] > before['queries']:
+                    regressions.append('%s 行 %s: SQL %d -> %d 条' % (
+                        rows, name, before['queries'], item['queries']))
+
+        if regressions:
+            for line in regressions:
+                self.stderr.write('退化: ' + line)
+            raise CommandError('性能退化 %d 项' % len(regressions))
+        self.stdout.write('与 %s 相比没有性能退化' % baseline_path)
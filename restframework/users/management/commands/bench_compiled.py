@@ -0,0 +1,67 @@
+import datetime
+import decimal
+import time
+
+from django.core.management.base import BaseCommand
+from rest_framework.renderers import JSONRenderer
+
+from users.models import Department, Employee
+from users.serializers import DepartmentSerializer, EmployeeSerializer
+
+
+class Command(BaseCommand):
+    """
+    对比序列化器普通模式和编译模式的吞吐量(行/秒)
+    数据在内存中构造, 不需要连接数据库:
+        python manage.py bench_compiled --rows 100000
+    """
+    help = '对比序列化器普通模式和编译模式的吞吐量'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100000, help='员工数量')
+        parser.add_argument('--repeat', type=int, default=3, help='重复次数, 取最快的一次')
+
+    def handle(self, *args, **options):
+        rows = options['rows']
+        repeat = options['repeat']
+
+        departments = [
+            Department(id=i, name='部门%d' % i, create_date=datetime.date(2018, 1, 1 + i % 28))
+            for i in range(1, 101)
+        ]
+        employees = [
+            Employee(
+                id=i,
+                name='员工%d' % i,
+                age=20 + i % 40,
+                gender=i % 2,
+                salary=decimal.Decimal('%d.%02d' % (3000 + i % 5000, i % 100)),
+                comment=None if i % 3 else '备注%d' % i,
+                hire_date=datetime.date(2018, 1 + i % 12, 1 + i % 28),
+                department_id=departments[i % 100].id,
+            )
+            for i in range(1, rows + 1)
+        ]
+
+        for serializer_class, instances in ((EmployeeSerializer, employees),
+                                            (DepartmentSerializer, departments * (rows // 100))):
+            results = {}
+            for compiled in (False, True):
+                serializer_class.compiled = compiled
+                best = None
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    data = serializer_class(instances, many=True).data
+                    elapsed = time.perf_counter() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                results[compiled] = (best, JSONRenderer().render(data))
+            serializer_class.compiled = None
+
+            normal, compiled = results[False], results[True]
+            if normal[1] != compiled[1]:
+                self.stderr.write('%s: 编译模式输出与普通模式不一致!' % serializer_class.__name__)
+            self.stdout.write('%s (%d 行)' % (serializer_class.__name__, len(instances)))
+            self.stdout.write('  普通模式: %10.0f 行/秒' % (len(instances) / normal[0]))
+            self.stdout.write('  编译模式: %10.0f 行/秒  (%.1fx)' % (len(instances) / compiled[0],
+                                                                 normal[0] / compiled[0]))
+            self.stdout.write('  输出一致: %s' % (normal[1] == compiled[1]))
@@ -0,0 +1,59 @@
+import datetime
+import decimal
+import time
+
+from django.core.management.base import BaseCommand
+from rest_framework.renderers import JSONRenderer
+
+from users import compression
+from users.models import Employee
+from users.serializers import EmployeeSerializer
+
+
+class Command(BaseCommand):
+    """
+    员工列表的 JSON 渲染时间, 以及压缩(见 users/compression.py)后的字节数和压缩时间
+    数据在内存中构造, 不需要连接数据库:
+        python manage.py bench_renderer --rows 10000
+    """
+    help = 'JSON 渲染时间和压缩后的大小'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10000, help='员工数量')
+        parser.add_argument('--repeat', type=int, default=5, help='重复次数, 取最快的一次')
+
+    def best(self, func, repeat):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = func()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best * 1000, result
+
+    def handle(self, *args, **options):
+        rows = options['rows']
+        repeat = options['repeat']
+        employees = [
+            Employee(
+                id=i,
+                name='员工%d' % i,
+                age=20 + i % 40,
+                gender=i % 2,
+                salary=decimal.Decimal('%d.%02d' % (3000 + i % 5000, i % 100)),
+                comment=None if i % 3 else '备注%d' % i,
+                hire_date=datetime.date(2018, 1 + i % 12, 1 + i % 28),
+                department_id=1 + i % 100,
+            )
+            for i in range(1, rows + 1)
+        ]
+        data = EmployeeSerializer(employees, many=True).data
+        self.stdout.write('序列化器输出 (%d 行)' % rows)
+        elapsed, content = self.best(lambda: JSONRenderer().render(data, 'application/json', {}), repeat)
+        self.stdout.write('  JSONRenderer:     %8.2fms  %10d 字节' % (elapsed, len(content)))
+        options = compression.get_options()
+        for encoding, wbits in compression.ENCODINGS:
+            for level in sorted({options['LEVEL'], options['FAST_LEVEL']}):
+                elapsed, body = self.best(lambda: compression.compress(content, encoding, level), repeat)
+                self.stdout.write('  %-7s 级别 %d:   %8.2fms  %10d 字节  (%.1f%%)' % (
+                    encoding, level, elapsed, len(body), 100.0 * len(body) / len(content)))
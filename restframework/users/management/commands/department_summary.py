@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from users import summary
+
+
+class Command(BaseCommand):
+    """
+    部门汇总(见 users/summary.py)的检查和重建:
+
+        python manage.py department_summary --check     # 与数据库的聚合结果比较, 不一致时返回非 0
+        python manage.py department_summary --rebuild   # 用聚合结果重建所有部门的汇总
+    """
+    help = '检查或重建按部门汇总的员工人数, 年龄和工资'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', help='与聚合结果比较')
+        parser.add_argument('--rebuild', action='store_true', help='重建所有部门的汇总')
+
+    def handle(self, *args, **options):
+        if not options['check'] and not options['rebuild']:
+            raise CommandError('需要指定 --check 或 --rebuild')
+        if options['rebuild']:
+            summary.rebuild()
+            self.stdout.write('已重建部门汇总')
+        if options['check']:
+            mismatches = summary.check()
+            for department_id, stored, expected in mismatches:
+                self.stdout.write('部门 %s: 汇总 %s, 实际 %s' % (
+                    department_id, self.format(stored), self.format(expected)))
+            if mismatches:
+                raise CommandError('%d 个部门的汇总不一致' % len(mismatches))
+            self.stdout.write('部门汇总一致')
+
+    def format(self, values):
+        return '人数=%s 年龄之和=%s 工资之和=%s' % values
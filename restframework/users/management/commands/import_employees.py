@@ -0,0 +1,56 @@
+import io
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from users.importer import FORMATS, EmployeeImporter, guess_format, iter_records
+from users.models import ImportCheckpoint
+
+
+class Command(BaseCommand):
+    """
+    从 CSV / NDJSON 文件批量导入员工, 见 users/importer.py:
+
+        python manage.py import_employees employees.csv --workers 4
+        # 中断后再次执行同样的命令, 从断点继续; --restart 从头开始
+    CSV 的表头为字段名: name,age,gender,salary,comment,hire_date,department
+    """
+    help = '从 CSV / NDJSON 文件批量导入员工'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='要导入的文件')
+        parser.add_argument('--format', choices=FORMATS, help='文件格式, 默认根据扩展名判断')
+        parser.add_argument('--workers', type=int, help='校验的进程数, 0 表示在当前进程中校验')
+        parser.add_argument('--batch-size', type=int, help='每批的行数')
+        parser.add_argument('--checkpoint', help='断点名称, 默认为文件的绝对路径')
+        parser.add_argument('--restart', action='store_true', help='删除断点, 从头开始导入')
+        parser.add_argument('--rejects', help='拒绝记录文件, 默认为 <path>.rejects.ndjson')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not os.path.isfile(path):
+            raise CommandError('文件不存在: %s' % path)
+        checkpoint = options['checkpoint'] or 'employee:%s' % os.path.abspath(path)
+        if options['restart']:
+            ImportCheckpoint.objects.filter(name=checkpoint).delete()
+        file_format = options['format'] or guess_format(path)
+        reject_path = options['rejects'] or path + '.rejects.ndjson'
+
+        with io.open(path, encoding='utf-8-sig', newline='') as records_file, \
+                io.open(reject_path, 'a', encoding='utf-8') as reject_file:
+            importer = EmployeeImporter(
+                workers=options['workers'],
+                batch_size=options['batch_size'],
+                checkpoint=checkpoint,
+                reject_file=reject_file,
+                progress=self.progress,
+            )
+            result = importer.run(iter_records(records_file, file_format))
+
+        self.stdout.write('导入 %d 行, 拒绝 %d 行, 已处理到第 %d 行' % (
+            result['imported'], result['rejected'], result['position']))
+        if result['rejected']:
+            self.stdout.write('拒绝记录: %s' % reject_path)
+
+    def progress(self, result):
+        self.stdout.write('  第 %d 行: 导入 %d, 拒绝 %d' % (result['position'], result['imported'], result['rejected']))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from users import changes
+
+
+class Command(BaseCommand):
+    """
+    删除超过保留天数(USERS_CHANGES['TOMBSTONE_DAYS'])的删除记录, 见 users/changes.py:
+
+        python manage.py purge_tombstones
+    """
+    help = '删除过期的删除记录(Tombstone)'
+
+    def handle(self, *args, **options):
+        self.stdout.write('已删除 %d 条删除记录' % changes.purge_tombstones())
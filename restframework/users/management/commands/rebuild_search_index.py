@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from users import search
+
+
+class Command(BaseCommand):
+    """
+    重建搜索索引(见 users/search.py):
+
+        python manage.py rebuild_search_index              # 部门和员工
+        python manage.py rebuild_search_index employee     # 只重建员工
+    """
+    help = '重建部门和员工的搜索索引'
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*', help='模型名称: %s' % ', '.join(self.get_models()))
+
+    def get_models(self):
+        return dict((search.model_key(model), model) for model in search.SEARCH_FIELDS)
+
+    def handle(self, *args, **options):
+        models = self.get_models()
+        names = options['models'] or list(models)
+        unknown = [name for name in names if name not in models]
+        if unknown:
+            raise CommandError('未知模型: %s' % ', '.join(unknown))
+        for name in names:
+            search.rebuild(models[name])
+            self.stdout.write('已重建 %s 的搜索索引' % name)
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from users import warmup
+
+
+class Command(BaseCommand):
+    """
+    执行启动预热并输出各阶段的耗时(不管 USERS_WARMUP['ENABLED'] 是否开启), 见 users/warmup.py:
+
+        python manage.py warmup
+        python manage.py warmup --phases urls serializers
+    """
+    help = '执行启动预热, 输出各阶段的耗时'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--phases', nargs='+', choices=warmup.PHASES, help='要执行的阶段, 默认为 PHASES 配置')
+
+    def handle(self, *args, **options):
+        if options['phases']:
+            report = warmup.warm_up(force=True, phases=options['phases'])
+        else:
+            report = warmup.warm_up(force=True)
+        for name, elapsed in report.items():
+            self.stdout.write('  %-12s %8.1fms' % (name, elapsed))
+        self.stdout.write('  %-12s %8.1fms' % ('total', sum(report.values())))
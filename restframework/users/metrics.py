@@ -0,0 +1,289 @@
+"""
+接口的性能统计: 每个视图/动作的总耗时, SQL 次数和耗时, 序列化耗时, 渲染耗时
+
+一个慢请求的时间可能花在 SQL, 序列化或者渲染上, 只看总耗时无法判断.
+    - MetricsMiddleware: 记录整个请求的耗时和 SQL 次数/耗时, 按 (视图, 动作) 分类;
+      视图集的动作(包括 latest, update_name 等自定义 action)从路由中取得
+    - InstrumentedViewMixin: DRF 视图使用, 在 finalize_response 中计时渲染
+      (响应缓存等在视图内部提前渲染的响应也能统计到)
+    - InstrumentedSerializerMixin: 统计 serializer.data 的耗时
+数据保存在进程内的直方图中(对数分桶, 内存大小固定), GET /metrics 返回 p50/p95/p99.
+
+只统计被采样的请求, 未采样的请求只多一次随机数判断.
+流式响应的耗时只统计到返回响应对象为止, 不包括之后逐块生成内容的时间.
+
+配置(settings.USERS_METRICS):
+    {
+        'ENABLED': True,
+        'SAMPLE_RATE': 0.1,    # 采样比例, 0 ~ 1
+    }
+"""
+import bisect
+import random
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections
+from django.template.response import SimpleTemplateResponse
+from django.utils.deprecation import MiddlewareMixin
+from rest_framework.serializers import ListSerializer
+
+
+def _time_bounds():
+    """耗时(毫秒)的分桶上限: 0.05ms ~ 60s, 相邻两个桶相差 20%"""
+    bounds = []
+    value = 0.05
+    while value < 60000:
+        bounds.append(value)
+        value *= 1.2
+    return bounds
+
+
+def _count_bounds():
+    """次数的分桶上限: 0 ~ 20 每个整数一个桶, 之后相邻两个桶相差 25%"""
+    bounds = list(range(21))
+    value = 20.0
+    while value < 100000:
+        value *= 1.25
+        bounds.append(int(value))
+    return bounds
+
+
+TIME_BOUNDS = _time_bounds()
+COUNT_BOUNDS = _count_bounds()
+
+# 每个请求统计的指标 -> 分桶
+METRICS = OrderedDict([
+    ('wall_ms', TIME_BOUNDS),
+    ('db_queries', COUNT_BOUNDS),
+    ('db_ms', TIME_BOUNDS),
+    ('serializer_ms', TIME_BOUNDS),
+    ('renderer_ms', TIME_BOUNDS),
+])
+
+
+class Histogram(object):
+    """固定分桶的直方图, 百分位数在桶内线性插值, 误差不超过一个桶的宽度"""
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # 最后一个桶保存超过最大上限的值
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        if not self.count:
+            return None
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if not count or seen + count < rank:
+                seen += count
+                continue
+            lower = self.bounds[index - 1] if index > 0 else 0
+            upper = self.bounds[index] if index < len(self.bounds) else self.max
+            value = lower + (upper - lower) * (rank - seen) / count
+            return min(value, self.max)
+        return self.max
+
+    def summary(self):
+        return OrderedDict([
+            ('p50', self.percentile(50)),
+            ('p95', self.percentile(95)),
+            ('p99', self.percentile(99)),
+            ('mean', self.sum / self.count if self.count else None),
+            ('max', self.max),
+        ])
+
+
+class MetricsRegistry(object):
+    """进程内的统计数据: (视图, 动作) -> 每个指标一个直方图"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._views = {}
+
+    def record(self, label, values):
+        with self._lock:
+            histograms = self._views.get(label)
+            if histograms is None:
+                histograms = self._views[label] = OrderedDict(
+                    (name, Histogram(bounds)) for name, bounds in METRICS.items()
+                )
+            for name, value in values.items():
+                histograms[name].observe(value)
+
+    def snapshot(self):
+        with self._lock:
+            result = OrderedDict()
+            for label in sorted(self._views):
+                histograms = self._views[label]
+                item = result[label] = OrderedDict([('count', histograms['wall_ms'].count)])
+                for name, histogram in histograms.items():
+                    item[name] = histogram.summary()
+            return result
+
+    def reset(self):
+        with self._lock:
+            self._views.clear()
+
+
+registry = MetricsRegistry()
+
+
+def get_options():
+    options = getattr(settings, 'USERS_METRICS', {})
+    return options.get('ENABLED', True), options.get('SAMPLE_RATE', 0.1)
+
+
+def is_sampled():
+    enabled, sample_rate = get_options()
+    return enabled and sample_rate > 0 and random.random() < sample_rate
+
+
+class RequestRecord(object):
+    """一个被采样的请求的统计数据"""
+
+    def __init__(self, request):
+        self.view = None
+        self.action = request.method.lower()
+        self.timings = dict.fromkeys(('serializer', 'renderer'), 0)
+        self._running = set()
+        self._start = time.perf_counter()
+        # 每个数据库连接: (连接, 原来的 force_debug_cursor, 请求开始时已有的查询记录数)
+        self._connections = []
+        for connection in connections.all():
+            self._connections.append((connection, connection.force_debug_cursor, len(connection.queries_log)))
+            connection.force_debug_cursor = True
+
+    @property
+    def label(self):
+        return '%s.%s' % (self.view, self.action)
+
+    def finish(self):
+        wall = time.perf_counter() - self._start
+        queries = []
+        for connection, force_debug_cursor, start in self._connections:
+            connection.force_debug_cursor = force_debug_cursor
+            queries.extend(list(connection.queries_log)[start:])
+        return OrderedDict([
+            ('wall_ms', wall * 1000),
+            ('db_queries', len(queries)),
+            ('db_ms', sum(float(query['time']) for query in queries) * 1000),
+            ('serializer_ms', self.timings['serializer'] * 1000),
+            ('renderer_ms', self.timings['renderer'] * 1000),
+        ])
+
+
+_local = threading.local()
+
+
+def current_record():
+    """当前线程正在统计的请求, 没有被采样时为 None"""
+    return getattr(_local, 'record', None)
+
+
+@contextmanager
+def timer(name):
+    """把代码块的耗时累加到当前请求的 name 上, 嵌套时只计算最外层"""
+    record = current_record()
+    if record is None or name in record._running:
+        yield
+        return
+    record._running.add(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record._running.discard(name)
+        record.timings[name] += time.perf_counter() - start
+
+
+class MetricsMiddleware(MiddlewareMixin):
+    """
+    按采样比例统计请求, 放在中间件列表的第一个:
+    这样它的 process_response 最后执行, process_template_response 也最后执行(此时才渲染)
+    """
+
+    def process_request(self, request):
+        _local.record = RequestRecord(request) if is_sampled() else None
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        record = current_record()
+        if record is None:
+            return
+        view_class = getattr(view_func, 'cls', None)
+        record.view = view_class.__name__ if view_class is not None else view_func.__name__
+        # 视图集: as_view({'get': 'list'}) 的映射
+        actions = getattr(view_func, 'actions', None)
+        if actions and request.method.lower() in actions:
+            record.action = actions[request.method.lower()]
+
+    def process_template_response(self, request, response):
+        with timer('renderer'):
+            response.render()
+        return response
+
+    def process_response(self, request, response):
+        record = current_record()
+        if record is None:
+            return response
+        _local.record = None
+        values = record.finish()
+        if record.view is not None:
+            # 没有匹配到视图的请求(如 404)不统计
+            registry.record(record.label, values)
+        response['Server-Timing'] = ', '.join([
+            'db;dur=%.2f' % values['db_ms'],
+            'serializer;dur=%.2f' % values['serializer_ms'],
+            'renderer;dur=%.2f' % values['renderer_ms'],
+            'total;dur=%.2f' % values['wall_ms'],
+        ])
+        return response
+
+
+class InstrumentedViewMixin(object):
+    """
+    DRF 视图使用: 用 self.action 作为动作名称, 并在 finalize_response 中计时渲染.
+    与 CachedResponseMixin 一起使用时放在它后面, 缓存的响应在这里渲染.
+    """
+
+    def initial(self, request, *args, **kwargs):
+        record = current_record()
+        if record is not None:
+            record.view = self.__class__.__name__
+            if getattr(self, 'action', None):
+                record.action = self.action
+        super(InstrumentedViewMixin, self).initial(request, *args, **kwargs)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super(InstrumentedViewMixin, self).finalize_response(request, response, *args, **kwargs)
+        if isinstance(response, SimpleTemplateResponse) and not response.is_rendered:
+            with timer('renderer'):
+                response.render()
+        return response
+
+
+class InstrumentedSerializerMixin(object):
+    """统计 serializer.data 的耗时(序列化的结果在第一次访问 data 时生成)"""
+
+    @property
+    def data(self):
+        with timer('serializer'):
+            return super(InstrumentedSerializerMixin, self).data
+
+
+class InstrumentedListSerializer(InstrumentedSerializerMixin, ListSerializer):
+    """many=True 时使用, 见序列化器 Meta.list_serializer_class"""
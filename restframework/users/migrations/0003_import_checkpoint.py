@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 19:24
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0002_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True, verbose_name='导入任务')),
+                ('position', models.IntegerField(default=0, verbose_name='已处理的行号')),
+                ('imported', models.IntegerField(default=0, verbose_name='已导入行数')),
+                ('rejected', models.IntegerField(default=0, verbose_name='被拒绝行数')),
+                ('update_time', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+            ],
+            options={
+                'db_table': 'import_checkpoint',
+            },
+        ),
+    ]
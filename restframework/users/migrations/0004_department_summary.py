@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 19:31
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_summaries(apps, schema_editor):
+    """已有员工的汇总, 之后由 users/summary.py 增量更新"""
+    Employee = apps.get_model('users', 'Employee')
+    DepartmentSummary = apps.get_model('users', 'DepartmentSummary')
+    rows = Employee.objects.order_by().values('department').annotate(
+        headcount=models.Count('id'), age_total=models.Sum('age'), salary_total=models.Sum('salary'))
+    DepartmentSummary.objects.bulk_create([
+        DepartmentSummary(department_id=row['department'], headcount=row['headcount'],
+                          age_total=row['age_total'], salary_total=row['salary_total'])
+        for row in rows
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0003_import_checkpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DepartmentSummary',
+            fields=[
+                ('department', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='summary', serialize=False, to='users.Department', verbose_name='部门')),
+                ('headcount', models.IntegerField(default=0, verbose_name='人数')),
+                ('age_total', models.BigIntegerField(default=0, verbose_name='年龄之和')),
+                ('salary_total', models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='工资之和')),
+            ],
+            options={
+                'db_table': 'department_summary',
+            },
+        ),
+        migrations.RunPython(build_summaries, migrations.RunPython.noop),
+    ]
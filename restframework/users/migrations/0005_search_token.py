@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 19:38
+from __future__ import unicode_literals
+
+import re
+
+from django.db import migrations, models
+
+# 迁移执行时的分词规则和字段(复制自 users/search.py), 之后修改 search.py 不影响本迁移
+SEARCH_FIELDS = (
+    ('Department', ('name',)),
+    ('Employee', ('name', 'comment')),
+)
+WORD = re.compile(r'\w+')
+
+
+def text_tokens(text):
+    tokens = set()
+    for word in WORD.findall(text.lower()):
+        tokens.update(word)
+        tokens.update(word[index:index + 2] for index in range(len(word) - 1))
+    return tokens
+
+
+def build_index(apps, schema_editor):
+    """已有部门和员工的搜索索引, 之后由 users/search.py 通过信号同步"""
+    SearchToken = apps.get_model('users', 'SearchToken')
+    for model_name, fields in SEARCH_FIELDS:
+        model = apps.get_model('users', model_name)
+        key = model._meta.model_name
+        tokens = []
+        for row in model._base_manager.values_list('pk', *fields).iterator():
+            object_tokens = set()
+            for value in row[1:]:
+                if value:
+                    object_tokens |= text_tokens(str(value))
+            tokens.extend(SearchToken(model=key, object_id=row[0], token=token) for token in object_tokens)
+            if len(tokens) >= 10000:
+                SearchToken.objects.bulk_create(tokens)
+                tokens = []
+        SearchToken.objects.bulk_create(tokens)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0004_department_summary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchToken',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=20, verbose_name='模型')),
+                ('object_id', models.IntegerField(verbose_name='对象 id')),
+                ('token', models.CharField(max_length=2, verbose_name='n-gram')),
+            ],
+            options={
+                'db_table': 'search_token',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='searchtoken',
+            index=models.Index(fields=['model', 'object_id'], name='search_token_object_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='searchtoken',
+            unique_together=set([('model', 'token', 'object_id')]),
+        ),
+        migrations.RunPython(build_index, migrations.RunPython.noop),
+    ]
@@ -1,17 +1,40 @@
 from django.db import models
 
 
+class LiveDepartmentManager(models.Manager):
+    """只查询未删除(is_delete=False)的部门"""
+
+    def get_queryset(self):
+        return super(LiveDepartmentManager, self).get_queryset().filter(is_delete=False)
+
+
 class Department(models.Model):
     """部门模型类"""
     name = models.CharField(max_length=20, verbose_name='部门名称')
     create_date = models.DateField(verbose_name='成立时间')
     is_delete = models.BooleanField(default=False, verbose_name='是否删除')
+    # 增量同步(?since=)使用, 见 users/changes.py
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='修改时间')
+
+    # 默认只查询未删除的部门
+    objects = LiveDepartmentManager()
+    # 包含已删除的部门
+    all_objects = models.Manager()
 
     def __str__(self):
         return self.name
 
     class Meta(object):
         db_table = 'department'
+        # 外键查询员工所属部门时, 已删除的部门也要能查到
+        base_manager_name = 'all_objects'
+        # is_delete 放在最前面: 查询未删除的部门时按 name 过滤, 按 (create_date, id) 排序/分页都能用上索引
+        indexes = [
+            models.Index(fields=['is_delete', 'name'], name='department_live_name_idx'),
+            models.Index(fields=['is_delete', 'create_date', 'id'], name='department_live_created_idx'),
+            # 增量同步按 (updated_at, id) 读取变化的部门
+            models.Index(fields=['updated_at', 'id'], name='department_updated_idx'),
+        ]
 
 
 class Employee(models.Model):
@@ -29,13 +52,83 @@ class Employee(models.Model):
     hire_date = models.DateField(help_text='xx',verbose_name='入职时间', auto_now_add=True)
     # 关联属性
     department = models.ForeignKey('Department', verbose_name='所属部门')
+    # 增量同步(?since=)使用, 见 users/changes.py
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='修改时间')
 
     def __str__(self):
         return self.name
 
     class Meta(object):
         db_table = 'employee'
+        indexes = [
+            # 按部门查询员工并按入职时间排序
+            models.Index(fields=['department', 'hire_date'], name='employee_dept_hire_idx'),
+            # 按 (hire_date, id) 排序/分页
+            models.Index(fields=['hire_date', 'id'], name='employee_hire_id_idx'),
+            # 增量同步按 (updated_at, id) 读取变化的员工
+            models.Index(fields=['updated_at', 'id'], name='employee_updated_idx'),
+        ]
 
 
 class User(models.Model):
-    password = models.CharField(max_length=30)
\ No newline at end of file
+    password = models.CharField(max_length=30)
+
+class ImportCheckpoint(models.Model):
+    """批量导入的断点(见 users/importer.py), 与导入的数据在同一个事务中更新"""
+    name = models.CharField(max_length=255, unique=True, verbose_name='导入任务')
+    position = models.IntegerField(default=0, verbose_name='已处理的行号')
+    imported = models.IntegerField(default=0, verbose_name='已导入行数')
+    rejected = models.IntegerField(default=0, verbose_name='被拒绝行数')
+    update_time = models.DateTimeField(auto_now=True, verbose_name='更新时间')
+
+    def __str__(self):
+        return self.name
+
+    class Meta(object):
+        db_table = 'import_checkpoint'
+
+
+class DepartmentSummary(models.Model):
+    """每个部门的员工汇总(见 users/summary.py), 员工变化时增量更新"""
+    department = models.OneToOneField('Department', primary_key=True, related_name='summary', verbose_name='部门')
+    headcount = models.IntegerField(default=0, verbose_name='人数')
+    age_total = models.BigIntegerField(default=0, verbose_name='年龄之和')
+    salary_total = models.DecimalField(default=0, max_digits=14, decimal_places=2, verbose_name='工资之和')
+
+    def __str__(self):
+        return str(self.department_id)
+
+    class Meta(object):
+        db_table = 'department_summary'
+
+
+class SearchToken(models.Model):
+    """搜索索引(见 users/search.py): 每个对象的每个 n-gram 一行"""
+    model = models.CharField(max_length=20, verbose_name='模型')
+    object_id = models.IntegerField(verbose_name='对象 id')
+    token = models.CharField(max_length=2, verbose_name='n-gram')
+
+    def __str__(self):
+        return self.token
+
+    class Meta(object):
+        db_table = 'search_token'
+        # 搜索时按 (model, token) 查出对象 id, 只读索引
+        unique_together = ('model', 'token', 'object_id')
+        indexes = [
+            # 同步索引时按 (model, object_id) 查询
+            models.Index(fields=['model', 'object_id'], name='search_token_object_idx'),
+        ]
+
+
+class Tombstone(models.Model):
+    """删除的部门/员工, 增量同步(见 users/changes.py)时通知客户端删除, 保留 USERS_CHANGES['TOMBSTONE_DAYS'] 天"""
+    model = models.CharField(max_length=20, verbose_name='模型')
+    object_id = models.IntegerField(verbose_name='对象 id')
+    deleted_at = models.DateTimeField(verbose_name='删除时间')
+
+    class Meta(object):
+        db_table = 'tombstone'
+        indexes = [
+            models.Index(fields=['model', 'deleted_at', 'id'], name='tombstone_model_deleted_idx'),
+        ]
@@ -0,0 +1,141 @@
+"""
+嵌套输出关联对象的列表(如组织架构页面: 部门 -> 员工)
+
+    GET /departments5/?employees=5      每个部门最近入职的 5 个员工, 以及员工总数
+    GET /departments5/?employees=all    每个部门的全部员工
+
+直接声明 employee_set = EmployeeSerializer(many=True) 时, 每个部门查询一次员工, 而且不限制个数.
+NestedRelationSerializerMixin 只在请求参数指定时增加两个字段:
+    employee_set    LimitedListSerializer, QueryPlanMixin 为它生成一个 Prefetch 查询,
+                    整页的部门只查询一次员工
+    employee_count  RelatedCountField, 用关联子查询注解到部门的查询上, 只计算当前页的部门
+所以不论一页有多少个部门, 都只有 2 条 SQL.
+
+限制每个部门的个数时, Prefetch 的查询只保留每个部门排在前 N 的员工:
+    WHERE employee.id IN (SELECT U0.id FROM employee U0
+                          WHERE U0.department_id = employee.department_id
+                          ORDER BY U0.hire_date DESC, U0.id DESC LIMIT N)
+子查询按 (department_id, hire_date) 索引读取. MySQL 不支持 IN 子查询中的 LIMIT,
+此时查询这些部门的全部员工, 在 Python 中每个部门只保留前 N 个.
+
+只对使用 QueryPlanMixin 的视图生效(其他视图没有 Prefetch, 会逐行查询).
+"""
+from django.db import connections, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from rest_framework import serializers
+from rest_framework.permissions import SAFE_METHODS
+
+
+def reverse_relation(model, accessor_name):
+    """反向关联的访问器名称(如 employee_set) -> ManyToOneRel, 没有则返回 None"""
+    for model_field in model._meta.get_fields():
+        if model_field.one_to_many and model_field.auto_created and model_field.get_accessor_name() == accessor_name:
+            return model_field
+    return None
+
+
+def limit_per_parent(queryset, fk_name, ordering, limit):
+    """每个父对象(外键 fk_name)只保留按 ordering 排在前 limit 个的对象"""
+    queryset = queryset.order_by(*ordering)
+    if limit is None or not connections[queryset.db].features.allow_sliced_subqueries:
+        return queryset
+    top = queryset.model._default_manager.filter(**{fk_name: OuterRef(fk_name)}).order_by(*ordering)
+    return queryset.filter(pk__in=Subquery(top.values('pk')[:limit]))
+
+
+class LimitedListSerializer(serializers.ListSerializer):
+    """
+    嵌套的关联对象列表, 按 ordering 排序, 每个父对象最多 limit 个
+    get_prefetch_queryset() 供 QueryPlanMixin 生成 Prefetch 的查询集
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.limit = kwargs.pop('limit', None)
+        self.ordering = kwargs.pop('ordering', ())
+        super(LimitedListSerializer, self).__init__(*args, **kwargs)
+
+    def get_prefetch_queryset(self, queryset, model_field):
+        return limit_per_parent(queryset, model_field.field.name, self.ordering, self.limit)
+
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, models.Manager) else data
+        if self.limit is not None:
+            # 数据库不支持子查询中的 LIMIT 时, Prefetch 查询出了全部对象
+            iterable = list(iterable)[:self.limit]
+        return [self.child.to_representation(item) for item in iterable]
+
+
+class RelatedCountField(serializers.IntegerField):
+    """
+    反向关联对象的个数
+    get_annotation() 供 QueryPlanMixin 注解到查询集上, 没有注解时逐行 COUNT
+    """
+
+    def __init__(self, relation, **kwargs):
+        self.relation = relation
+        kwargs['read_only'] = True
+        super(RelatedCountField, self).__init__(**kwargs)
+
+    def get_annotation(self, model):
+        model_field = reverse_relation(model, self.relation)
+        fk_name = model_field.field.name
+        counts = model_field.related_model._default_manager.filter(**{fk_name: OuterRef('pk')}) \
+            .order_by().values(fk_name).annotate(count=Count('pk')).values('count')
+        return Coalesce(Subquery(counts, output_field=IntegerField()), 0)
+
+    def get_attribute(self, instance):
+        try:
+            return super(RelatedCountField, self).get_attribute(instance)
+        except AttributeError:
+            return getattr(instance, self.relation).count()
+
+
+class NestedRelationSerializerMixin(object):
+    """
+    序列化器使用: 请求参数 ?{nested_query_param}=N / all 时增加嵌套的关联对象列表和总数
+    子类设置 nested_relation(反向关联的访问器名称), nested_count_name, nested_query_param,
+    nested_ordering, 并实现 get_nested_child()
+    """
+    nested_relation = None
+    # 关联对象个数的字段名
+    nested_count_name = None
+    nested_query_param = None
+    nested_ordering = ()
+    # 每个父对象最多返回的个数
+    nested_max_limit = 100
+
+    def get_nested_child(self):
+        raise NotImplementedError
+
+    def get_nested_limit(self):
+        """返回 (是否嵌套, 每个父对象的个数上限); 上限为 None 表示不限制"""
+        if self.parent is not None and not (isinstance(self.parent, serializers.ListSerializer)
+                                            and self.parent.parent is None):
+            return False, None
+        request = self.context.get('request')
+        view = self.context.get('view')
+        if request is None or request.method not in SAFE_METHODS or not getattr(view, 'auto_plan_queryset', False):
+            return False, None
+        params = getattr(request, 'query_params', request.GET)
+        value = params.get(self.nested_query_param)
+        if not value:
+            return False, None
+        if value == 'all':
+            return True, None
+        try:
+            limit = int(value)
+        except ValueError:
+            limit = -1
+        if limit < 1:
+            raise serializers.ValidationError({self.nested_query_param: ['必须是正整数或 all']})
+        return True, min(limit, self.nested_max_limit)
+
+    def get_fields(self):
+        fields = super(NestedRelationSerializerMixin, self).get_fields()
+        nested, limit = self.get_nested_limit()
+        if nested:
+            fields[self.nested_relation] = LimitedListSerializer(
+                child=self.get_nested_child(), limit=limit, ordering=self.nested_ordering, read_only=True)
+            fields[self.nested_count_name] = RelatedCountField(self.nested_relation)
+        return fields
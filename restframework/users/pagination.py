@@ -0,0 +1,151 @@
+"""
+键集(keyset / cursor)分页
+
+PageNumberPagination 每一页都要执行一次 COUNT(*), 再用 OFFSET 跳过前面的行,
+页码越大越慢. 键集分页记住上一页最后一行的排序键, 下一页直接用
+WHERE (create_date, id) > (上一页最后一行) 定位, 不需要 COUNT 也不需要 OFFSET,
+配合 (create_date, id) 上的索引, 任意深度的翻页耗时都相同.
+
+DRF 自带的 CursorPagination 只用第一个排序字段定位, 排序字段重复的行
+(例如同一天成立的部门)还要靠 OFFSET 跳过, 所以这里按完整的排序键比较.
+"""
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import namedtuple
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.utils import six
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination
+from rest_framework.utils.urls import replace_query_param
+
+# position: 排序键的值列表; reverse: 是否向前(上一页)翻页
+Cursor = namedtuple('Cursor', ['position', 'reverse'])
+
+
+class KeysetPagination(CursorPagination):
+    """按完整排序键定位的游标分页, 子类需指定 ordering(最后一个字段必须唯一, 如 id)"""
+    ordering = ('id',)
+    page_size = 2  # 每页显示2条
+    cursor_query_param = 'cursor'  # 查询关键字名称: 游标
+    page_size_query_param = 'page_size'  # 查询关键字名称：每页多少条
+    max_page_size = 100  # 服务端限制的每页最大条数
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.cursor = self.decode_cursor(request)
+        position, reverse = self.cursor if self.cursor else (None, False)
+
+        names, defer = queryset.query.deferred_loading
+        if names and not defer:
+            # only() 时排序字段也要查询, 否则取游标位置时每行都要再查询一次
+            queryset = queryset.only(*set(names).union(order.lstrip('-') for order in self.ordering))
+
+        if reverse:
+            queryset = queryset.order_by(*self._reverse(self.ordering))
+        else:
+            queryset = queryset.order_by(*self.ordering)
+        if position is not None:
+            try:
+                queryset = queryset.filter(self._keyset_filter(position, reverse))
+            except (TypeError, ValueError, ValidationError):
+                raise NotFound(self.invalid_cursor_message)
+
+        # 多取一条, 用于判断后面是否还有数据
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        if reverse:
+            self.page.reverse()
+            self.has_next = position is not None
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = position is not None
+
+        self.display_page_controls = self.has_next or self.has_previous
+        self.request = request
+        return self.page
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        if self.page:
+            position = self._get_position(self.page[-1])
+        else:
+            position = self.cursor.position
+        return self.encode_cursor(Cursor(position=position, reverse=False))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if self.page:
+            position = self._get_position(self.page[0])
+        else:
+            position = self.cursor.position
+        return self.encode_cursor(Cursor(position=position, reverse=True))
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            tokens = json.loads(urlsafe_b64decode(encoded.encode('ascii')).decode('utf-8'))
+            position = tokens['p']
+            reverse = bool(tokens.get('r', 0))
+        except (TypeError, ValueError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(position, list) or len(position) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return Cursor(position=position, reverse=reverse)
+
+    def encode_cursor(self, cursor):
+        tokens = {'p': cursor.position}
+        if cursor.reverse:
+            tokens['r'] = 1
+        encoded = urlsafe_b64encode(json.dumps(tokens, separators=(',', ':')).encode('utf-8'))
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded.decode('ascii'))
+
+    def _get_position(self, instance):
+        position = []
+        for order in self.ordering:
+            name = order.lstrip('-')
+            # values() 查询出的是字典
+            attr = instance[name] if isinstance(instance, dict) else getattr(instance, name)
+            # 日期等类型转成字符串, 查询时由 Django 转换回来
+            position.append(attr if isinstance(attr, six.integer_types) else six.text_type(attr))
+        return position
+
+    def _keyset_filter(self, position, reverse):
+        """
+        (a, b, c) > (x, y, z) 展开为:
+        a > x OR (a = x AND b > y) OR (a = x AND b = y AND c > z)
+        """
+        condition = Q()
+        for index, order in enumerate(self.ordering):
+            descending = order.startswith('-')
+            if reverse:
+                descending = not descending
+            lookup = '__lt' if descending else '__gt'
+            equals = dict((prefix.lstrip('-'), position[i]) for i, prefix in enumerate(self.ordering[:index]))
+            equals[order.lstrip('-') + lookup] = position[index]
+            condition |= Q(**equals)
+        return condition
+
+    @staticmethod
+    def _reverse(ordering):
+        return tuple(order[1:] if order.startswith('-') else '-' + order for order in ordering)
+
+
+class DepartmentKeysetPagination(KeysetPagination):
+    ordering = ('create_date', 'id')
+
+
+class EmployeeKeysetPagination(KeysetPagination):
+    ordering = ('hire_date', 'id')
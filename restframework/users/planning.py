@@ -0,0 +1,262 @@
+"""
+根据序列化器的字段树自动优化查询集
+
+列表接口最常见的性能问题是 N+1 查询: 序列化器中的嵌套序列化器
+(例如 EmployeeSerializer2 的 depth = 1)或关联字段, 每序列化一行就要
+再查询一次关联对象.
+
+QueryPlanMixin 在 get_queryset() 中遍历序列化器的字段:
+    - 嵌套的单个对象(外键/一对一)    -> select_related
+    - 嵌套的多个对象 / many=True 关联 -> prefetch_related(Prefetch 内部递归优化),
+      嵌套的列表可以提供 get_prefetch_queryset() 调整 Prefetch 的查询集(如每个父对象的个数上限)
+    - 提供 get_annotation() 的字段(如关联对象的个数) -> annotate
+    - 只用到主键的 PrimaryKeyRelatedField -> 直接读外键列, 不需要关联查询
+    - 使用身份映射的关联字段(见 users/identity.py) -> 只读外键列, 关联对象整页一条 in_bulk 查询
+    - 只读请求时, 用 only() 只查询序列化器用到的列
+    - list 时, 如果开启了编译模式或请求中有 ?fields= / ?exclude=, 并且序列化器的字段都是普通的列
+      (包括外键 id), 用 values() 直接查询字典, 不创建模型对象(见 compiled.mapping_columns);
+      retrieve 等使用 get_object() 的请求仍然查询模型对象(对象权限, 重写的视图方法需要)
+配合 ?fields= / ?exclude=(见 users/sparse.py), 没有用到的列不会被查询.
+
+调试模式(settings.USERS_QUERY_PLAN_DEBUG, 默认跟随 DEBUG)下,
+会统计每个请求的 SQL 条数, 如果查询次数随返回的行数增长, 就记录警告日志.
+"""
+import logging
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+from django.db import connection
+from django.db.models import Prefetch
+from django.test.utils import CaptureQueriesContext
+from rest_framework import serializers
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.relations import ManyRelatedField, RelatedField
+
+from users.compiled import VALUES_CONTEXT_KEY, CompiledSerializerMixin, mapping_columns
+
+logger = logging.getLogger('users.planning')
+
+
+class QueryPlan(object):
+    """一个查询集需要的 select_related / prefetch_related / only 参数"""
+
+    def __init__(self):
+        self.select_related = []
+        self.prefetch_related = []
+        self.annotations = {}
+        # 使用身份映射的关联字段, 每个一条 in_bulk 查询
+        self.identity_mapped = []
+        # None 表示无法确定用到了哪些列(例如 source='*' 或方法属性), 不使用 only()
+        self.only = []
+
+    def defer_all(self):
+        self.only = None
+
+    def add_only(self, path):
+        if self.only is not None and path not in self.only:
+            self.only.append(path)
+
+    def apply(self, queryset, use_only=True):
+        if self.select_related:
+            queryset = queryset.select_related(*self.select_related)
+        if self.prefetch_related:
+            queryset = queryset.prefetch_related(*self.prefetch_related)
+        if self.annotations:
+            queryset = queryset.annotate(**self.annotations)
+        if use_only and self.only:
+            queryset = queryset.only(*self.only)
+        return queryset
+
+
+def _model_field(model, name):
+    try:
+        return model._meta.get_field(name)
+    except FieldDoesNotExist:
+        pass
+    # 反向关联使用访问器名称, 如 employee_set
+    for model_field in model._meta.get_fields():
+        if model_field.auto_created and not model_field.concrete and model_field.is_relation:
+            if model_field.get_accessor_name() == name:
+                return model_field
+    return None
+
+
+def _related_queryset(model_field):
+    """反向关联(如 employee_set)的 related_model 也是被关联的模型"""
+    return model_field.related_model._default_manager.all()
+
+
+def build_plan(serializer, model, plan=None, prefix=''):
+    """遍历序列化器的可读字段, 生成查询计划"""
+    if plan is None:
+        plan = QueryPlan()
+
+    for field in serializer.fields.values():
+        if field.write_only:
+            continue
+        if field.source == '*' or len(field.source_attrs) != 1:
+            # 使用整个对象或者跨对象的属性, 无法确定需要的列
+            plan.defer_all()
+            continue
+
+        name = field.source_attrs[0]
+        if hasattr(field, 'get_annotation') and not prefix:
+            # 注解的值由数据库计算(只能注解在最外层的查询上)
+            plan.annotations[name] = field.get_annotation(model)
+            continue
+        model_field = _model_field(model, name)
+        if model_field is None:
+            # 模型的属性/方法, 可能用到任意列
+            plan.defer_all()
+            continue
+
+        path = prefix + name
+        if not model_field.is_relation:
+            plan.add_only(path)
+            continue
+
+        single = model_field.many_to_one or model_field.one_to_one
+        if isinstance(field, serializers.ListSerializer) or isinstance(field, ManyRelatedField):
+            # 多个关联对象: 整页只执行一次 prefetch 查询
+            child = getattr(field, 'child', None)
+            queryset = _related_queryset(model_field)
+            if isinstance(child, serializers.BaseSerializer):
+                queryset = plan_queryset(queryset, child, use_only=False)
+            if hasattr(field, 'get_prefetch_queryset'):
+                queryset = field.get_prefetch_queryset(queryset, model_field)
+            plan.prefetch_related.append(Prefetch(path, queryset=queryset))
+        elif getattr(field, 'identity_mapped', False) and single and model_field.concrete:
+            # 关联对象从请求的身份映射中取, 整页一条 in_bulk 查询(见 users/identity.py), 只需要外键列
+            plan.add_only(path)
+            plan.identity_mapped.append(path)
+        elif isinstance(field, serializers.BaseSerializer) and single:
+            # 嵌套的单个对象: 用 JOIN 一起查询出来, 并递归处理嵌套序列化器
+            plan.select_related.append(path)
+            plan.add_only(path)
+            build_plan(field, model_field.related_model, plan, prefix=path + '__')
+        elif isinstance(field, RelatedField) and single:
+            if model_field.concrete:
+                plan.add_only(path)
+            if not field.use_pk_only_optimization():
+                # 需要整个关联对象(例如 StringRelatedField)
+                plan.select_related.append(path)
+                plan.defer_all()
+        else:
+            if model_field.concrete:
+                plan.add_only(path)
+            else:
+                plan.defer_all()
+    return plan
+
+
+def plan_queryset(queryset, serializer, use_only=True):
+    """根据序列化器优化查询集"""
+    plan = build_plan(serializer, queryset.model)
+    if use_only and plan.only is not None:
+        # 主键总是需要的
+        plan.add_only(queryset.model._meta.pk.name)
+    return plan.apply(queryset, use_only=use_only)
+
+
+class QueryPlanMixin(object):
+    """
+    视图集使用: 根据序列化器自动为 get_queryset() 添加
+    select_related / prefetch_related / only
+    """
+    # 是否自动优化查询集
+    auto_plan_queryset = True
+    # 调试模式, None 表示使用 settings.USERS_QUERY_PLAN_DEBUG, 默认跟随 DEBUG
+    query_plan_debug = None
+    # 这些 action 中, 序列化器的字段都是普通的列时用 values() 查询字典(只用于不调用 get_object() 的 action)
+    values_actions = ('list',)
+
+    def get_queryset(self):
+        queryset = super(QueryPlanMixin, self).get_queryset()
+        if not self.auto_plan_queryset:
+            return queryset
+        # 写操作可能会修改序列化器没有声明的列, 只对只读请求使用 only()
+        use_only = self.request is not None and self.request.method in SAFE_METHODS
+        serializer = self.get_serializer()
+        if use_only and getattr(self, 'action', None) in self.values_actions and self.use_values(serializer):
+            columns = self.get_values_columns(serializer, queryset.model)
+            if columns is not None:
+                # 之后创建的序列化器按字典处理(见 get_serializer_context)
+                self._values_rows = True
+                return queryset.values(*columns)
+        return plan_queryset(queryset, serializer, use_only=use_only)
+
+    def get_serializer_context(self):
+        context = super(QueryPlanMixin, self).get_serializer_context()
+        if getattr(self, '_values_rows', False):
+            context[VALUES_CONTEXT_KEY] = True
+        return context
+
+    def use_values(self, serializer):
+        """开启了编译模式, 或者请求了稀疏字段集时才用 values()"""
+        if not isinstance(serializer, CompiledSerializerMixin):
+            return False
+        if serializer.is_compiled():
+            return True
+        get_field_selection = getattr(serializer, 'get_field_selection', None)
+        return get_field_selection is not None and get_field_selection() != (None, None)
+
+    def get_values_columns(self, serializer, model):
+        """values() 要查询的列, 序列化器不能序列化字典时返回 None"""
+        if not isinstance(serializer, CompiledSerializerMixin):
+            return None
+        columns = mapping_columns(serializer, model)
+        if columns is None:
+            return None
+        # 主键(get_object 等使用)和分页的排序字段
+        extra = [model._meta.pk.attname]
+        extra.extend(order.lstrip('-') for order in getattr(self.paginator, 'ordering', None) or ())
+        for name in extra:
+            if name not in columns:
+                columns.append(name)
+        return columns
+
+    def is_query_plan_debug(self):
+        if self.query_plan_debug is not None:
+            return self.query_plan_debug
+        return getattr(settings, 'USERS_QUERY_PLAN_DEBUG', settings.DEBUG)
+
+    def dispatch(self, request, *args, **kwargs):
+        if not self.is_query_plan_debug():
+            return super(QueryPlanMixin, self).dispatch(request, *args, **kwargs)
+
+        with CaptureQueriesContext(connection) as queries:
+            self._captured_queries = queries
+            self._initial_query_count = 0
+            response = super(QueryPlanMixin, self).dispatch(request, *args, **kwargs)
+        # 认证, 权限检查等在 initial() 中执行的查询不计入
+        self.check_query_count(response, len(queries) - self._initial_query_count)
+        return response
+
+    def initial(self, request, *args, **kwargs):
+        super(QueryPlanMixin, self).initial(request, *args, **kwargs)
+        captured = getattr(self, '_captured_queries', None)
+        if captured is not None:
+            self._initial_query_count = len(captured)
+
+    def check_query_count(self, response, query_count):
+        """视图方法中的查询次数超过 "固定次数 + 行数" 时, 说明存在 N+1 查询"""
+        response['X-Query-Count'] = str(query_count)
+        data = getattr(response, 'data', None)
+        if isinstance(data, dict):
+            data = data.get('results')
+        if not isinstance(data, list) or len(data) < 2:
+            return
+
+        rows = len(data)
+        # 固定的查询: 主查询 1 条 + 每个 prefetch 1 条 + 每个身份映射的关联字段 1 条(没有优化查询集时只有主查询)
+        fixed = 1
+        if self.auto_plan_queryset:
+            plan = build_plan(self.get_serializer(), self.get_queryset().model)
+            fixed += len(plan.prefetch_related) + len(plan.identity_mapped)
+        if query_count - fixed >= rows:
+            response['X-Query-Count-Warning'] = 'n+1'
+            logger.warning(
+                '%s.%s: %d queries for %d rows, query count grows with the number of rows',
+                self.__class__.__name__, getattr(self, 'action', None) or self.request.method.lower(),
+                query_count, rows,
+            )
@@ -0,0 +1,187 @@
+"""
+读写分离: users 应用的读请求使用从库, 写入和事务使用主库(default)
+
+    - ReplicaRoutingMiddleware: GET / HEAD / OPTIONS 请求选择一个可用的从库, 其他请求只使用主库;
+      写请求成功后设置 Cookie, PIN_SECONDS 秒内该客户端的读请求也使用主库(读到自己刚写入的数据)
+    - ReplicaRouter(DATABASE_ROUTERS): 只路由 users 应用的模型, 读取使用本次请求选择的从库;
+      主库上有事务(transaction.atomic)时读取也使用主库, 写入始终使用主库
+    - 响应缓存未命中时改用主库(见 users/cache.py), 缓存中不会存入从库的旧数据
+    - 请求之外(管理命令等)以及 POST /batch 的子请求都使用主库
+    - 流式响应(?stream=, 导出)在输出内容时才查询, 每次生成内容时重新使用本次请求选择的从库
+
+连接: DATABASES 中设置 CONN_MAX_AGE 后, 每个线程的连接在请求之间复用, 不再每个请求重新连接.
+复用的连接可能已经被数据库关闭(如 MySQL 的 wait_timeout), 请求开始时对空闲超过
+HEALTH_CHECK_INTERVAL 秒的连接检查一次(is_usable, MySQL 为 ping), 不可用时关闭, 下次查询重新连接.
+从库连接失败时 RETRY_SECONDS 秒内不再选择它; 没有可用的从库时使用主库.
+
+本地用两个 SQLite 文件代替主库和从库(从库不会自动同步, 复制 primary.sqlite3 模拟复制):
+    python manage.py migrate --settings=restframework.settings_replica
+    python manage.py migrate --database=replica --settings=restframework.settings_replica
+    python manage.py runserver --settings=restframework.settings_replica
+
+配置(settings.USERS_DATABASE_ROUTING):
+    {
+        'REPLICAS': ['replica'],        # 从库的别名, 为空时不做读写分离
+        'PIN_SECONDS': 5,               # 应大于从库的复制延迟
+        'HEALTH_CHECK_INTERVAL': 30,
+        'RETRY_SECONDS': 30,
+        'COOKIE_NAME': 'users_pin',
+    }
+"""
+import itertools
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import request_finished, request_started
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from django.dispatch import receiver
+from django.utils.deprecation import MiddlewareMixin
+
+APP_LABEL = 'users'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+DEFAULTS = {
+    'REPLICAS': [],
+    'PIN_SECONDS': 5,
+    'HEALTH_CHECK_INTERVAL': 30,
+    'RETRY_SECONDS': 30,
+    'COOKIE_NAME': 'users_pin',
+}
+
+_local = threading.local()
+# 从库别名 -> 连接失败后恢复选择的时间
+_down_until = {}
+_counter = itertools.count()
+
+
+def get_options():
+    options = dict(DEFAULTS)
+    options.update(getattr(settings, 'USERS_DATABASE_ROUTING', {}))
+    return options
+
+
+def current_replica():
+    """本次请求读取使用的从库, None 表示主库"""
+    return getattr(_local, 'replica', None)
+
+
+def use_primary():
+    """本次请求剩下的读取都使用主库"""
+    _local.replica = None
+
+
+def close_if_unusable(alias, interval):
+    """空闲超过 interval 秒的持久连接检查是否可用, 不可用时关闭(下次查询时重新连接)"""
+    connection = connections[alias]
+    last_used = getattr(connection, 'users_last_used', None)
+    if connection.connection is not None and last_used is not None \
+            and time.monotonic() - last_used > interval and not connection.is_usable():
+        connection.close()
+
+
+def check_connection(alias, interval):
+    """检查持久连接, 没有连接时建立连接, 连接失败时抛出 DatabaseError"""
+    close_if_unusable(alias, interval)
+    connections[alias].ensure_connection()
+
+
+def choose_replica():
+    """轮流选择一个可用的从库, 都不可用时返回 None"""
+    options = get_options()
+    replicas = list(options['REPLICAS'])
+    if not replicas:
+        return None
+    start = next(_counter)
+    now = time.monotonic()
+    for offset in range(len(replicas)):
+        alias = replicas[(start + offset) % len(replicas)]
+        if _down_until.get(alias, 0) > now:
+            continue
+        try:
+            check_connection(alias, options['HEALTH_CHECK_INTERVAL'])
+        except DatabaseError:
+            _down_until[alias] = now + options['RETRY_SECONDS']
+            continue
+        return alias
+    return None
+
+
+def is_pinned(request):
+    try:
+        return float(request.COOKIES.get(get_options()['COOKIE_NAME'], 0)) > time.time()
+    except ValueError:
+        return False
+
+
+@receiver(request_started)
+def check_primary_connection(sender, **kwargs):
+    """请求开始时检查主库的持久连接(从库在选择时检查)"""
+    close_if_unusable(DEFAULT_DB_ALIAS, get_options()['HEALTH_CHECK_INTERVAL'])
+
+
+@receiver(request_finished)
+def record_last_used(sender, **kwargs):
+    now = time.monotonic()
+    for connection in connections.all():
+        if connection.connection is not None:
+            connection.users_last_used = now
+
+
+def _read_from(replica, chunks):
+    """流式响应的内容: 生成每一块时(查询在这时执行)使用请求选择的从库, 之后恢复"""
+    iterator = iter(chunks)
+    while True:
+        _local.replica = replica
+        try:
+            chunk = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            _local.replica = None
+        yield chunk
+
+
+class ReplicaRoutingMiddleware(MiddlewareMixin):
+    """按请求方法和 Cookie 选择本次请求读取使用的数据库"""
+
+    def process_request(self, request):
+        if request.method in SAFE_METHODS and not is_pinned(request):
+            _local.replica = choose_replica()
+        else:
+            _local.replica = None
+
+    def process_response(self, request, response):
+        replica = current_replica()
+        _local.replica = None
+        if replica is not None and response.streaming:
+            response.streaming_content = _read_from(replica, response.streaming_content)
+        options = get_options()
+        if options['REPLICAS'] and request.method not in SAFE_METHODS and response.status_code < 400:
+            response.set_cookie(options['COOKIE_NAME'], '%.3f' % (time.time() + options['PIN_SECONDS']),
+                                max_age=options['PIN_SECONDS'], httponly=True)
+        return response
+
+
+class ReplicaRouter(object):
+    """只路由 users 应用的模型, 其他应用(auth, sessions 等)使用默认数据库"""
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label != APP_LABEL:
+            return None
+        replica = current_replica()
+        if replica is None or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return replica
+
+    def db_for_write(self, model, **hints):
+        # 从库读出的对象保存时也写入主库
+        if model._meta.app_label == APP_LABEL:
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # 主库和从库的数据相同
+        aliases = set(get_options()['REPLICAS']) | {DEFAULT_DB_ALIAS}
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
@@ -0,0 +1,189 @@
+"""
+员工/部门的搜索索引: ?search=
+
+    GET /employee5/?search=张三        姓名或备注中包含 "张三" 的员工
+    GET /departments5/?search=研发     名称中包含 "研发" 的部门
+
+icontains 生成的 LIKE '%...%' 不能使用索引, 每次都要扫描整张表.
+SearchToken 为每个对象的文本字段(SEARCH_FIELDS)保存 n-gram: 文本转成小写, 按非文字字符分词,
+每个词的单个字符和相邻两个字符各一行. 中文没有空格, 按字切分正好适合; 英文和数字也按同样的方式切分.
+    "研发部" -> 研, 发, 部, 研发, 发部
+
+搜索时查询词也切成 n-gram(只有一个字符时用单字, 否则用相邻两个字符),
+在 (model, token, object_id) 索引上查出包含全部 n-gram 的对象(每个 n-gram 一个 IN 子查询),
+再对这些候选对象用 icontains 确认(n-gram 都出现不代表它们连在一起).
+查询时间取决于包含这些 n-gram 的对象数, 与表的大小无关. (SQLite 没有统计信息(ANALYZE)时,
+部门的查询可能仍按 is_delete 索引读取所有未删除的部门, 员工的查询不受影响.)
+多个词用空格分开时, 每个词都要匹配(可以在不同的字段中).
+
+索引通过信号与数据同步: post_save / post_delete, 批量接口的 bulk_changed.
+批量接口和导入总是带主键发送 bulk_changed; 不知道主键时(pks 为 None), 索引还没有任何 n-gram 的对象.
+重建索引:
+    python manage.py rebuild_search_index
+"""
+import re
+from collections import OrderedDict
+
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.filters import BaseFilterBackend
+
+from users.models import Department, Employee, SearchToken
+from users.signals import bulk_changed
+
+# 建立索引的模型和字段
+SEARCH_FIELDS = OrderedDict([
+    (Department, ('name',)),
+    (Employee, ('name', 'comment')),
+])
+# Python 3 的 \w 包括中文
+WORD = re.compile(r'\w+')
+# 每次处理的对象数(SQLite 一条语句最多 999 个参数)
+CHUNK_SIZE = 500
+
+
+def _chunks(values):
+    values = list(values)
+    for start in range(0, len(values), CHUNK_SIZE):
+        yield values[start:start + CHUNK_SIZE]
+
+
+def model_key(model):
+    return model._meta.model_name
+
+
+def text_tokens(text):
+    """文本 -> n-gram 集合(单个字符和相邻两个字符)"""
+    tokens = set()
+    for word in WORD.findall(text.lower()):
+        tokens.update(word)
+        tokens.update(word[index:index + 2] for index in range(len(word) - 1))
+    return tokens
+
+
+def term_tokens(term):
+    """查询词 -> 必须全部出现的 n-gram"""
+    if len(term) == 1:
+        return {term}
+    return set(term[index:index + 2] for index in range(len(term) - 1))
+
+
+def object_tokens(model, instance):
+    tokens = set()
+    for field in SEARCH_FIELDS[model]:
+        value = getattr(instance, field)
+        if value:
+            tokens |= text_tokens(str(value))
+    return tokens
+
+
+def sync(model, pks, instances):
+    """
+    同步这些主键的索引, instances 为其中仍然存在的对象(不存在的主键删除索引)
+    只写入有变化的 n-gram
+    读取现有的 n-gram 和写入在同一个事务中, 先锁定这些对象的行(select_for_update):
+    同一个对象同时保存两次时, 后一次等前一次提交后再读取, 不会重复写入相同的 n-gram(unique_together)
+    """
+    key = model_key(model)
+    wanted = set()
+    for instance in instances:
+        wanted.update((instance.pk, token) for token in object_tokens(model, instance))
+    with transaction.atomic():
+        existing = {}
+        for chunk in _chunks(pks):
+            list(model._base_manager.select_for_update().filter(pk__in=chunk).values_list('pk', flat=True))
+            # 加锁读取: 外层事务(如批量接口)中也读到已提交的最新数据
+            rows = SearchToken.objects.select_for_update().filter(model=key, object_id__in=chunk).values_list(
+                'id', 'object_id', 'token')
+            for token_id, object_id, token in rows:
+                existing[(object_id, token)] = token_id
+        stale = [token_id for pair, token_id in existing.items() if pair not in wanted]
+        for chunk in _chunks(stale):
+            SearchToken.objects.filter(id__in=chunk).delete()
+        SearchToken.objects.bulk_create([
+            SearchToken(model=key, object_id=object_id, token=token)
+            for object_id, token in wanted if (object_id, token) not in existing
+        ])
+
+
+def update_index(model, pks):
+    """从数据库读取这些对象, 同步索引"""
+    fields = SEARCH_FIELDS[model]
+    for chunk in _chunks(pks):
+        sync(model, chunk, model._base_manager.filter(pk__in=chunk).only(*fields))
+
+
+def index_new(model):
+    """
+    索引还没有任何 n-gram 的对象(不知道新增了哪些主键时)
+    不按 "主键大于已索引的最大主键" 判断: 其他写入先提交了更大的主键时, 中间的对象会被漏掉
+    """
+    indexed = SearchToken.objects.filter(model=model_key(model)).values('object_id')
+    update_index(model, model._base_manager.exclude(pk__in=indexed).order_by('pk').values_list('pk', flat=True))
+
+
+def rebuild(model):
+    """重建一个模型的索引"""
+    with transaction.atomic():
+        SearchToken.objects.filter(model=model_key(model)).delete()
+        index_new(model)
+
+
+def search(queryset, query):
+    """查询集中包含 query 的每个词的对象"""
+    model = queryset.model
+    key = model_key(model)
+    for term in sorted(set(WORD.findall(query.lower()))):
+        # 每个 n-gram 一个 IN 子查询, 都只读 (model, token) 索引;
+        # 不用 GROUP BY ... HAVING COUNT(*) = n, 没有统计信息时 SQLite 会改为按 object_id 扫描整个模型的索引
+        for token in sorted(term_tokens(term)):
+            queryset = queryset.filter(pk__in=SearchToken.objects.filter(model=key, token=token).values('object_id'))
+        contains = Q()
+        for field in SEARCH_FIELDS[model]:
+            contains |= Q(**{field + '__icontains': term})
+        queryset = queryset.filter(contains)
+    return queryset
+
+
+class IndexedSearchFilter(BaseFilterBackend):
+    """视图的 filter_backends 使用: ?search= 按 SEARCH_FIELDS 中的字段搜索"""
+    search_param = 'search'
+
+    def filter_queryset(self, request, queryset, view):
+        query = request.query_params.get(self.search_param, '')
+        if queryset.model not in SEARCH_FIELDS or not WORD.search(query):
+            return queryset
+        return search(queryset, query)
+
+
+@receiver(post_save, sender=Department)
+@receiver(post_save, sender=Employee)
+def index_on_save(sender, instance, raw=False, **kwargs):
+    if not raw:
+        sync(sender, [instance.pk], [instance])
+
+
+@receiver(post_delete, sender=Department)
+@receiver(post_delete, sender=Employee)
+def unindex_on_delete(sender, instance, **kwargs):
+    sync(sender, [instance.pk], [])
+
+
+@receiver(bulk_changed, sender=Department)
+@receiver(bulk_changed, sender=Employee)
+def index_on_bulk_change(sender, pks=None, objs=None, deleted=False, **kwargs):
+    if deleted:
+        # 批量删除: 每批一条 DELETE
+        for chunk in _chunks(pks):
+            SearchToken.objects.filter(model=model_key(sender), object_id__in=chunk).delete()
+    elif objs is not None and pks is not None:
+        # 新增的对象就是数据库中的值, 不用重新查询
+        for chunk in _chunks(range(len(objs))):
+            instances = [objs[index] for index in chunk]
+            sync(sender, [instance.pk for instance in instances], instances)
+    elif pks is not None:
+        update_index(sender, pks)
+    else:
+        index_new(sender)
@@ -7,10 +7,21 @@ from rest_framework.pagination import PageNumberPagination
 from rest_framework.relations import PrimaryKeyRelatedField
 from rest_framework.validators import UniqueValidator
 
+from users.bulk import BulkListSerializer, BulkPrimaryKeyRelatedField, UniqueFieldsMixin
+from users.compiled import CompiledSerializerMixin
+from users.identity import IdentityMapListSerializer, IdentityMapModelSerializerMixin, MemoizedChoiceField
+from users.metrics import InstrumentedListSerializer, InstrumentedSerializerMixin
+from users.nested import NestedRelationSerializerMixin
+from users.sparse import SparseFieldsSerializerMixin
 from users.models import Department, Employee
 
+# 部门名称只能是字母, 数字或中文; 只编译一次, 批量校验时每行直接使用
+DEPARTMENT_NAME_PATTERN = re.compile('^[a-zA-Z0-9\u4e00-\u9fa5]+$')
 
-class EmployeeSerializer(serializers.Serializer):
+
+class EmployeeSerializer(InstrumentedSerializerMixin, SparseFieldsSerializerMixin, CompiledSerializerMixin,
+                         serializers.Serializer):
+    # ?fields= / ?exclude= 只返回需要的字段, 见 users/sparse.py
     choices_gender = (
         (0, '男'),
         (1, '女'),
@@ -19,17 +30,24 @@ class EmployeeSerializer(serializers.Serializer):
     id = serializers.IntegerField(read_only=True)
     name = serializers.CharField(label='姓名', max_length=20)
     age = serializers.IntegerField(label='年龄')
-    gender = serializers.ChoiceField(label='性别', default=0, choices=choices_gender)
+    # 输出按原始值缓存, 每行不再 str() 后查找(见 users/identity.py)
+    gender = MemoizedChoiceField(label='性别', default=0, choices=choices_gender)
     salary = serializers.DecimalField(label='工资', max_digits=8, decimal_places=2)
     comment = serializers.CharField(label='备注', max_length=300, allow_null=True, allow_blank=True)
     hire_date = serializers.DateField(label='入职时间')
 
     # 关联属性
     # 方式一：　序列化为主键ｉｄ返回回去
-    department = serializers.PrimaryKeyRelatedField(label='所属部门', read_only=True)
+    # 新增时需要传部门id, 批量新增时所有部门id只查询一次
+    department = BulkPrimaryKeyRelatedField(label='所属部门', queryset=Department.objects.all())
     # 方式二：　序列化部门对象所有字段
     # department = DepartmentSerializer()
 
+    class Meta:
+        model = Employee
+        # many=True 时批量校验, 批量新增
+        list_serializer_class = BulkListSerializer
+
     def create(self, validated_data):
         """新增一个员工"""
         # OrderedDict类型
@@ -53,7 +71,8 @@ class EmployeeSerializer(serializers.Serializer):
     #     return instance
 
 
-class DepartmentSerializer(serializers.Serializer):
+class DepartmentSerializer(InstrumentedSerializerMixin, SparseFieldsSerializerMixin, NestedRelationSerializerMixin,
+                           CompiledSerializerMixin, UniqueFieldsMixin, serializers.Serializer):
     """
     序列化器:
     1. 转成字典的属性
@@ -67,6 +86,8 @@ class DepartmentSerializer(serializers.Serializer):
     # name = serializers.RegexField('^[a-zA-Z0-9\u4e00-\u9fa5]$',
     #                               max_length=10, label='部门名称',
     #                               validators=[UniqueValidator(queryset=Department.objects.all())])
+    # UniqueValidator 每一行都要查询一次, 改为 Meta.unique_fields:
+    # 单个部门一条查询, 批量时整批一条 name__in 查询(UniqueFieldsMixin / BulkListSerializer)
     create_date = serializers.DateField(label='成立时间')
     is_delete = serializers.BooleanField(default=False, label='是否删除', required=False)
 
@@ -76,6 +97,24 @@ class DepartmentSerializer(serializers.Serializer):
     #     label='部门员工', read_only=True, many=True)
     # 方式一:
     # employee_set = EmployeeSerializer(many=True, read_only=True)
+    # 每个部门查询一次员工, 改为 ?employees=N / all 时才嵌套输出, 整页一个 Prefetch 查询(见 users/nested.py):
+    # employee_set: 最近入职的 N 个员工, employee_count: 员工总数
+    nested_relation = 'employee_set'
+    nested_count_name = 'employee_count'
+    nested_query_param = 'employees'
+    nested_ordering = ('-hire_date', '-id')
+
+    def get_nested_child(self):
+        return EmployeeSerializer()
+
+    class Meta:
+        model = Department
+        # many=True 时批量校验, 批量新增
+        list_serializer_class = BulkListSerializer
+        # 未删除的部门中名称唯一
+        unique_fields = ('name',)
+        # 恢复已删除的部门(is_delete 改为 False)时, 原来的名称也要检查
+        soft_delete_field = 'is_delete'
 
     # 参数校验方式2:
     def validate_name(self, value):
@@ -84,7 +123,7 @@ class DepartmentSerializer(serializers.Serializer):
         :param value: 用户请求传递的要校验的参数值
         :return:
         """
-        if not re.match('^[a-zA-Z0-9\u4e00-\u9fa5]+$', value):
+        if not DEPARTMENT_NAME_PATTERN.match(value):
             # 校验不通过 则抛异常
             raise ValidationError('部门名称必须为字母数字或中文')
         return value
@@ -128,20 +167,40 @@ class UserSerializer(serializers.Serializer):
         return attrs
 
 
-class EmployeeSerializer2(serializers.ModelSerializer):
+class EmployeeSerializer2(InstrumentedSerializerMixin, SparseFieldsSerializerMixin, IdentityMapModelSerializerMixin,
+                          serializers.ModelSerializer):
+    # 嵌套的部门从请求的身份映射中取: 整页一条 in_bulk 查询, 每个部门只序列化一次(见 users/identity.py)
+    serializer_choice_field = MemoizedChoiceField
 
     class Meta:
         model = Employee  # 关联的模型类对象
         fields = '__all__'  # 表示包含模型类中所有字段
         depth = 1               # 关联对象序列化
+        list_serializer_class = IdentityMapListSerializer
 
 
 
 
 
-class DepartmentNameSerializer(serializers.Serializer):
+class DepartmentNameSerializer(InstrumentedSerializerMixin, serializers.Serializer):
     name = serializers.CharField(label='部门名称', max_length=20)
 
+    class Meta:
+        list_serializer_class = InstrumentedListSerializer
+
+
+class DepartmentStatsSerializer(InstrumentedSerializerMixin, serializers.Serializer):
+    """部门统计(见 users/summary.py 的 department_stats), 只用于输出"""
+    id = serializers.IntegerField(label='ID', read_only=True)
+    name = serializers.CharField(label='部门名称', read_only=True)
+    headcount = serializers.IntegerField(label='人数', read_only=True)
+    avg_age = serializers.FloatField(label='平均年龄', read_only=True)
+    salary_total = serializers.DecimalField(label='工资总额', max_digits=14, decimal_places=2, read_only=True)
+    avg_salary = serializers.DecimalField(label='平均工资', max_digits=14, decimal_places=2, read_only=True)
+
+    class Meta:
+        list_serializer_class = InstrumentedListSerializer
+
 
 
 """
@@ -0,0 +1,21 @@
+"""
+users 应用的自定义信号
+
+bulk_create() 和 QuerySet.update() 不会发送 post_save 信号,
+批量接口写入数据后发送 bulk_changed, 依赖数据变化的模块(如响应缓存)
+同时监听 post_save / post_delete 和 bulk_changed.
+
+bulk_changing: 批量修改之前(在同一个事务中)发送, 需要修改前的值的模块(如部门汇总)监听
+    sender: 模型类
+    pks:    将要修改的主键列表
+
+bulk_changed: 批量写入之后(在同一个事务中)发送, 监听者需要在提交后执行的操作用 transaction.on_commit
+    sender: 模型类
+    pks:    受影响的主键列表, 无法确定时(例如 bulk_create 没有返回主键)为 None
+    objs:   批量新增时为新增的对象列表, 否则为 None
+    deleted: 批量删除(没有发送 post_delete)时为 True, 这些主键的行已经不存在
+"""
+from django.dispatch import Signal
+
+bulk_changing = Signal(providing_args=['pks'])
+bulk_changed = Signal(providing_args=['pks', 'objs', 'deleted'])
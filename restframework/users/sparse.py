@@ -0,0 +1,57 @@
+"""
+稀疏字段集: 客户端只取需要的字段
+
+    GET /employee5/?fields=id,name,department    只返回这几个字段
+    GET /employee5/?exclude=comment,salary       去掉这几个字段
+
+字段在序列化器的 get_fields() 中去掉, 不会被序列化. 视图集的 QueryPlanMixin
+根据剩下的字段生成查询(见 users/planning.py), 没用到的列也不会从数据库读取:
+    - 列表接口所有字段都是普通的列时, 用 values() 直接查询字典, 不创建模型对象
+    - 否则用 only() 只查询用到的列
+只对 GET / HEAD / OPTIONS 请求生效, 写操作需要完整的字段做校验.
+"""
+from rest_framework.exceptions import ValidationError
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.serializers import ListSerializer
+
+
+class SparseFieldsSerializerMixin(object):
+    """根据请求参数 ?fields= / ?exclude= 去掉序列化器的字段, 只作用于最外层的序列化器"""
+    fields_query_param = 'fields'
+    exclude_query_param = 'exclude'
+
+    def _split(self, value):
+        if not value:
+            return None
+        return [name.strip() for name in value.split(',') if name.strip()]
+
+    def get_field_selection(self):
+        """返回 (要保留的字段, 要去掉的字段), 没有指定时为 None"""
+        parent = self.parent
+        if parent is not None and not (isinstance(parent, ListSerializer) and parent.parent is None):
+            # 嵌套的序列化器
+            return None, None
+        request = self.context.get('request')
+        if request is None or request.method not in SAFE_METHODS:
+            return None, None
+        params = getattr(request, 'query_params', request.GET)
+        return self._split(params.get(self.fields_query_param)), self._split(params.get(self.exclude_query_param))
+
+    def get_fields(self):
+        fields = super(SparseFieldsSerializerMixin, self).get_fields()
+        include, exclude = self.get_field_selection()
+        if include is None and exclude is None:
+            return fields
+
+        errors = {}
+        for param, names in ((self.fields_query_param, include), (self.exclude_query_param, exclude)):
+            unknown = [name for name in names or () if name not in fields]
+            if unknown:
+                errors[param] = ['未知字段: %s' % ', '.join(unknown)]
+        if errors:
+            raise ValidationError(errors)
+
+        for name in list(fields):
+            if (include is not None and name not in include) or (exclude is not None and name in exclude):
+                del fields[name]
+        return fields
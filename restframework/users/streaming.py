@@ -0,0 +1,82 @@
+"""
+列表接口的流式输出
+
+普通的列表视图会先把整个查询集和 serializer.data 都放到内存里再渲染,
+导出整张表时内存占用很大, 首字节也要等全部序列化完成才能返回.
+
+流式模式用 QuerySet.iterator() 分块读取数据, 每块单独序列化,
+再通过 StreamingHttpResponse 边生成边输出, 内存占用与表的大小无关.
+iterator() 不执行 prefetch_related, 查询集中的 prefetch 对每一块执行一次(每块每个 prefetch 一条查询).
+
+请求方式:
+    GET /department?stream=json      JSON 数组
+    GET /employee5/?stream=ndjson    每行一个 JSON 对象(NDJSON)
+"""
+from itertools import islice
+
+from django.db.models import prefetch_related_objects
+from django.http import StreamingHttpResponse
+from rest_framework.renderers import JSONRenderer
+
+
+class StreamingListMixin(object):
+    """为列表视图增加流式输出"""
+    # 查询参数名
+    stream_query_param = 'stream'
+    # 每次序列化的行数
+    stream_chunk_size = 1000
+    # 每一块数据的编码与普通响应(JSONRenderer)保持一致
+    stream_renderer_class = JSONRenderer
+
+    stream_content_types = {
+        'json': 'application/json',
+        'ndjson': 'application/x-ndjson',
+    }
+
+    def get_stream_format(self, request):
+        """返回请求的流式格式, 不是流式请求时返回 None"""
+        stream_format = request.query_params.get(self.stream_query_param)
+        if stream_format in self.stream_content_types:
+            return stream_format
+        return None
+
+    def iter_chunks(self, queryset):
+        """用 iterator() 分块读取, 不缓存整个查询集; prefetch_related 按块执行"""
+        lookups = queryset._prefetch_related_lookups
+        iterator = queryset.iterator()
+        while True:
+            chunk = list(islice(iterator, self.stream_chunk_size))
+            if not chunk:
+                return
+            if lookups:
+                prefetch_related_objects(chunk, *lookups)
+            yield chunk
+
+    def iter_stream(self, queryset, serializer_class, stream_format):
+        if hasattr(self, 'get_serializer_context'):
+            # 视图集的 context(包括 values() 查询的标记, 见 users/planning.py)
+            context = self.get_serializer_context()
+        else:
+            context = {'request': self.request, 'view': self}
+        renderer = self.stream_renderer_class()
+        first = True
+        if stream_format == 'json':
+            yield b'['
+        for chunk in self.iter_chunks(queryset):
+            data = serializer_class(chunk, many=True, context=context).data
+            if stream_format == 'ndjson':
+                yield b''.join(renderer.render(item) + b'\n' for item in data)
+            else:
+                # 去掉这一块的 '[' 和 ']', 拼接成一个完整的数组
+                body = renderer.render(data)[1:-1]
+                yield body if first else b',' + body
+            first = False
+        if stream_format == 'json':
+            yield b']'
+
+    def stream_response(self, queryset, serializer_class, stream_format):
+        """返回流式响应"""
+        return StreamingHttpResponse(
+            self.iter_stream(queryset, serializer_class, stream_format),
+            content_type=self.stream_content_types[stream_format],
+        )
@@ -0,0 +1,218 @@
+"""
+按部门汇总的员工人数, 年龄和工资(DepartmentSummary), 增量维护
+
+统计每个部门的人数, 平均年龄, 工资总额和平均工资原来要读取全部员工.
+DepartmentSummary 每个部门一行, 保存人数, 年龄之和, 工资之和, 员工变化时只更新受影响的部门:
+    - post_save / post_delete: 单个员工新增, 修改(包括调换部门), 删除;
+      修改前的值在 pre_save 中查询一次
+    - bulk_changing / bulk_changed: 批量修改前减去这些员工原来的值, 修改后加上新的值;
+      批量新增直接累加新增的对象, 不查询数据库
+    - 批量删除: 删除前(bulk_changing)减去这些员工的值, 删除后已经不存在的员工不再累加
+增量用 F() 表达式在数据库中累加, 并发修改不会互相覆盖; 多个部门的变化量用一条 CASE 语句更新.
+部门还没有汇总行时, 用数据库的聚合结果创建; 没有汇总行的部门没有员工.
+
+批量接口在写入数据的同一个事务中发送 bulk_changing / bulk_changed, 减去和累加一起提交.
+直接修改数据库等其他原因导致汇总不一致时, 用命令检查和重建:
+    python manage.py department_summary --check
+    python manage.py department_summary --rebuild
+
+    GET /departments5/stats/   各部门的人数, 平均年龄, 工资总额和平均工资
+"""
+from collections import OrderedDict
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Case, Count, F, Sum, Value, When
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from users.models import DepartmentSummary, Employee
+from users.signals import bulk_changed, bulk_changing
+
+# 汇总表中累加的列
+COLUMNS = ('headcount', 'age_total', 'salary_total')
+ZERO = Decimal('0.00')
+CENT = Decimal('0.01')
+# pk__in 查询每次的主键个数(SQLite 一条语句最多 999 个参数)
+CHUNK_SIZE = 500
+
+
+def _chunks(values):
+    values = list(values)
+    for start in range(0, len(values), CHUNK_SIZE):
+        yield values[start:start + CHUNK_SIZE]
+
+
+def _add(totals, department_id, headcount, age, salary):
+    old = totals.get(department_id, (0, 0, ZERO))
+    totals[department_id] = (old[0] + headcount, old[1] + age, old[2] + salary)
+
+
+def _negate(totals):
+    return dict(
+        (department_id, (-headcount, -age, -salary))
+        for department_id, (headcount, age, salary) in totals.items()
+    )
+
+
+def employee_totals(queryset):
+    """按部门聚合员工: {部门 id: (人数, 年龄之和, 工资之和)}"""
+    rows = queryset.order_by().values('department').annotate(
+        headcount=Count('id'), age_total=Sum('age'), salary_total=Sum('salary'))
+    return dict(
+        (row['department'], (row['headcount'], row['age_total'] or 0, Decimal(row['salary_total'] or ZERO)))
+        for row in rows
+    )
+
+
+def totals_of_pks(pks):
+    totals = {}
+    for chunk in _chunks(pks):
+        for department_id, values in employee_totals(Employee.objects.filter(pk__in=chunk)).items():
+            _add(totals, department_id, *values)
+    return totals
+
+
+def totals_of_objs(objs):
+    """新增的员工对象(还没有从数据库读取)的汇总"""
+    totals = {}
+    for obj in objs:
+        _add(totals, obj.department_id, 1, int(obj.age), Decimal(obj.salary))
+    return totals
+
+
+def _update(deltas):
+    """一条 UPDATE 累加多个部门的变化量(CASE department_id WHEN ... THEN ...), 返回更新的行数"""
+    values = {}
+    for index, name in enumerate(COLUMNS):
+        field = DepartmentSummary._meta.get_field(name)
+        change = Case(*[
+            When(department_id=department_id, then=Value(delta[index], output_field=field))
+            for department_id, delta in deltas.items()
+        ], output_field=field)
+        values[name] = F(name) + change
+    return DepartmentSummary.objects.filter(department_id__in=list(deltas)).update(**values)
+
+
+def apply_deltas(deltas, create=True):
+    """
+    deltas: {部门 id: (人数, 年龄之和, 工资之和)} 的变化量, 每 CHUNK_SIZE 个部门一条 UPDATE
+    create: 部门没有汇总行时用聚合结果创建(此时聚合结果已经包含这次的变化);
+            删除员工时为 False, 级联删除部门时不能再创建汇总行
+    """
+    deltas = dict((department_id, delta) for department_id, delta in deltas.items() if any(delta))
+    if not deltas:
+        return
+    missing = []
+    with transaction.atomic():
+        for chunk in _chunks(deltas):
+            if _update(dict((department_id, deltas[department_id]) for department_id in chunk)) < len(chunk):
+                existing = set(DepartmentSummary.objects.filter(department_id__in=chunk).values_list(
+                    'department_id', flat=True))
+                missing.extend(department_id for department_id in chunk if department_id not in existing)
+        if missing and create:
+            rebuild(missing)
+
+
+def rebuild(department_ids=None):
+    """用聚合结果重建汇总(删除后重新插入), department_ids 为 None 时重建所有部门"""
+    with transaction.atomic():
+        if department_ids is None:
+            DepartmentSummary.objects.all().delete()
+            _create(employee_totals(Employee.objects.all()))
+            return
+        for chunk in _chunks(department_ids):
+            totals = dict.fromkeys(chunk, (0, 0, ZERO))
+            totals.update(employee_totals(Employee.objects.filter(department__in=chunk)))
+            DepartmentSummary.objects.filter(department_id__in=chunk).delete()
+            _create(totals)
+
+
+def _create(totals):
+    DepartmentSummary.objects.bulk_create([
+        DepartmentSummary(department_id=department_id, headcount=headcount, age_total=age, salary_total=salary)
+        for department_id, (headcount, age, salary) in totals.items()
+    ])
+
+
+def check():
+    """
+    与数据库的聚合结果比较, 返回不一致的部门:
+    [(部门 id, 汇总表中的值, 聚合结果)], 值为 (人数, 年龄之和, 工资之和)
+    """
+    actual = employee_totals(Employee.objects.all())
+    stored = dict(
+        (department_id, (headcount, age, Decimal(salary)))
+        for department_id, headcount, age, salary in DepartmentSummary.objects.values_list(
+            'department_id', 'headcount', 'age_total', 'salary_total')
+    )
+    empty = (0, 0, ZERO)
+    mismatches = []
+    for department_id in sorted(set(actual) | set(stored)):
+        expected = actual.get(department_id, empty)
+        value = stored.get(department_id, empty)
+        if (value[0], value[1], value[2].quantize(CENT)) != (expected[0], expected[1], expected[2].quantize(CENT)):
+            mismatches.append((department_id, value, expected))
+    return mismatches
+
+
+def department_stats(queryset):
+    """部门查询集 -> 每个部门一行统计, 只读取部门和汇总表"""
+    rows = queryset.order_by('id').values(
+        'id', 'name', 'summary__headcount', 'summary__age_total', 'summary__salary_total')
+    stats = []
+    for row in rows:
+        headcount = row['summary__headcount'] or 0
+        salary_total = Decimal(row['summary__salary_total'] or ZERO).quantize(CENT)
+        stats.append(OrderedDict([
+            ('id', row['id']),
+            ('name', row['name']),
+            ('headcount', headcount),
+            ('avg_age', round(row['summary__age_total'] / headcount, 2) if headcount else None),
+            ('salary_total', salary_total),
+            ('avg_salary', (salary_total / headcount).quantize(CENT) if headcount else None),
+        ]))
+    return stats
+
+
+@receiver(pre_save, sender=Employee)
+def remember_old_totals(sender, instance, raw=False, **kwargs):
+    """修改员工之前记住原来的部门, 年龄和工资"""
+    if raw or instance.pk is None:
+        return
+    instance._summary_old = Employee.objects.filter(pk=instance.pk).values_list(
+        'department_id', 'age', 'salary').first()
+
+
+@receiver(post_save, sender=Employee)
+def update_on_save(sender, instance, created, raw=False, **kwargs):
+    old = instance.__dict__.pop('_summary_old', None)
+    if raw:
+        return
+    deltas = {}
+    if old is not None and not created:
+        _add(deltas, old[0], -1, -old[1], -Decimal(old[2]))
+    _add(deltas, instance.department_id, 1, int(instance.age), Decimal(instance.salary))
+    apply_deltas(deltas)
+
+
+@receiver(post_delete, sender=Employee)
+def update_on_delete(sender, instance, **kwargs):
+    apply_deltas({instance.department_id: (-1, -instance.age, -Decimal(instance.salary))}, create=False)
+
+
+@receiver(bulk_changing, sender=Employee)
+def subtract_before_bulk_change(sender, pks, **kwargs):
+    apply_deltas(_negate(totals_of_pks(pks)), create=False)
+
+
+@receiver(bulk_changed, sender=Employee)
+def add_after_bulk_change(sender, pks=None, objs=None, **kwargs):
+    if objs is not None:
+        apply_deltas(totals_of_objs(objs))
+    elif pks is not None:
+        # 已经删除的员工不在结果中
+        apply_deltas(totals_of_pks(pks))
+    else:
+        # 不知道哪些员工变化了
+        rebuild()
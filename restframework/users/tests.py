@@ -1,3 +1,1565 @@
-from django.test import TestCase
+import base64
+import csv
+import datetime
+import gzip
+import io
+import json
+import struct
+import threading
+import time
+import zlib
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, connection, connections, transaction
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework import serializers as rest_serializers
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+
+from users.compression import accepted_encoding
+from users.importer import EmployeeImporter, iter_records
+from users.metrics import COUNT_BOUNDS, Histogram, registry
+from users import admission, batch, bulk, cache, changes, identity, routers, search, summary, topn, warmup
+from users.compiled import VALUES_CONTEXT_KEY, _compiled_cache, get_compiled_row
+from users.models import Department, DepartmentSummary, Employee, ImportCheckpoint, SearchToken, Tombstone
+from users.signals import bulk_changed
+from users.streaming import StreamingListMixin
+from users.planning import build_plan
+from users.views import DepartmentViewSet, EmployeeViewSet
+from users.serializers import (DepartmentNameSerializer, DepartmentSerializer, DepartmentStatsSerializer,
+                               EmployeeSerializer, EmployeeSerializer2)
+
+
+class CompiledSerializerTest(TestCase):
+    """编译模式(模型对象和 values() 的字典)的输出与普通模式逐字节相同"""
+
+    def setUp(self):
+        department = Department.objects.create(name='研发部', create_date=datetime.date(2018, 1, 31))
+        Department.objects.create(name='测试部', create_date=datetime.date(2019, 12, 1), is_delete=True)
+        Employee.objects.create(name='张三', age=20, gender=1, salary='1000.5', comment=None,
+                                department=department)
+        Employee.objects.create(name='李四', age=30, gender=0, salary='12.34', comment='备注, "引号"',
+                                department=department)
+
+    def render(self, serializer_class, instances, compiled):
+        context = {VALUES_CONTEXT_KEY: True} if isinstance(instances[0], dict) else {}
+        serializer = serializer_class(instances, many=True, context=context)
+        serializer.child.compiled = compiled
+        content = JSONRenderer().render(serializer.data)
+        # 确认走的是编译后的函数
+        self.assertEqual(hasattr(serializer.child, '_compiled_row'), compiled or isinstance(instances[0], dict))
+        return content
+
+    def test_employee_parity(self):
+        employees = list(Employee.objects.order_by('id'))
+        # 外键为空(还没有保存的员工)
+        employees.append(Employee(name='王五', age=40, salary='0', hire_date=datetime.date(2020, 2, 29)))
+        plain = self.render(EmployeeSerializer, employees, False)
+        self.assertEqual(self.render(EmployeeSerializer, employees, True), plain)
+        self.assertIn(b'"department":null', plain)
+        self.assertIn(b'"gender":1', plain)
+        columns = ['id', 'name', 'age', 'gender', 'salary', 'comment', 'hire_date', 'department_id']
+        rows = list(Employee.objects.order_by('id').values(*columns))
+        self.assertEqual(self.render(EmployeeSerializer, rows, False),
+                         self.render(EmployeeSerializer, employees[:2], False))
+
+    def test_validated_data(self):
+        # validated_data 是没有 id 的字典, 不能按 values() 的列取值
+        for compiled in (False, True):
+            serializer = DepartmentSerializer(data={'name': '测试部', 'create_date': '2020-01-01'})
+            serializer.compiled = compiled
+            self.assertTrue(serializer.is_valid(), serializer.errors)
+            self.assertEqual(serializer.data['name'], '测试部')
+            self.assertNotIn('id', serializer.data)
+
+    def test_department_parity(self):
+        departments = list(Department.all_objects.order_by('id'))
+        plain = self.render(DepartmentSerializer, departments, False)
+        self.assertEqual(self.render(DepartmentSerializer, departments, True), plain)
+        self.assertIn(b'"create_date":"2018-01-31"', plain)
+        self.assertIn(b'"is_delete":true', plain)
+
+
+class ResponseCacheCommitTest(TransactionTestCase):
+    """事务中的修改: 提交后版本号再加一, 提交前存入的旧响应不会被读到"""
+
+    def setUp(self):
+        cache.get_backend().clear()
+        self.department = Department.objects.create(name='研发部', create_date=datetime.date(2018, 1, 1))
+
+    def versions(self):
+        return cache.get_backend().get_versions([cache.model_name(Department)])
+
+    def test_bumped_after_commit(self):
+        with transaction.atomic():
+            self.department.name = '测试部'
+            self.department.save()
+            # 提交前其他请求的缓存未命中(读到旧数据并存入缓存)
+            before_commit = self.versions()
+        self.assertNotEqual(self.versions(), before_commit)
+
+
+@mock.patch.object(StreamingListMixin, 'stream_chunk_size', 2)
+class StreamingTest(TestCase):
+    """?stream= 分块输出的内容与普通列表相同"""
+
+    def setUp(self):
+        for index in range(5):
+            department = Department.objects.create(name='部门%d' % index, create_date=datetime.date(2018, 1, index + 1))
+            Employee.objects.create(name='员工%d' % index, age=20, salary='1000', comment=None,
+                                    hire_date=datetime.date(2018, 2, index + 1), department=department)
+
+    def stream(self, path):
+        response = self.client.get(path)
+        self.assertTrue(response.streaming)
+        return response, b''.join(response.streaming_content).decode()
+
+    def test_json_array(self):
+        response, content = self.stream('/department?stream=json')
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(json.loads(content), json.loads(self.client.get('/department').content.decode()))
+        Department.all_objects.all().delete()
+        self.assertEqual(self.stream('/department?stream=json')[1], '[]')
+
+    def test_ndjson(self):
+        response, content = self.stream('/employee5/?stream=ndjson')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = content.splitlines()
+        self.assertEqual(len(lines), 5)
+        expected = json.loads(self.client.get('/employee5/?page_size=10').content.decode())['results']
+        self.assertEqual(sorted((json.loads(line) for line in lines), key=lambda item: item['id']),
+                         sorted(expected, key=lambda item: item['id']))
+
+    def test_prefetch_per_chunk(self):
+        class DepartmentEmployeesSerializer(rest_serializers.Serializer):
+            id = rest_serializers.IntegerField()
+            employee_set = rest_serializers.PrimaryKeyRelatedField(many=True, read_only=True)
+
+        view = StreamingListMixin()
+        view.request = None
+        queryset = Department.objects.order_by('id').prefetch_related('employee_set')
+        # 主查询 1 条 + 3 块各 1 条 prefetch, 不随行数增长
+        with self.assertNumQueries(4):
+            content = b''.join(view.iter_stream(queryset, DepartmentEmployeesSerializer, 'json'))
+        self.assertEqual([len(item['employee_set']) for item in json.loads(content.decode())], [1] * 5)
+
+
+class KeysetPaginationTest(TestCase):
+    """键集分页: 排序字段相同的行不重复, 不遗漏; 无效的游标返回 404"""
+
+    def setUp(self):
+        cache.get_backend().clear()
+        # 每两个部门同一天成立
+        self.departments = [
+            Department.objects.create(name='部门%d' % index, create_date=datetime.date(2018, 1, index // 2 + 1))
+            for index in range(7)
+        ]
+        # hire_date 为 auto_now_add, 所有员工的入职时间相同, 只靠 id 区分
+        department = self.departments[0]
+        self.employees = [Employee.objects.create(name='员工%d' % index, age=20, salary='1000', department=department)
+                          for index in range(5)]
+
+    def get(self, url):
+        # 部门列表的响应可能来自缓存(没有 data)
+        return json.loads(self.client.get(url).content.decode('utf-8'))
+
+    def walk(self, url, link):
+        ids = []
+        while url:
+            data = self.get(url)
+            ids.append([item['id'] for item in data['results']])
+            url = data[link]
+        return ids
+
+    def test_next_and_previous_with_ties(self):
+        expected = [department.pk for department in self.departments]
+        pages = self.walk('/departments5/?page_size=2', 'next')
+        self.assertEqual(sum(pages, []), expected)
+        self.assertEqual([len(page) for page in pages], [2, 2, 2, 1])
+        # 从最后一页往前翻, 每一页与向后翻时相同
+        last = self.get('/departments5/?page_size=2')
+        while last['next']:
+            last = self.get(last['next'])
+        self.assertEqual(self.walk(last['previous'], 'previous'), pages[-2::-1])
+
+        employee_pages = self.walk('/employee5/?page_size=2', 'next')
+        self.assertEqual(sum(employee_pages, []), [employee.pk for employee in self.employees])
+
+    def test_invalid_cursor(self):
+        def cursor(tokens):
+            return base64.urlsafe_b64encode(json.dumps(tokens).encode('utf-8')).decode('ascii')
+
+        for value in ('abc', cursor({'p': [1]}), cursor({'p': ['不是日期', 1]}), cursor({'x': 1}), cursor([1])):
+            response = self.client.get('/departments5/', {'cursor': value})
+            self.assertEqual(response.status_code, 404, value)
+
+    def test_page_size_cap(self):
+        Employee.objects.bulk_create([
+            Employee(name='员工', age=20, salary='1000', department=self.departments[0]) for _ in range(100)])
+        data = self.get('/employee5/?page_size=1000')
+        self.assertEqual(len(data['results']), 100)
+        self.assertIsNotNone(data['next'])
+        self.assertEqual(len(self.get('/employee5/')['results']), 2)
+
+
+class QueryPlanTest(TestCase):
+    """列表接口的 SQL 条数不随行数增长; 调试模式下返回 X-Query-Count"""
+
+    def setUp(self):
+        cache.get_backend().clear()
+        for index in range(3):
+            department = Department.objects.create(name='部门%d' % index, create_date=datetime.date(2018, 1, 1))
+            for number in range(3):
+                Employee.objects.create(name='员工%d' % number, age=20, salary='1000', department=department)
+
+    def test_build_plan(self):
+        class EmployeeDepartmentSerializer(rest_serializers.Serializer):
+            name = rest_serializers.CharField()
+            department = DepartmentNameSerializer()
+
+        plan = build_plan(EmployeeDepartmentSerializer(), Employee)
+        self.assertEqual(plan.select_related, ['department'])
+        self.assertEqual(plan.only, ['name', 'department', 'department__name'])
+        # 只用到外键列, 不需要关联查询
+        plan = build_plan(EmployeeSerializer(), Employee)
+        self.assertEqual((plan.select_related, plan.prefetch_related), ([], []))
+        self.assertIn('department', plan.only)
+
+    def test_list_query_counts(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(len(json.loads(self.client.get('/employee5/?page_size=100').content.decode())['results']), 9)
+        # 部门 + 嵌套员工的 Prefetch(员工总数是子查询注解)
+        with self.assertNumQueries(2):
+            data = json.loads(self.client.get('/departments5/?page_size=100&employees=2').content.decode())
+        self.assertEqual([len(item['employee_set']) for item in data['results']], [2, 2, 2])
+
+    @override_settings(USERS_QUERY_PLAN_DEBUG=True)
+    def test_debug_header(self):
+        response = self.client.get('/employee5/?page_size=100')
+        self.assertEqual(response['X-Query-Count'], '1')
+        self.assertFalse(response.has_header('X-Query-Count-Warning'))
+        self.assertEqual(self.client.get('/departments5/?page_size=100&employees=2')['X-Query-Count'], '2')
+
+        class DepartmentEmployeesSerializer(rest_serializers.Serializer):
+            id = rest_serializers.IntegerField()
+            employee_set = rest_serializers.PrimaryKeyRelatedField(many=True, read_only=True)
+
+        # 不优化查询集时, 每个部门查询一次员工
+        with mock.patch.object(DepartmentViewSet, 'auto_plan_queryset', False), \
+                mock.patch.object(DepartmentViewSet, 'get_serializer_class', return_value=DepartmentEmployeesSerializer), \
+                self.assertLogs('users.planning', 'WARNING'):
+            response = self.client.get('/departments5/?page_size=100')
+        self.assertEqual(response['X-Query-Count'], '4')
+        self.assertEqual(response['X-Query-Count-Warning'], 'n+1')
+
+
+class BulkCreateTest(TestCase):
+    """列表请求体批量新增: 错误按位置返回, 关联 id 整批一条查询"""
+
+    def setUp(self):
+        self.departments = [Department.objects.create(name='部门%d' % index, create_date=datetime.date(2018, 1, 1))
+                            for index in range(2)]
+
+    def employees(self, count):
+        return [{'name': '员工%d' % index, 'age': 20 + index, 'salary': '1000', 'comment': None,
+                 'hire_date': '2018-01-02', 'department': self.departments[index % 2].pk} for index in range(count)]
+
+    def test_related_ids_in_one_query(self):
+        serializer = EmployeeSerializer(data=self.employees(50), many=True)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(serializer.is_valid(), serializer.errors)
+        self.assertEqual(len(queries), 1)
+        self.assertIn(' IN (', queries[0]['sql'])
+        self.assertEqual(set(item['department'] for item in serializer.validated_data), set(self.departments))
+
+    def test_created_ids(self):
+        # 其他员工已经存在, 新行的主键从它之后开始
+        Employee.objects.create(name='员工0', age=20, salary='1000', department=self.departments[0])
+        received = []
+
+        def receiver(sender, pks=None, **kwargs):
+            received.append(pks)
+        bulk_changed.connect(receiver, sender=Employee)
+        try:
+            response = self.client.post('/employee5/', json.dumps(self.employees(5)), content_type='application/json')
+        finally:
+            bulk_changed.disconnect(receiver, sender=Employee)
+        self.assertEqual(response.status_code, 201)
+        ids = [item['id'] for item in response.data]
+        self.assertNotIn(None, ids)
+        self.assertEqual(received, [ids])
+        self.assertEqual([Employee.objects.get(pk=pk).age for pk in ids], [20, 21, 22, 23, 24])
+
+    def test_identical_rows_get_their_own_ids(self):
+        # 已有相同的行, 本批中也有相同的行: 主键由 INSERT 得到, 不按列值对应
+        existing = Employee.objects.create(name='员工', age=20, salary='1000', department=self.departments[0])
+        instances = [Employee(name='员工', age=20, salary='1000', department=self.departments[0])
+                     for _ in range(3)]
+        bulk.bulk_create_with_pks(Employee, instances)
+        pks = [instance.pk for instance in instances]
+        self.assertEqual(len(set(pks)), 3)
+        self.assertNotIn(existing.pk, pks)
+        self.assertEqual(Employee.objects.filter(pk__in=pks).count(), 3)
+
+    def test_error_positions(self):
+        data = self.employees(6)
+        data[1]['age'] = '不是数字'
+        data[4]['department'] = 999
+        response = self.client.post('/employee5/', json.dumps(data), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([sorted(error) for error in response.data], [[], ['age'], [], [], ['department'], []])
+        self.assertFalse(Employee.objects.exists())
+
+    def test_create_and_duplicates(self):
+        data = [{'name': '测试部', 'create_date': '2018-01-02'}, {'name': '财务部', 'create_date': '2018-01-02'}]
+        response = self.client.post('/departments5/', json.dumps(data), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual([item['name'] for item in response.data], ['测试部', '财务部'])
+        # 批次内部重复, 以及与已有的部门重复
+        data = [{'name': '人事部', 'create_date': '2018-01-02'}, {'name': '行政部', 'create_date': '2018-01-02'},
+                {'name': '人事部', 'create_date': '2018-01-02'}, {'name': '部门0', 'create_date': '2018-01-02'}]
+        response = self.client.post('/departments5/', json.dumps(data), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([bool(error) for error in response.data], [True, False, True, True])
+        self.assertIn('重复', response.data[0]['name'][0])
+        self.assertIn('已存在', response.data[3]['name'][0])
+        self.assertFalse(Department.objects.filter(name='行政部').exists())
+
+
+class ResponseCacheTest(TestCase):
+    """部门接口的响应缓存: ETag / 304, 修改后失效, 按查询参数分别缓存"""
+
+    def setUp(self):
+        cache.get_backend().clear()
+        self.department = Department.objects.create(name='研发部', create_date=datetime.date(2018, 1, 1))
+        Department.objects.create(name='销售部', create_date=datetime.date(2018, 1, 2))
+        self.url = '/departments5/%d/' % self.department.pk
+
+    def test_if_none_match(self):
+        response = self.client.get(self.url)
+        etag = response['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH='"other"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_invalidated_on_change(self):
+        etag = self.client.get(self.url)['ETag']
+        self.department.name = '测试部'
+        self.department.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode('utf-8'))['name'], '测试部')
+
+        # 批量修改(bulk_changed)
+        etag = response['ETag']
+        Department.all_objects.filter(pk=self.department.pk).update(name='财务部')
+        bulk_changed.send(sender=Department, pks=[self.department.pk])
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(json.loads(response.content.decode('utf-8'))['name'], '财务部')
+
+        # 删除; 员工的修改也让部门的缓存失效
+        self.client.get('/departments5/')
+        Employee.objects.create(name='张三', age=20, salary='1000', department=self.department)
+        with self.assertNumQueries(1):
+            self.client.get('/departments5/')
+        self.department.delete()
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    def test_keyed_by_query_string(self):
+        first = self.client.get('/departments5/?page_size=1&include_deleted=1')
+        with self.assertNumQueries(0):
+            # 参数的顺序不影响
+            second = self.client.get('/departments5/?include_deleted=1&page_size=1')
+        self.assertEqual(second.content, first.content)
+        response = self.client.get('/departments5/?page_size=2')
+        self.assertNotEqual(response['ETag'], first['ETag'])
+        self.assertEqual(len(json.loads(response.content.decode('utf-8'))['results']), 2)
+
+
+class BulkDestroyTest(TestCase):
+    """DELETE {prefix}/bulk/: 部门软删除; 员工整批删除, SQL 条数与行数无关"""
+
+    def setUp(self):
+        self.department = Department.objects.create(name='研发部', create_date=datetime.date(2018, 1, 1))
+        data = [{'name': '员工%d' % index, 'age': 20, 'salary': '1000', 'comment': None,
+                 'hire_date': '2018-01-02', 'department': self.department.pk} for index in range(110)]
+        self.client.post('/employee5/', json.dumps(data), content_type='application/json')
+        self.ids = sorted(Employee.objects.values_list('pk', flat=True))
+
+    def delete(self, path, ids):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.delete(path, json.dumps({'ids': ids}), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(response.data['ids']), sorted(ids))
+        return len(queries)
+
+    def test_department_soft_delete(self):
+        other = Department.objects.create(name='销售部', create_date=datetime.date(2018, 1, 1))
+        self.delete('/departments5/bulk/', [self.department.pk, other.pk])
+        self.assertFalse(Department.objects.exists())
+        self.assertTrue(Department.all_objects.get(pk=self.department.pk).is_delete)
+        # 员工没有被级联删除
+        self.assertEqual(Employee.objects.count(), 110)
+        self.assertFalse(Tombstone.objects.exists())
+        self.assertEqual(summary.check(), [])
+
+    def test_employee_query_count_is_constant(self):
+        small = self.delete('/employee5/bulk/', self.ids[:10])
+        large = self.delete('/employee5/bulk/', self.ids[10:110])
+        self.assertEqual(small, large)
+        self.assertFalse(Employee.objects.exists())
+        self.assertEqual(sorted(Tombstone.objects.filter(model='employee').values_list('object_id', flat=True)),
+                         self.ids)
+        self.assertFalse(SearchToken.objects.filter(model='employee').exists())
+        self.assertEqual(summary.check(), [])
+        self.assertEqual(DepartmentSummary.objects.get(department=self.department).headcount, 0)
+
+
+    def test_duplicate_ids_rejected(self):
+        pk = self.ids[0]
+        response = self.client.patch('/employee5/bulk/', json.dumps(
+            [{'id': pk, 'name': '张三'}, {'id': pk, 'name': '李四'}]), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('ids', response.data)
+        response = self.client.delete('/employee5/bulk/', json.dumps({'ids': [pk, pk]}),
+                                      content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Employee.objects.get(pk=pk).name, '员工0')
+
+class SoftDeleteManagerTest(TestCase):
+    """Department.objects 只返回未删除的部门"""
+
+    def setUp(self):
+        Department.objects.create(name='研发部', create_date=datetime.date(2018, 1, 1))
+        Department.objects.create(name='测试部', create_date=datetime.date(2018, 1, 2), is_delete=True)
+
+    def test_live_rows_by_default(self):
+        self.assertEqual(list(Department.objects.values_list('name', flat=True)), ['研发部'])
+
+    def test_all_objects_includes_deleted(self):
+        self.assertEqual(Department.all_objects.count(), 2)
+
+    def test_related_lookup_sees_deleted_department(self):
+        department = Department.all_objects.get(name='测试部')
+        employee = Employee.objects.create(name='张三', age=20, salary='1000', department=department)
+        self.assertEqual(Employee.objects.get(pk=employee.pk).department, department)
+
+
+class IndexUsageTest(TestCase):
+    """用 EXPLAIN 确认常用的查询用到了 0002_indexes 中的索引"""
+
+    @classmethod
+    def setUpTestData(cls):
+        departments = [
+            Department(name='部门%d' % i, create_date=datetime.date(2018, 1, 1 + i % 28), is_delete=i % 10 == 0)
+            for i in range(200)
+        ]
+        Department.all_objects.bulk_create(departments)
+        department_ids = list(Department.all_objects.values_list('id', flat=True))
+        Employee.objects.bulk_create([
+            Employee(name='员工%d' % i, age=20 + i % 40, salary='1000', department_id=department_ids[i % 200])
+            for i in range(2000)
+        ])
+
+    def explain(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+                return ' '.join(str(row[-1]) for row in cursor.fetchall())
+            if connection.vendor == 'mysql':
+                cursor.execute('EXPLAIN ' + sql, params)
+                columns = [column[0] for column in cursor.description]
+                return ' '.join(str(dict(zip(columns, row)).get('key')) for row in cursor.fetchall())
+        self.skipTest('EXPLAIN 检查只支持 sqlite 和 mysql')
+
+    def assertUsesIndex(self, queryset, index_name):
+        plan = self.explain(queryset)
+        self.assertIn(index_name, plan)
+
+    def test_filter_live_department_by_name(self):
+        self.assertUsesIndex(Department.objects.filter(name='部门1'), 'department_live_name_idx')
+
+    def test_latest_live_department(self):
+        queryset = Department.objects.order_by('-create_date')[:1]
+        self.assertUsesIndex(queryset, 'department_live_created_idx')
+
+    def test_department_keyset_page(self):
+        queryset = Department.objects.filter(create_date__gte='2018-01-10').order_by('create_date', 'id')[:10]
+        self.assertUsesIndex(queryset, 'department_live_created_idx')
+
+    def test_employees_of_department_by_hire_date(self):
+        queryset = Employee.objects.filter(department_id=1).order_by('hire_date')
+        self.assertUsesIndex(queryset, 'employee_dept_hire_idx')
+
+    def test_employee_keyset_page(self):
+        queryset = Employee.objects.order_by('hire_date', 'id')[:10]
+        self.assertUsesIndex(queryset, 'employee_hire_id_idx')
+
+
+class HistogramTest(TestCase):
+
+    def test_percentiles(self):
+        histogram = Histogram(COUNT_BOUNDS)
+        for value in range(1, 101):
+            histogram.observe(value)
+        self.assertEqual(histogram.percentile(50), 50)
+        self.assertAlmostEqual(histogram.percentile(99), 99, delta=99 * 0.25)
+        self.assertEqual(histogram.summary()['max'], 100)
+
+
+@override_settings(USERS_METRICS={'ENABLED': True, 'SAMPLE_RATE': 1})
+class MetricsTest(TestCase):
+    """每个视图/动作的统计数据"""
+
+    def setUp(self):
+        registry.reset()
+        department = Department.objects.create(name='研发部', create_date=datetime.date(2018, 1, 1))
+        Employee.objects.create(name='张三', age=20, salary='1000', department=department)
+
+    def test_records_viewset_actions(self):
+        response = self.client.get('/employee5/')
+        self.assertIn('Server-Timing', response)
+        self.client.get('/departments5/latest/')
+
+        views = registry.snapshot()
+        self.assertEqual(sorted(views), ['DepartmentViewSet.latest', 'EmployeeViewSet.list'])
+        stats = views['EmployeeViewSet.list']
+        self.assertEqual(stats['count'], 1)
+        self.assertEqual(stats['db_queries']['max'], 1)
+        self.assertGreater(stats['serializer_ms']['max'], 0)
+        self.assertGreater(stats['renderer_ms']['max'], 0)
+
+    @override_settings(USERS_METRICS={'ENABLED': True, 'SAMPLE_RATE': 0})
+    def test_not_sampled(self):
+        response = self.client.get('/employee5/')
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(registry.snapshot(), {})
+
+    def test_stats_endpoint_requires_admin(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        get_user_model().objects.create_superuser('admin', 'admin@example.com', '123456')
+        self.client.login(username='admin', password='123456')
+        self.client.get('/employee5/')
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('p99', response.data['views']['EmployeeViewSet.list']['wall_ms'])
+
+
+class SparseFieldsTest(TestCase):
+    """?fields= / ?exclude= 去掉的字段不序列化, 也不查询对应的列"""
+
+    def setUp(self):
+        department = Department.objects.create(name='研发部', create_date=datetime.date(2018, 1, 1))
+        Employee.objects.create(name='张三', age=20, salary='1000', comment='备注', department=department)
+
+    def get(self, path):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(path)
+        return response, ' '.join(query['sql'] for query in queries.captured_queries)
+
+    def test_fields(self):
+        response, sql = self.get('/employee5/?fields=id,name,department')
+        self.assertEqual(list(response.data['results'][0]), ['id', 'name', 'department'])
+        self.assertNotIn('comment', sql)
+        self.assertNotIn('salary', sql)
+
+    def test_exclude(self):
+        response, sql = self.get('/departments5/?exclude=is_delete,create_date')
+        self.assertEqual(list(response.data['results'][0]), ['id', 'name'])
+
+    def test_unknown_field(self):
+        response, sql = self.get('/employee5/?fields=id,password')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('fields', response.data)
+
+    def test_full_output_unchanged(self):
+        response, sql = self.get('/employee5/')
+        self.assertEqual(list(response.data['results'][0]), [
+            'id', 'name', 'age', 'gender', 'salary', 'comment', 'hire_date', 'department'])
+        self.assertEqual(response.data['results'][0]['salary'], '1000.00')
+
+    def queryset_for(self, path, action):
+        view = EmployeeViewSet(action_map={'get': action}, format_kwarg=None, args=(), kwargs={})
+        view.request = view.initialize_request(RequestFactory().get(path))
+        return view.get_queryset()
+
+    def test_values_only_when_requested(self):
+        # 没有请求稀疏字段集, 也没有开启编译模式时查询模型对象
+        self.assertIsInstance(self.queryset_for('/employee5/', 'list')[0], Employee)
+        self.assertIsInstance(self.queryset_for('/employee5/?fields=id,name', 'list')[0], dict)
+        # get_object() 使用的查询集总是返回模型对象
+        self.assertIsInstance(self.queryset_for('/employee5/1/?fields=id,name', 'retrieve')[0], Employee)
+        with override_settings(USERS_COMPILED_SERIALIZERS=True):
+            self.assertIsInstance(self.queryset_for('/employee5/', 'list')[0], dict)
+
+    def test_write_ignores_fields(self):
+        response = self.client.post('/departments5/?fields=id', {'name': '测试部', 'create_date': '2018-01-02'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['name'], '测试部')
+
+
+class ExportTest(TestCase):
+    """导出格式的值与 JSON 接口相同"""
+
+    def setUp(self):
+        department = Department.objects.create(name='研发部', create_date=datetime.date(2018, 1, 1))
+        Employee.objects.create(name='张三', age=20, gender=1, salary='1000.5', comment='备注, "引号"',
+                                hire_date=datetime.date(2018, 2, 1), department=department)
+        Employee.objects.create(name='李四', age=30, salary='20', comment=None, department=department)
+        self.expected = json.loads(b''.join(self.client.get('/employee5/?stream=json').streaming_content).decode())
+
+    def export(self, path):
+        response = self.client.get(path)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content)
+
+    def test_csv(self):
+        rows = list(csv.reader(io.StringIO(self.export('/employee5/?format=csv').decode('utf-8'))))
+        self.assertEqual(rows[0], list(self.expected[0]))
+        for row, item in zip(rows[1:], self.expected):
+            self.assertEqual(row, ['' if value is None else str(value) for value in item.values()])
+
+    def test_columnar(self):
+        content = self.export('/employee5/?format=columnar&fields=id,name,gender,salary,comment')
+        self.assertEqual(content[:4], b'UCOL')
+        version, length = struct.unpack_from('<BI', content, 4)
+        header = json.loads(content[9:9 + length].decode('utf-8'))
+        offset = 9 + length
+        count, = struct.unpack_from('<I', content, offset)
+        offset += 4
+        columns = {}
+        for column in header['columns']:
+            nulls = content[offset:offset + count]
+            offset += count
+            if column['type'] == 'int':
+                values = list(struct.unpack_from('<%dq' % count, content, offset))
+                offset += 8 * count
+            else:
+                offsets = struct.unpack_from('<%dI' % (count + 1), content, offset)
+                offset += 4 * (count + 1)
+                values = [content[offset + start:offset + end].decode('utf-8')
+                          for start, end in zip(offsets, offsets[1:])]
+                offset += offsets[-1]
+            columns[column['name']] = [None if null else value for null, value in zip(nulls, values)]
+        self.assertEqual(struct.unpack_from('<I', content, offset), (0,))
+        for name, values in columns.items():
+            self.assertEqual(values, [item[name] for item in self.expected])
+
+    def test_department_list(self):
+        rows = list(csv.reader(io.StringIO(self.export('/department?format=csv').decode('utf-8'))))
+        department = Department.objects.get()
+        self.assertEqual(rows, [
+            ['id', 'name', 'create_date', 'is_delete'],
+            [str(department.pk), '研发部', '2018-01-01', 'False'],
+        ])
+
+
+class ImportTest(TestCase):
+    """员工批量导入: 校验, 拒绝记录和断点"""
+
+    def setUp(self):
+        self.department = Department.objects.create(name='研发部', create_date=datetime.date(2018, 1, 1))
+        lines = ['name,age,gender,salary,comment,hire_date,department']
+        for i in range(10):
+            age = 'x' if i == 3 else str(20 + i)
+            department = 999999 if i == 5 else self.department.pk
+            lines.append('员工%d,%s,0,1000.50,,2018-01-02,%d' % (i, age, department))
+        self.csv = '\n'.join(lines) + '\n'
+
+    def run_import(self, **kwargs):
+        kwargs.setdefault('workers', 0)
+        importer = EmployeeImporter(batch_size=4, **kwargs)
+        return importer.run(iter_records(io.StringIO(self.csv), 'csv'))
+
+    def test_import_with_rejects(self):
+        result = self.run_import()
+        self.assertEqual((result['imported'], result['rejected']), (8, 2))
+        self.assertEqual([error['line'] for error in result['errors']], [4, 6])
+        self.assertIn('age', result['errors'][0]['errors'])
+        self.assertIn('department', result['errors'][1]['errors'])
+        employee = Employee.objects.get(name='员工0')
+        self.assertIsNone(employee.comment)
+        self.assertEqual(employee.department, self.department)
+        # 批量新增后部门汇总仍然一致
+        self.assertEqual(summary.check(), [])
+
+    def test_process_pool(self):
+        result = self.run_import(workers=2)
+        self.assertEqual((result['imported'], result['rejected']), (8, 2))
+        self.assertEqual(Employee.objects.count(), 8)
+
+    def test_resume_from_checkpoint(self):
+        ImportCheckpoint.objects.create(name='test', position=4, imported=3, rejected=1)
+        reject_file = io.StringIO()
+        result = self.run_import(checkpoint='test', reject_file=reject_file)
+        self.assertEqual((result['imported'], result['rejected']), (5, 1))
+        self.assertEqual(sorted(Employee.objects.values_list('name', flat=True)),
+                         ['员工%d' % i for i in (4, 6, 7, 8, 9)])
+        self.assertEqual(json.loads(reject_file.getvalue())['line'], 6)
+        checkpoint = ImportCheckpoint.objects.get(name='test')
+        self.assertEqual((checkpoint.position, checkpoint.imported, checkpoint.rejected), (10, 8, 2))
+
+    @override_settings(USERS_IMPORT={'BATCH_SIZE': 2, 'WORKERS': 2})
+    def test_upload_ndjson(self):
+        content = '\n'.join([
+            json.dumps({'name': '张三', 'age': 20, 'salary': '1000', 'comment': None, 'hire_date': '2018-01-02',
+                        'department': self.department.pk}),
+            '{不是 JSON',
+        ])
+        upload = io.BytesIO(content.encode('utf-8'))
+        upload.name = 'employees.ndjson'
+        # 上传的文件在请求的进程中校验, 不创建进程池
+        with mock.patch('users.importer.multiprocessing.Pool') as pool:
+            response = self.client.post('/employee5/import/', {'file': upload})
+        self.assertFalse(pool.called)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual((response.data['imported'], response.data['rejected']), (1, 1))
+        self.assertEqual(response.data['errors'][0]['line'], 2)
+
+
+class DepartmentUniqueNameTest(TestCase):
+    """部门名称唯一: 批量时整批一条查询"""
+
+    def setUp(self):
+        self.department = Department.objects.create(name='研发部', create_date=datetime.date(2018, 1, 1))
+
+    def test_batch_uses_one_query(self):
+        data = [{'name': '部门%d' % i, 'create_date': '2018-01-02'} for i in range(50)]
+        data[10]['name'] = '研发部'
+        data[20]['name'] = data[30]['name']
+        serializer = DepartmentSerializer(data=data, many=True)
+        with self.assertNumQueries(1):
+            self.assertFalse(serializer.is_valid())
+        errors = [index for index, error in enumerate(serializer.errors) if error]
+        self.assertEqual(errors, [10, 20, 30])
+        self.assertIn('已存在', serializer.errors[10]['name'][0])
+        self.assertIn('重复', serializer.errors[20]['name'][0])
+
+    def test_single_create_and_update(self):
+        response = self.client.post('/departments5/', {'name': '研发部', 'create_date': '2018-01-02'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('name', response.data)
+        # 修改时自己原来的名称不算重复
+        response = self.client.put('/department/%d' % self.department.pk,
+                                   json.dumps({'name': '研发部', 'create_date': '2018-01-03'}),
+                                   content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_bulk_update_keeps_own_name(self):
+        response = self.client.patch('/departments5/bulk/', json.dumps(
+            {'ids': [self.department.pk], 'changes': {'name': '研发部'}}), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        response = self.client.patch('/departments5/bulk/', json.dumps(
+            [{'id': self.department.pk, 'name': '研发部'}]), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_bulk_update_swaps_names(self):
+        other = Department.objects.create(name='销售部', create_date=datetime.date(2018, 1, 1))
+        response = self.client.patch('/departments5/bulk/', json.dumps([
+            {'id': self.department.pk, 'name': '销售部'},
+            {'id': other.pk, 'name': '研发部'},
+        ]), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Department.all_objects.get(pk=self.department.pk).name, '销售部')
+        self.assertEqual(Department.all_objects.get(pk=other.pk).name, '研发部')
+        # 与其他行(不在本次修改中)的名称重复, 或本次提交中重复
+        Department.objects.create(name='财务部', create_date=datetime.date(2018, 1, 1))
+        third = Department.objects.create(name='测试部', create_date=datetime.date(2018, 1, 1))
+        response = self.client.patch('/departments5/bulk/', json.dumps([
+            {'id': self.department.pk, 'name': '财务部'},
+            {'id': other.pk, 'name': '人事部'},
+            {'id': third.pk, 'name': '人事部'},
+        ]), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('已存在', response.data[str(self.department.pk)]['name'][0])
+        self.assertIn('重复', response.data[str(other.pk)]['name'][0])
+
+
+    def test_restore_checks_current_name(self):
+        self.department.is_delete = True
+        self.department.save()
+        Department.objects.create(name='研发部', create_date=datetime.date(2018, 1, 2))
+        response = self.client.patch('/departments5/bulk/?include_deleted=1', json.dumps(
+            {'ids': [self.department.pk], 'changes': {'is_delete': False}}), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('已存在', response.data[str(self.department.pk)]['name'][0])
+        self.assertEqual(Department.objects.filter(name='研发部').count(), 1)
+        # 同时改成其他名称时可以恢复
+        response = self.client.patch('/departments5/bulk/?include_deleted=1', json.dumps(
+            [{'id': self.department.pk, 'is_delete': False, 'name': '测试部'}]), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(Department.objects.filter(pk=self.department.pk, name='测试部').exists())
+
+class DepartmentSummaryTest(TestCase):
+    """部门汇总: 单个和批量修改后与聚合结果一致"""
+
+    def setUp(self):
+        self.first = Department.objects.create(name='研发部', create_date=datetime.date(2018, 1, 1))
+        self.second = Department.objects.create(name='销售部', create_date=datetime.date(2018, 1, 1))
+        self.employee = Employee.objects.create(name='张三', age=20, salary='100.10', department=self.first)
+
+    def assertConsistent(self):
+        self.assertEqual(summary.check(), [])
+
+    def test_single_changes(self):
+        Employee.objects.create(name='李四', age=30, salary='10.05', department=self.first)
+        summary_row = DepartmentSummary.objects.get(department=self.first)
+        self.assertEqual((summary_row.headcount, summary_row.age_total), (2, 50))
+        self.assertEqual(summary_row.salary_total, Decimal('110.15'))
+        # 调换部门
+        self.employee.department = self.second
+        self.employee.save()
+        self.assertConsistent()
+        self.employee.delete()
+        self.assertConsistent()
+
+    def test_bulk_changes(self):
+        data = [{'name': '员工%d' % i, 'age': 30, 'salary': '10.05', 'comment': None,
+                 'hire_date': '2018-01-01', 'department': self.second.pk} for i in range(3)]
+        self.client.post('/employee5/', json.dumps(data), content_type='application/json')
+        self.assertConsistent()
+        ids = list(Employee.objects.values_list('id', flat=True))
+        self.client.patch('/employee5/bulk/', json.dumps({'ids': ids[:2], 'changes': {'department': self.second.pk}}),
+                          content_type='application/json')
+        self.client.patch('/employee5/bulk/', json.dumps([{'id': ids[2], 'age': 40, 'salary': '1.00'}]),
+                          content_type='application/json')
+        self.assertConsistent()
+        self.client.delete('/employee5/bulk/', json.dumps({'ids': ids[1:]}), content_type='application/json')
+        self.assertConsistent()
+
+    def test_stats(self):
+        with self.assertNumQueries(1):
+            response = self.client.get('/departments5/stats/')
+        self.assertEqual(response.data[0]['headcount'], 1)
+        self.assertEqual(response.data[0]['avg_salary'], '100.10')
+        self.assertEqual(response.data[1]['headcount'], 0)
+        self.assertIsNone(response.data[1]['avg_age'])
+
+    def test_check_and_rebuild(self):
+        DepartmentSummary.objects.update(headcount=5)
+        with self.assertRaises(CommandError):
+            call_command('department_summary', check=True, stdout=io.StringIO())
+        call_command('department_summary', rebuild=True, check=True, stdout=io.StringIO())
+        self.assertConsistent()
+
+
+class DepartmentSummaryCommitTest(TransactionTestCase):
+    """批量修改: 减去原来的值和累加新的值在同一个事务中提交"""
+
+    def setUp(self):
+        self.first = Department.objects.create(name='研发部', create_date=datetime.date(2018, 1, 1))
+        self.second = Department.objects.create(name='销售部', create_date=datetime.date(2018, 1, 1))
+        self.ids = [Employee.objects.create(name='员工%d' % i, age=20, salary='10.00', department=self.first).pk
+                    for i in range(2)]
+
+    def patch_department(self):
+        return self.client.patch('/employee5/bulk/', json.dumps({'ids': self.ids, 'changes': {'department': self.second.pk}}),
+                                 content_type='application/json')
+
+    def test_bulk_update(self):
+        self.patch_department()
+        self.assertEqual(summary.check(), [])
+        self.assertEqual(DepartmentSummary.objects.get(department=self.second).headcount, 2)
+
+    def test_rolled_back_together(self):
+        def fail(sender, **kwargs):
+            raise DatabaseError('bulk_changed failed')
+
+        bulk_changed.connect(fail, sender=Employee)
+        try:
+            with self.assertRaises(DatabaseError):
+                self.patch_department()
+        finally:
+            bulk_changed.disconnect(fail, sender=Employee)
+        self.assertEqual(Employee.objects.filter(department=self.first).count(), 2)
+        self.assertEqual(summary.check(), [])
+        self.assertEqual(DepartmentSummary.objects.get(department=self.first).headcount, 2)
+
+
+class NestedEmployeesTest(TestCase):
+    """?employees=N: 整页的部门一个 Prefetch 查询, 每个部门最多 N 个员工"""
+
+    def setUp(self):
+        for d in range(6):
+            department = Department.objects.create(name='部门%d' % d, create_date=datetime.date(2018, 1, 1 + d))
+            for i in range(d):
+                Employee.objects.create(name='员工%d' % i, age=20, salary='1000', department=department)
+
+    def get(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.data, len(queries)
+
+    def assertNested(self, data):
+        for item in data['results']:
+            department = Department.objects.get(pk=item['id'])
+            expected = list(department.employee_set.order_by('-hire_date', '-id').values_list('id', flat=True)[:2])
+            self.assertEqual([employee['id'] for employee in item['employee_set']], expected)
+            self.assertEqual(item['employee_count'], department.employee_set.count())
+
+    def test_two_queries(self):
+        data, count = self.get('/departments5/?employees=2&page_size=2')
+        self.assertEqual(count, 2)
+        data, count = self.get('/departments5/?employees=2&page_size=6')
+        self.assertEqual(count, 2)
+        self.assertEqual(len(data['results']), 6)
+        self.assertNested(data)
+
+    def test_without_sliced_subqueries(self):
+        # MySQL 不支持 IN 子查询中的 LIMIT, 在 Python 中截断
+        with mock.patch.object(connection.features, 'allow_sliced_subqueries', False):
+            data, count = self.get('/departments5/?employees=2&page_size=6')
+        self.assertEqual(count, 2)
+        self.assertNested(data)
+
+    def test_not_nested_by_default(self):
+        data, count = self.get('/departments5/')
+        self.assertNotIn('employee_set', data['results'][0])
+        response = self.client.get('/departments5/?employees=0')
+        self.assertEqual(response.status_code, 400)
+
+
+class SearchTest(TestCase):
+    """?search=: n-gram 索引(SearchToken)查出候选对象, 再用 icontains 确认"""
+
+    def setUp(self):
+        self.department = Department.objects.create(name='研发部', create_date=datetime.date(2018, 1, 1))
+        self.other = Department.objects.create(name='部发研', create_date=datetime.date(2018, 1, 2))
+        self.employee = Employee.objects.create(
+            name='张三', age=20, salary='1000', comment='Python 工程师', department=self.department)
+
+    def search(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return [item['name'] for item in response.data['results']]
+
+    def test_substring(self):
+        self.assertEqual(self.search('/departments5/?search=研发'), ['研发部'])
+        self.assertEqual(self.search('/departments5/?search=发'), ['研发部', '部发研'])
+        self.assertEqual(self.search('/employee5/?search=python 工程'), ['张三'])
+        # n-gram 研发, 发部 都出现, 但不是连续的 "研发部"
+        Employee.objects.create(name='李四', age=20, salary='1000', comment='研发,发部', department=self.department)
+        self.assertEqual(self.search('/employee5/?search=研发'), ['李四'])
+        self.assertEqual(self.search('/employee5/?search=研发部'), [])
+
+    def test_unknown_pks_indexes_missing_objects(self):
+        # bulk_create 没有带主键的通知之前, 单个新增的员工(主键更大)已经建立了索引
+        Employee.objects.bulk_create([Employee(name='王五', age=20, salary='1000', department=self.department)])
+        Employee.objects.create(name='赵六', age=20, salary='1000', department=self.department)
+        bulk_changed.send(sender=Employee, pks=None)
+        self.assertEqual(self.search('/employee5/?search=王五'), ['王五'])
+        self.assertEqual(self.search('/employee5/?search=赵六'), ['赵六'])
+
+    def test_sync_on_update_and_delete(self):
+        self.employee.name = '李四'
+        self.employee.save()
+        self.assertEqual(self.search('/employee5/?search=张三'), [])
+        self.assertEqual(self.search('/employee5/?search=李四'), ['李四'])
+        self.employee.delete()
+        self.assertFalse(SearchToken.objects.filter(model='employee', object_id=self.employee.pk).exists())
+
+    def test_bulk_create(self):
+        response = self.client.post('/employee5/', json.dumps([
+            {'name': '王五%d' % i, 'age': 20, 'salary': '1000', 'comment': '', 'hire_date': '2018-01-01',
+             'department': self.department.pk}
+            for i in range(3)
+        ]), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(sorted(self.search('/employee5/?search=王五&page_size=10')), ['王五0', '王五1', '王五2'])
+
+    def test_rebuild_command(self):
+        SearchToken.objects.all().delete()
+        call_command('rebuild_search_index', 'department', stdout=io.StringIO())
+        self.assertEqual(self.search('/departments5/?search=研发'), ['研发部'])
+        self.assertEqual(self.search('/employee5/?search=张三'), [])
+        with self.assertRaises(CommandError):
+            call_command('rebuild_search_index', 'unknown', stdout=io.StringIO())
+
+    def test_uses_index(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('EXPLAIN 检查只支持 sqlite')
+        sql, params = search.search(Employee.objects.all(), '张三').query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            plan = ' '.join(str(row[-1]) for row in cursor.fetchall())
+        self.assertIn('search_token_model', plan)
+        self.assertNotIn('SCAN TABLE search_token', plan)
+
+
+class CompressionTest(TestCase):
+    """按 Accept-Encoding 压缩响应, 见 users/compression.py"""
+
+    @classmethod
+    def setUpTestData(cls):
+        department = Department.objects.create(name='研发部', create_date=datetime.date(2018, 1, 1))
+        Employee.objects.bulk_create([
+            Employee(name='员工%d' % i, age=20, salary='1000', comment='备注', department=department)
+            for i in range(50)
+        ])
+        for i in range(50):
+            Department.objects.create(name='部门%d' % i, create_date=datetime.date(2018, 1, 1))
+
+    def test_accepted_encoding(self):
+        self.assertEqual(accepted_encoding('gzip, deflate, br'), 'gzip')
+        self.assertEqual(accepted_encoding('gzip;q=0.5, deflate'), 'deflate')
+        self.assertEqual(accepted_encoding('gzip;q=0, *'), 'deflate')
+        self.assertIsNone(accepted_encoding('br, identity'))
+        self.assertIsNone(accepted_encoding(''))
+
+    def test_gzip_and_deflate(self):
+        plain = self.client.get('/employee5/?page_size=50')
+        self.assertNotIn('Content-Encoding', plain)
+        self.assertIn('Accept-Encoding', plain['Vary'])
+        response = self.client.get('/employee5/?page_size=50', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.content), plain.content)
+        response = self.client.get('/employee5/?page_size=50', HTTP_ACCEPT_ENCODING='deflate')
+        self.assertEqual(response['Content-Encoding'], 'deflate')
+        self.assertEqual(zlib.decompress(response.content), plain.content)
+
+    def test_small_response_not_compressed(self):
+        response = self.client.get('/employee5/?page_size=1', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertNotIn('Content-Encoding', response)
+
+    def test_streaming(self):
+        plain = b''.join(self.client.get('/employee5/?stream=ndjson').streaming_content)
+        response = self.client.get('/employee5/?stream=ndjson', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), plain)
+
+    def test_cached_response_etag(self):
+        response = self.client.get('/departments5/?page_size=50', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertTrue(response['ETag'].startswith('W/"'))
+        response = self.client.get('/departments5/?page_size=50', HTTP_ACCEPT_ENCODING='gzip',
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+
+class BatchTest(TestCase):
+    """POST /batch: 按顺序执行子请求, 每个子请求单独给出状态码"""
+
+    def setUp(self):
+        self.department = Department.objects.create(name='研发部', create_date=datetime.date(2018, 1, 1))
+        self.employee = Employee.objects.create(
+            name='张三', age=20, salary='1000', comment='', department=self.department)
+
+    def batch(self, requests):
+        response = self.client.post('/batch', json.dumps({'requests': requests}), content_type='application/json')
+        return response.status_code, json.loads(response.content.decode('utf-8'))
+
+    def test_responses(self):
+        status, data = self.batch([
+            {'path': '/department/%d' % self.department.pk},
+            {'path': '/departments5/latest/'},
+            {'path': '/employee5/%d/?fields=name' % self.employee.pk},
+            {'path': '/employee5/?search=张三'},
+            {'path': '/nothing'},
+            {'path': '/batch', 'method': 'POST'},
+        ])
+        self.assertEqual(status, 200)
+        self.assertEqual([item['status'] for item in data['responses']], [200, 200, 200, 200, 404, 400])
+        self.assertEqual(data['responses'][0]['body']['name'], '研发部')
+        self.assertEqual(data['responses'][2]['body'], {'name': '张三'})
+        self.assertEqual(len(data['responses'][3]['body']['results']), 1)
+
+    def test_write_then_read(self):
+        status, data = self.batch([
+            {'method': 'PATCH', 'path': '/employee5/bulk/', 'body': {'ids': [self.employee.pk], 'changes': {'age': 30}}},
+            {'path': '/employee5/%d/' % self.employee.pk},
+            {'method': 'POST', 'path': '/departments5/', 'body': {'name': '研发部', 'create_date': '2018-01-01'}},
+        ])
+        self.assertEqual([item['status'] for item in data['responses']], [200, 200, 400])
+        self.assertEqual(data['responses'][1]['body']['age'], 30)
+
+    def test_sub_request_headers(self):
+        etag = self.client.get('/departments5/%d/' % self.department.pk)['ETag']
+        status, data = self.batch([
+            {'path': '/departments5/%d/' % self.department.pk, 'headers': {'If-None-Match': etag}},
+        ])
+        self.assertEqual(data['responses'][0]['status'], 304)
+        self.assertIsNone(data['responses'][0]['body'])
+
+    @override_settings(USERS_BATCH={'MAX_REQUESTS': 2})
+    def test_invalid(self):
+        status, data = self.batch([{'path': '/department'}] * 3)
+        self.assertEqual(status, 400)
+        status, data = self.batch([{'path': 'department'}])
+        self.assertEqual(status, 400)
+
+
+class BatchConcurrencyTest(TransactionTestCase):
+    """不在事务中时, 连续的 GET 子请求在线程池中执行, 每个线程使用自己的数据库连接"""
+
+    def test_concurrent_gets(self):
+        department = Department.objects.create(name='研发部', create_date=datetime.date(2018, 1, 1))
+        threads = []
+        dispatch = batch.dispatch
+
+        def record(request, item):
+            threads.append(threading.current_thread().name)
+            return dispatch(request, item)
+
+        requests = [{'path': '/department/%d' % department.pk}] * 4 + [
+            {'method': 'PUT', 'path': '/departments5/%d/name/' % department.pk, 'body': {'name': '测试部'}},
+            {'path': '/department/%d' % department.pk},
+        ]
+        with mock.patch.object(batch, 'dispatch', record):
+            response = self.client.post('/batch', json.dumps({'requests': requests}), content_type='application/json')
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual([item['status'] for item in data['responses']], [200] * 6)
+        self.assertEqual([item['body']['name'] for item in data['responses'][:4]], ['研发部'] * 4)
+        self.assertEqual(data['responses'][5]['body']['name'], '测试部')
+        self.assertTrue(all(name.startswith('users-batch') for name in threads[:4]))
+        self.assertEqual(threads[4:], [threading.current_thread().name] * 2)
+
+
+@override_settings(USERS_CHANGES={'OVERLAP': 0})
+class ChangeFeedTest(TestCase):
+    """GET /employee5/changes/?since=: 游标之后变化和删除的行"""
+
+    def setUp(self):
+        self.department = Department.objects.create(name='研发部', create_date=datetime.date(2018, 1, 1))
+        self.employees = [
+            Employee.objects.create(name='员工%d' % i, age=20, salary='1000', comment='', department=self.department)
+            for i in range(4)
+        ]
+
+    def sync(self, url, since=None, page_size=None):
+        """一直请求到 more 为 false, 返回 (变化的 id, 删除的 id, 游标)"""
+        changed, deleted = [], []
+        while True:
+            params = {}
+            if since:
+                params['since'] = since
+            if page_size:
+                params['page_size'] = page_size
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 200)
+            changed += [item['id'] for item in response.data['changed']]
+            deleted += response.data['deleted']
+            since = response.data['since']
+            if not response.data['more']:
+                return changed, deleted, since
+
+    def test_incremental(self):
+        ids = [employee.pk for employee in self.employees]
+        changed, deleted, since = self.sync('/employee5/changes/')
+        self.assertEqual(changed, ids)
+        self.assertEqual(self.sync('/employee5/changes/', since)[:2], ([], []))
+
+        self.employees[0].age = 30
+        self.employees[0].save()
+        self.employees[1].delete()
+        response = self.client.patch('/employee5/bulk/', json.dumps({'ids': ids[2:], 'changes': {'age': 40}}),
+                                     content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        changed, deleted, since = self.sync('/employee5/changes/', since)
+        self.assertEqual(sorted(changed), [ids[0]] + ids[2:])
+        self.assertEqual(deleted, [ids[1]])
+
+    def test_pages_with_same_time(self):
+        # 批量修改的行 updated_at 相同, 分在不同的页中也不会重复或遗漏
+        ids = [employee.pk for employee in self.employees]
+        since = self.sync('/employee5/changes/')[2]
+        self.client.patch('/employee5/bulk/', json.dumps({'ids': ids, 'changes': {'age': 50}}),
+                          content_type='application/json')
+        Employee.objects.filter(pk=ids[0]).delete()
+        changed, deleted, since = self.sync('/employee5/changes/', since, page_size=1)
+        self.assertEqual(changed, ids[1:])
+        self.assertEqual(deleted, [ids[0]])
+
+    def test_soft_deleted_department(self):
+        since = self.sync('/departments5/changes/')[2]
+        self.client.patch('/departments5/bulk/', json.dumps({'ids': [self.department.pk], 'changes': {
+            'is_delete': True}}), content_type='application/json')
+        self.assertEqual(self.sync('/departments5/changes/', since)[:2], ([], [self.department.pk]))
+
+    @override_settings(USERS_CHANGES={'OVERLAP': 60})
+    def test_overlap(self):
+        # 最近 OVERLAP 秒内的变化下次再返回一次
+        since = self.sync('/employee5/changes/')[2]
+        self.assertEqual(len(self.sync('/employee5/changes/', since)[0]), 4)
+
+    def test_invalid_and_expired_cursor(self):
+        response = self.client.get('/employee5/changes/', {'since': 'abc'})
+        self.assertEqual(response.status_code, 400)
+        since = changes.encode_cursor(changes.Cursor(timezone.now() - datetime.timedelta(days=31), 0, 0))
+        response = self.client.get('/employee5/changes/', {'since': since})
+        self.assertEqual(response.status_code, 410)
+
+    def test_uses_index(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('EXPLAIN 检查只支持 sqlite')
+        queryset = Employee.objects.filter(updated_at__gt=timezone.now()).order_by('updated_at', 'id')[:10]
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            plan = ' '.join(str(row[-1]) for row in cursor.fetchall())
+        self.assertIn('employee_updated_idx', plan)
+
+
+class IdentityMapTest(TestCase):
+    """嵌套的部门每个只查询一次, 只序列化一次"""
+
+    def setUp(self):
+        self.departments = [
+            Department.objects.create(name='部门%d' % i, create_date=datetime.date(2018, 1, 1)) for i in range(2)
+        ]
+        for i in range(6):
+            Employee.objects.create(name='员工%d' % i, age=20, gender=i % 2, salary='1000', comment='',
+                                    department=self.departments[i % 2])
+
+    def test_one_query_per_related_model(self):
+        class Meta:
+            model = Employee
+            fields = '__all__'
+            depth = 1
+        plain_class = type('PlainEmployeeSerializer', (rest_serializers.ModelSerializer,), {'Meta': Meta})
+        expected = plain_class(Employee.objects.select_related('department'), many=True).data
+
+        with self.assertNumQueries(2):
+            data = EmployeeSerializer2(Employee.objects.all(), many=True).data
+        self.assertEqual(json.loads(json.dumps(data)), json.loads(json.dumps(expected)))
+        # 同一个部门只序列化一次
+        self.assertIs(data[0]['department'], data[2]['department'])
+        self.assertIsNot(data[0]['department'], data[1]['department'])
+
+    def test_request_scoped(self):
+        request = Request(RequestFactory().get('/employee5/'))
+        employees = list(Employee.objects.all())
+        with self.assertNumQueries(1):
+            EmployeeSerializer2(employees, many=True, context={'request': request}).data
+        with self.assertNumQueries(0):
+            data = EmployeeSerializer2(employees[0], context={'request': request}).data
+        self.assertEqual(data['department']['name'], '部门0')
+        self.assertEqual(len(request._request.users_identity_map.objects[Department]), 2)
+
+    def test_expand_endpoint(self):
+        """GET /employee5/?expand=department: 查询次数与员工数无关"""
+        with self.assertNumQueries(2):
+            response = self.client.get('/employee5/?expand=department&page_size=100')
+        results = response.data['results']
+        self.assertEqual(len(results), 6)
+        self.assertEqual({row['department']['name'] for row in results}, {'部门0', '部门1'})
+        for i in range(20):
+            Employee.objects.create(name='新员工%d' % i, age=20, gender=0, salary='1000', comment='',
+                                    department=self.departments[i % 2])
+        with self.assertNumQueries(2):
+            response = self.client.get('/employee5/?expand=department&page_size=100')
+        self.assertEqual(len(response.data['results']), 26)
+
+        employee = Employee.objects.first()
+        response = self.client.get('/employee5/%d/?expand=department' % employee.pk)
+        self.assertEqual(response.data['department']['id'], employee.department_id)
+        # 不指定时仍然只输出部门 id
+        response = self.client.get('/employee5/%d/' % employee.pk)
+        self.assertEqual(response.data['department'], employee.department_id)
+
+    def test_plan_skips_select_related(self):
+        plan = build_plan(EmployeeSerializer2(), Employee)
+        self.assertEqual(plan.select_related, [])
+        self.assertEqual(plan.identity_mapped, ['department'])
+        self.assertIn('department', plan.only)
+
+    def test_choice_display(self):
+        field = identity.MemoizedChoiceField(choices=((0, '男'), (1, '女')))
+        self.assertEqual([field.to_representation(value) for value in (0, '1', 0, 2)], [0, 1, 0, 2])
+        self.assertEqual(field._display, {(int, 0): 0, (str, '1'): 1, (int, 2): 2})
+        # 与 0 / 1 哈希值相等的 False / True 不使用它们的缓存
+        values = (False, True, 1)
+        self.assertEqual([field.to_representation(value) for value in values],
+                         [rest_serializers.ChoiceField(choices=((0, '男'), (1, '女'))).to_representation(value)
+                          for value in values])
+        self.assertIs(field.to_representation(False), False)
+        # 编译模式仍然走快速路径
+        serializer = EmployeeSerializer()
+        self.assertNotIn('_generic_field(ret, fields[3]', get_compiled_row(serializer, Employee).source)
+
+
+class TopNTest(TransactionTestCase):
+    """GET /departments5/latest/?n=: 内存中的列表, 保存和删除时写穿更新(事务外才写穿, 所以用 TransactionTestCase)"""
+
+    def setUp(self):
+        for top in topn.TOP_LISTS.values():
+            top.invalidate()
+        self.top = topn.TOP_LISTS['latest_department']
+        self.departments = [
+            Department.objects.create(name='部门%d' % i, create_date=datetime.date(2018, 1, 1 + i)) for i in range(3)
+        ]
+
+    def names(self, n):
+        return [department.name for department in self.top.get(n)]
+
+    def test_latest(self):
+        response = self.client.get('/departments5/latest/')
+        self.assertEqual(response.data['name'], '部门2')
+        with self.assertNumQueries(0):
+            response = self.client.get('/departments5/latest/', {'n': 2})
+        self.assertEqual([item['name'] for item in response.data], ['部门2', '部门1'])
+        for value in ('0', 'abc', '101'):
+            self.assertEqual(self.client.get('/departments5/latest/', {'n': value}).status_code, 400)
+
+    def test_nested_employees(self):
+        """?employees= 时按主键一次取出部门, 嵌套的员工一条 prefetch 查询, 与 n 无关"""
+        for department in self.departments:
+            for i in range(2):
+                Employee.objects.create(name='%s员工%d' % (department.name, i), age=20, gender=0,
+                                        salary='1000', comment='', department=department)
+        self.names(3)
+        for n in (1, 3):
+            with self.assertNumQueries(2):
+                response = self.client.get('/departments5/latest/', {'n': n, 'employees': 'all'})
+            self.assertEqual(len(response.data), n)
+        self.assertEqual([item['name'] for item in response.data], ['部门2', '部门1', '部门0'])
+        self.assertEqual([item['employee_count'] for item in response.data], [2, 2, 2])
+        self.assertEqual({employee['name'] for employee in response.data[0]['employee_set']},
+                         {'部门2员工0', '部门2员工1'})
+        with self.assertNumQueries(2):
+            response = self.client.get('/departments5/latest/', {'employees': 1})
+        self.assertEqual(len(response.data['employee_set']), 1)
+        # 内存中的快照没有被修改
+        self.assertFalse(hasattr(self.top.get(1)[0], '_prefetched_objects_cache'))
+
+    def test_write_through(self):
+        self.assertEqual(self.names(10), ['部门2', '部门1', '部门0'])
+        newest = Department.objects.create(name='新部门', create_date='2018-02-01')
+        self.departments[1].create_date = datetime.date(2017, 1, 1)
+        self.departments[1].save()
+        self.departments[2].is_delete = True
+        self.departments[2].save()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.names(10), ['新部门', '部门0', '部门1'])
+        newest.delete()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.names(10), ['部门0', '部门1'])
+
+    @override_settings(USERS_TOP_N={'CAPACITY': 2})
+    def test_capacity(self):
+        self.assertEqual(self.names(2), ['部门2', '部门1'])
+        # 排在列表之后的不放入列表; 列表变短后请求更多时重新查询
+        Department.objects.create(name='旧部门', create_date='2017-01-01')
+        self.departments[2].delete()
+        with self.assertNumQueries(1):
+            self.assertEqual(self.names(2), ['部门1', '部门0'])
+
+    def test_rollback_and_bulk_change(self):
+        self.names(10)
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                Department.objects.create(name='回滚的部门', create_date='2018-02-01')
+                self.assertEqual(self.names(1), ['回滚的部门'])
+                raise ValueError
+        self.assertEqual(self.names(1), ['部门2'])
+        response = self.client.patch('/departments5/bulk/', json.dumps(
+            {'ids': [self.departments[0].pk], 'changes': {'create_date': '2019-01-01'}}),
+            content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.names(1), ['部门0'])
+
+    @override_settings(USERS_TOP_N={'TTL': 0})
+    def test_ttl(self):
+        self.names(1)
+        with self.assertNumQueries(1):
+            self.names(1)
+
+    def test_employee_latest(self):
+        employees = [
+            Employee.objects.create(name='员工%d' % i, age=20, salary='1000', comment='',
+                                    department=self.departments[0])
+            for i in range(3)
+        ]
+        response = self.client.get('/employee5/latest/', {'n': 2})
+        self.assertEqual([item['id'] for item in response.data], [employees[2].pk, employees[1].pk])
+        Department.all_objects.all().delete()
+        self.assertEqual(self.client.get('/employee5/latest/').status_code, 404)
+        self.assertEqual(self.client.get('/departments5/latest/').status_code, 404)
+
+
+class WarmupTest(TestCase):
+    """wsgi 启动预热: 各阶段执行并记录耗时, 出错的阶段不影响其他阶段"""
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(warmup.warm_up())
+
+    @override_settings(USERS_WARMUP={'PATHS': ['/departments5/latest/']})
+    def test_phases(self):
+        Department.objects.create(name='研发部', create_date=datetime.date(2018, 1, 1))
+        _compiled_cache.clear()
+        with mock.patch.object(warmup, 'warm_requests', wraps=warmup.warm_requests) as warm_requests:
+            report = warmup.warm_up(started=time.perf_counter(), force=True)
+        self.assertEqual(list(report), ['setup'] + list(warmup.PHASES))
+        warm_requests.assert_called_once_with(['/departments5/latest/'])
+        self.assertIn((DepartmentSerializer, ('id', 'name', 'create_date', 'is_delete'), Department, True),
+                      _compiled_cache)
+        self.assertEqual(warmup.last_report(), report)
+
+    def test_view_serializer_classes(self):
+        classes = warmup.view_serializer_classes()
+        for serializer_class in (DepartmentSerializer, EmployeeSerializer, DepartmentStatsSerializer,
+                                 DepartmentNameSerializer):
+            self.assertIn(serializer_class, classes)
+
+    def test_failing_phase(self):
+        with mock.patch.object(warmup, 'warm_settings', side_effect=ImportError), \
+                self.assertLogs('users.warmup', 'ERROR'):
+            report = warmup.warm_up(force=True, phases=['settings', 'urls'])
+        self.assertEqual(list(report), ['settings', 'urls'])
+
+
+@override_settings(USERS_ADMISSION={'LIMITS': {
+    'DepartmentListAPIView.get': {'rate': 1, 'burst': 2},
+    'EmployeeViewSet.list': {'concurrency': 1},
+}})
+class AdmissionTest(TestCase):
+    """超出并发数返回 503, 超出速率返回 429, 都带 Retry-After; 没有限制的接口不受影响"""
+
+    def setUp(self):
+        admission.registry.reset()
+        department = Department.objects.create(name='研发部', create_date=datetime.date(2018, 1, 1))
+        self.employee = Employee.objects.create(name='张三', age=20, salary='1000', comment='', department=department)
+
+    def gate(self, key):
+        return admission.registry.snapshot()[key]
+
+    def test_rate_limit(self):
+        statuses = [self.client.get('/department').status_code for _ in range(3)]
+        self.assertEqual(statuses, [200, 200, 429])
+        response = self.client.get('/department')
+        self.assertEqual(response['Retry-After'], '1')
+        gate = self.gate('DepartmentListAPIView.get')
+        self.assertEqual((gate['admitted'], gate['rejected_rate'], gate['in_flight']), (2, 2, 0))
+        self.assertEqual(gate['shed_ratio'], 0.5)
+
+    def test_concurrency_limit(self):
+        slot = admission.registry.get('EmployeeViewSet.list', admission.Limit(concurrency=1)).enter(1)
+        response = self.client.get('/employee5/')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+        # 没有限制的 retrieve 不受影响
+        self.assertEqual(self.client.get('/employee5/%d/' % self.employee.pk).status_code, 200)
+        slot.release()
+        slot.release()
+        self.assertEqual(self.client.get('/employee5/').status_code, 200)
+        gate = self.gate('EmployeeViewSet.list')
+        self.assertEqual((gate['admitted'], gate['rejected_concurrency'], gate['in_flight']), (2, 1, 0))
+
+    @override_settings(USERS_ADMISSION={'LIMITS': {'DepartmentViewSet.list': {'concurrency': 1}}})
+    def test_department_viewset_controlled(self):
+        slot = admission.registry.get('DepartmentViewSet.list', admission.Limit(concurrency=1)).enter(1)
+        self.assertEqual(self.client.get('/departments5/').status_code, 503)
+        slot.release()
+        self.assertEqual(self.client.get('/departments5/').status_code, 200)
+
+    @override_settings(USERS_ADMISSION={'LIMITS': {
+        'DepartmentListAPIView3.get': {'rate': 1}, 'DepartmentViewSet.lst': {'rate': 1}, 'EmployeeViewSet.list': {}}})
+    def test_unknown_limit_keys_logged(self):
+        with self.assertLogs('users.admission', 'WARNING') as logs:
+            self.assertEqual(admission.check_limits(), ['DepartmentViewSet.lst'])
+        self.assertEqual(len(logs.output), 1)
+
+    def test_streaming_holds_slot_until_consumed(self):
+        response = self.client.get('/employee5/', {'stream': 'ndjson'})
+        self.assertEqual(self.gate('EmployeeViewSet.list')['in_flight'], 1)
+        self.assertEqual(self.client.get('/employee5/').status_code, 503)
+        b''.join(response.streaming_content)
+        self.assertEqual(self.gate('EmployeeViewSet.list')['in_flight'], 0)
+
+    def test_unhandled_exception_releases_slot(self):
+        with mock.patch('users.views.EmployeeViewSet.list', side_effect=RuntimeError, create=True):
+            with self.assertRaises(RuntimeError):
+                self.client.get('/employee5/')
+        self.assertEqual(self.gate('EmployeeViewSet.list')['in_flight'], 0)
+
+    @override_settings(USERS_ADMISSION={'ENABLED': False, 'LIMITS': {'DepartmentListAPIView.get': {'rate': 1}}})
+    def test_disabled(self):
+        statuses = [self.client.get('/department').status_code for _ in range(3)]
+        self.assertEqual(statuses, [200, 200, 200])
+
+    def test_token_bucket_refill(self):
+        with mock.patch('users.admission.time.monotonic', return_value=100.0) as monotonic:
+            bucket = admission.TokenBucket(rate=2, burst=2)
+            self.assertEqual([bucket.take(), bucket.take()], [0, 0])
+            self.assertAlmostEqual(bucket.take(), 0.5)
+            monotonic.return_value = 100.5
+            self.assertEqual(bucket.take(), 0)
+
+
+@override_settings(USERS_DATABASE_ROUTING={'REPLICAS': ['replica'], 'PIN_SECONDS': 5})
+class ReplicaRoutingTest(TransactionTestCase):
+    """读请求使用从库, 写请求和写之后的读使用主库; 两个 SQLite 数据库代替主库和从库(没有复制)"""
+    multi_db = True
+
+    def setUp(self):
+        Department.objects.create(name='主库部门', create_date=datetime.date(2018, 1, 1))
+        # bulk_create 不发送信号, 搜索索引等不会写到主库
+        Department.objects.using('replica').bulk_create([
+            Department(name='从库部门', create_date=datetime.date(2018, 1, 1))])
+        cache.get_backend().clear()
+        routers._down_until.clear()
+
+    def names(self, url='/departments5/changes/'):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content.decode('utf-8'))
+        return [item['name'] for item in data.get('changed', data.get('results'))]
+
+    def test_reads_from_replica(self):
+        self.assertEqual(self.names(), ['从库部门'])
+        # 请求之外使用主库
+        self.assertEqual(list(Department.objects.values_list('name', flat=True)), ['主库部门'])
+
+    def test_streaming_reads_replica(self):
+        # 流式响应和导出在中间件返回之后才查询
+        response = self.client.get('/department?stream=ndjson')
+        self.assertIsNone(routers.current_replica())
+        content = b''.join(response.streaming_content).decode('utf-8')
+        self.assertEqual([json.loads(line)['name'] for line in content.splitlines()], ['从库部门'])
+        self.assertIsNone(routers.current_replica())
+        response = self.client.get('/department?format=csv')
+        content = b''.join(response.streaming_content).decode('utf-8')
+        self.assertIn('从库部门', content)
+        self.assertNotIn('主库部门', content)
+
+    def test_cache_miss_reads_primary(self):
+        # 缓存中不存入从库的数据
+        self.assertEqual(self.names('/departments5/'), ['主库部门'])
+        self.assertEqual(self.names('/departments5/'), ['主库部门'])
+
+    def test_read_your_writes(self):
+        response = self.client.post('/departments5/', json.dumps({'name': '新部门', 'create_date': '2018-01-02'}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertIn('users_pin', response.cookies)
+        self.assertEqual(self.names(), ['主库部门', '新部门'])
+        self.client.cookies['users_pin'] = '0'
+        self.assertEqual(self.names(), ['从库部门'])
+
+    def test_replica_down(self):
+        with mock.patch.object(routers, 'check_connection', side_effect=DatabaseError):
+            self.assertEqual(self.names(), ['主库部门'])
+        # RETRY_SECONDS 内不再选择这个从库
+        self.assertIsNone(routers.choose_replica())
+        routers._down_until.clear()
+        self.assertEqual(routers.choose_replica(), 'replica')
+
+    def test_health_check_closes_dead_connection(self):
+        connection = connections['replica']
+        connection.ensure_connection()
+        connection.users_last_used = time.monotonic() - 60
+        with mock.patch.object(connection, 'is_usable', return_value=False), \
+                mock.patch.object(connection, 'close', wraps=connection.close) as close:
+            routers.check_connection('replica', 30)
+        close.assert_called_once_with()
@@ -0,0 +1,228 @@
+"""
+最新部门 / 最近入职员工等前 N 个对象, 保存在进程内存中
+
+首页不停地轮询 GET /departments5/latest/, 每次都要查询数据库. TopN 在内存中保存排序后的前 CAPACITY 个对象:
+    GET /departments5/latest/          最新成立的部门(一个对象, 与原来相同)
+    GET /departments5/latest/?n=10     最新成立的 10 个部门(列表, n 最大为 CAPACITY)
+    GET /employee5/latest/?n=10        最近入职的 10 个员工
+
+第一次读取时从主库查询前 CAPACITY 个, 之后:
+    - 写穿(write-through): post_save / post_delete 时直接更新内存中的列表, 不重新查询
+      (新的对象排在列表末尾之后且表中还有更多行时, 不知道它的真实排名, 不放入列表)
+    - 删除或修改后列表变短, 请求的 n 超过列表长度时重新查询
+    - 事务中的修改在提交后才更新列表(回滚的修改不会进入列表);
+      事务中的读取直接查询数据库(可能读到自己没有提交的修改), 结果不放入内存
+    - 批量接口的 bulk_changed(见 users/bulk.py)让列表失效
+    - TTL 秒后重新查询: 多进程部署时其他进程的修改, 以及不发送信号的修改(如 QuerySet.update)
+内存中的对象是只读的快照(不含关联对象的缓存), 多个请求共用; 需要关联对象或注解时(如 ?employees=),
+按快照的主键从视图优化过的查询集(QueryPlanMixin)一次取出, 查询次数与 n 无关.
+
+配置(settings.USERS_TOP_N):
+    {
+        'CAPACITY': 100,    # 每个列表保存的对象数, 也是 ?n= 的上限
+        'TTL': 60,          # 秒
+    }
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.http import Http404
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+
+from users.models import Department, Employee
+from users.planning import build_plan
+from users.signals import bulk_changed
+
+DEFAULTS = {
+    'CAPACITY': 100,
+    'TTL': 60,
+}
+
+
+def get_options():
+    options = dict(DEFAULTS)
+    options.update(getattr(settings, 'USERS_TOP_N', {}))
+    return options
+
+
+def snapshot(instance):
+    """
+    只复制列的值, 不带关联对象和 prefetch 的缓存; 之后修改原对象不影响内存中的列表
+    值转换为列的类型(如 create_date='2018-01-01' 保存的字符串), 排序时可以比较
+    """
+    obj = instance.__class__(**dict((field.attname, field.to_python(getattr(instance, field.attname)))
+                                    for field in instance._meta.concrete_fields))
+    obj._state.adding = False
+    obj._state.db = instance._state.db
+    return obj
+
+
+class TopN(object):
+    """
+    一个模型按 ordering(全部降序或全部升序)排序的前 CAPACITY 个对象
+    condition(obj) 判断对象是否属于列表, 应与 manager 的过滤条件一致
+    """
+
+    def __init__(self, model, ordering, manager=None, condition=None):
+        descending = set(name.startswith('-') for name in ordering)
+        assert len(descending) == 1, 'ordering 必须全部降序或全部升序'
+        self.model = model
+        self.ordering = tuple(ordering)
+        self.attnames = tuple(name.lstrip('-') for name in ordering)
+        self.reverse = descending.pop()
+        self.manager = manager or model._default_manager
+        self.condition = condition
+        self._lock = threading.Lock()
+        # 为 None 表示还没有加载或已经失效
+        self._entries = None
+        # 表中所有符合条件的对象都在列表中(行数不到 CAPACITY)
+        self._complete = False
+        self._loaded_at = 0
+
+    def key(self, obj):
+        return tuple(getattr(obj, name) for name in self.attnames)
+
+    def before(self, a, b):
+        """a 是否排在 b 前面"""
+        return self.key(a) > self.key(b) if self.reverse else self.key(a) < self.key(b)
+
+    def matches(self, obj):
+        return self.condition is None or self.condition(obj)
+
+    def query(self, limit):
+        # 从主库读取, 内存中不会存入从库的旧数据
+        alias = router.db_for_write(self.model)
+        return list(self.manager.using(alias).order_by(*self.ordering)[:limit])
+
+    def get(self, n):
+        """排在最前面的 n 个对象(n 不超过 CAPACITY)"""
+        options = get_options()
+        if connections[router.db_for_write(self.model)].in_atomic_block:
+            # 事务中可能有没有提交的修改
+            return self.query(n)
+        with self._lock:
+            expired = time.monotonic() - self._loaded_at > options['TTL']
+            if self._entries is None or expired or (n > len(self._entries) and not self._complete):
+                # 在锁中查询: 同时到达的请求只查询一次, 写穿的更新等查询结束后再应用
+                capacity = options['CAPACITY']
+                self._entries = [snapshot(obj) for obj in self.query(capacity)]
+                self._complete = len(self._entries) < capacity
+                self._loaded_at = time.monotonic()
+            return self._entries[:n]
+
+    def invalidate(self):
+        with self._lock:
+            self._entries = None
+
+    def _remove(self, pk):
+        self._entries = [obj for obj in self._entries if obj.pk != pk]
+
+    def saved(self, obj):
+        """写穿: 新增或修改的对象(快照)放到列表中的位置"""
+        with self._lock:
+            if self._entries is None:
+                return
+            self._remove(obj.pk)
+            if not self.matches(obj):
+                return
+            if not self._complete and not (self._entries and self.before(obj, self._entries[-1])):
+                # 排在列表末尾之后, 不知道与表中其他行的先后; 列表为空时重新查询
+                if not self._entries:
+                    self._entries = None
+                return
+            position = len(self._entries)
+            while position > 0 and self.before(obj, self._entries[position - 1]):
+                position -= 1
+            self._entries.insert(position, obj)
+            capacity = get_options()['CAPACITY']
+            if len(self._entries) > capacity:
+                del self._entries[capacity:]
+                self._complete = False
+
+    def deleted(self, instance):
+        with self._lock:
+            if self._entries is not None:
+                self._remove(instance.pk)
+
+
+TOP_LISTS = {
+    # 最新成立的部门(不包括软删除的部门)
+    'latest_department': TopN(Department, ('-create_date', '-id'), condition=lambda obj: not obj.is_delete),
+    # 最近入职的员工
+    'latest_employee': TopN(Employee, ('-hire_date', '-id')),
+}
+
+
+def lists_of(model):
+    return [top for top in TOP_LISTS.values() if top.model is model]
+
+
+# 事务提交后才更新(不在事务中时立即执行): 提交前其他线程读到的仍然是旧数据, 与列表一致; 回滚时不执行
+@receiver(post_save, sender=Department)
+@receiver(post_save, sender=Employee)
+def write_through_on_save(sender, instance, using=None, **kwargs):
+    obj = snapshot(instance)
+    transaction.on_commit(lambda: [top.saved(obj) for top in lists_of(sender)], using=using)
+
+
+@receiver(post_delete, sender=Department)
+@receiver(post_delete, sender=Employee)
+def write_through_on_delete(sender, instance, using=None, **kwargs):
+    transaction.on_commit(lambda: [top.deleted(instance) for top in lists_of(sender)], using=using)
+
+
+@receiver(bulk_changed, sender=Department)
+@receiver(bulk_changed, sender=Employee)
+def invalidate_on_bulk_change(sender, **kwargs):
+    def invalidate():
+        for top in lists_of(sender):
+            top.invalidate()
+    # 提交前其他线程可能已经重新查询到旧数据, 提交后再失效一次
+    invalidate()
+    transaction.on_commit(invalidate, using=router.db_for_write(sender))
+
+
+class TopNMixin(object):
+    """视图集使用: 从 TOP_LISTS[top_list] 返回最前面的对象, ?n= 时返回列表"""
+    top_list = None
+    top_query_param = 'n'
+
+    def get_top_count(self, request):
+        value = request.query_params.get(self.top_query_param)
+        if value is None:
+            return None
+        capacity = get_options()['CAPACITY']
+        try:
+            n = int(value)
+        except ValueError:
+            n = 0
+        if not 1 <= n <= capacity:
+            raise ValidationError({self.top_query_param: ['必须是 1 到 %d 之间的整数' % capacity]})
+        return n
+
+    def get_top_objects(self, objs):
+        """
+        序列化器需要 select_related / prefetch / 注解(如 ?employees= 嵌套的员工和个数)时, 快照中没有这些数据,
+        按主键从 get_queryset() 一次取出(保持列表的顺序); 否则直接使用快照
+        """
+        if not objs or not getattr(self, 'auto_plan_queryset', False):
+            return objs
+        plan = build_plan(self.get_serializer(), type(objs[0]))
+        if not (plan.select_related or plan.prefetch_related or plan.annotations):
+            return objs
+        loaded = self.get_queryset().in_bulk([obj.pk for obj in objs])
+        return [loaded[obj.pk] for obj in objs if obj.pk in loaded]
+
+    def top_response(self, request):
+        n = self.get_top_count(request)
+        objs = self.get_top_objects(TOP_LISTS[self.top_list].get(1 if n is None else n))
+        if n is not None:
+            return Response(self.get_serializer(objs, many=True).data)
+        if not objs:
+            raise Http404
+        return Response(self.get_serializer(objs[0]).data)
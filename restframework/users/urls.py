@@ -13,6 +13,10 @@ urlpatterns = [
     url(r'^departments3/(?P<pk>\d+)$', DepartmentDetailAPIView3.as_view()),
     url(r'^departments4$', DepartmentAPIView4.as_view()),
     url(r'^departments4/(?P<pk>\d+)$', DepartmentAPIView4.as_view()),
+    # 性能统计
+    url(r'^metrics$', views.MetricsAPIView.as_view()),
+    # 批量请求, 一次执行多个接口
+    url(r'^batch$', views.BatchAPIView.as_view(), name='batch'),
 
     # 视图集的url配置方式一
     # {'get': 'list'}:
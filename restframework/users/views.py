@@ -1,15 +1,28 @@
 from django.http import HttpResponse
 from rest_framework.generics import GenericAPIView, ListAPIView, RetrieveAPIView
-from rest_framework.pagination import PageNumberPagination
-from rest_framework.permissions import BasePermission
+from rest_framework.permissions import BasePermission, IsAdminUser
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.mixins import ListModelMixin, CreateModelMixin, RetrieveModelMixin, UpdateModelMixin, DestroyModelMixin
 from rest_framework.viewsets import GenericViewSet, ModelViewSet
 from rest_framework.decorators import action
 
+from users import admission, batch, warmup
+from users.admission import AdmissionControlMixin, Limit
+from users.bulk import BulkCreateModelMixin, BulkUpdateDestroyMixin
+from users.cache import CachedResponseMixin
+from users.changes import ChangeFeedMixin
+from users.export import ExportListMixin
+from users.importer import EmployeeImporter, guess_format, iter_records, open_upload
+from users.metrics import InstrumentedViewMixin, get_options, registry
 from users.models import Department, Employee
-from users.serializers import DepartmentSerializer, DepartmentNameSerializer, EmployeeSerializer
+from users.pagination import DepartmentKeysetPagination, EmployeeKeysetPagination
+from users.planning import QueryPlanMixin
+from users.search import IndexedSearchFilter
+from users.summary import department_stats
+from users.topn import TopNMixin
+from users.serializers import (DepartmentSerializer, DepartmentNameSerializer, DepartmentStatsSerializer, EmployeeSerializer,
+                               EmployeeSerializer2)
 
 
 def index(request):
@@ -17,13 +30,25 @@ def index(request):
 
 
 """APIView + 序列化器 """
-class DepartmentListAPIView(APIView):
+class DepartmentListAPIView(AdmissionControlMixin, ExportListMixin, APIView):
     # 列表视图
+    # ExportListMixin: ?stream= 流式输出, ?format=csv / msgpack / columnar 导出
+    # AdmissionControlMixin: 不分页的列表很慢, 限制并发和速率, 超出时立即返回 503 / 429(见 users/admission.py)
+    admission_limits = {
+        'get': Limit(concurrency=2, rate=10, burst=20),
+    }
 
     # get /departments/
     def get(self, request):
         """查询多条数据"""
         query_set = Department.objects.all()
+        if self.is_export(request):
+            serializer = DepartmentSerializer(context={'request': request, 'view': self})
+            return self.export_response(query_set, serializer)
+        # ?stream=json 或 ?stream=ndjson: 分块读取, 流式输出
+        stream_format = self.get_stream_format(request)
+        if stream_format:
+            return self.stream_response(query_set, DepartmentSerializer, stream_format)
         # 因为是多条数据所以后面需要+ many=True
         serializer = DepartmentSerializer(query_set, many=True)
         # return JsonResponse(serializer.data, safe=True)  # 字典数据
@@ -41,8 +66,9 @@ class DepartmentListAPIView(APIView):
         return Response(serializer.data, status=201)
 
 
-class DepartmentDetailAPIView(APIView):
-    # 详情视图
+class DepartmentDetailAPIView(CachedResponseMixin, InstrumentedViewMixin, APIView):
+    # 详情视图, GET 请求的响应会被缓存, 部门或员工修改后失效
+    # InstrumentedViewMixin: 缓存的响应提前渲染, 渲染耗时在这里统计
 
     def get(self, request, pk):
         """查询一条数据"""
@@ -81,7 +107,11 @@ class DepartmentDetailAPIView(APIView):
         # 响应请求
         return Response(status=204)
 """GenericAPIView + 拓展类"""
-class DepartmentListAPIView2(ListModelMixin, CreateModelMixin, GenericAPIView):
+class DepartmentListAPIView2(AdmissionControlMixin, ListModelMixin, CreateModelMixin, GenericAPIView):
+    # AdmissionControlMixin: 不分页的列表, 与 DepartmentListAPIView 相同的限制
+    admission_limits = {
+        'get': Limit(concurrency=2, rate=10, burst=20),
+    }
     # 部门查询集
     queryset = Department.objects.all()
     # 使用的序列化器
@@ -116,19 +146,26 @@ class DepartmentDetailAPIView2(RetrieveModelMixin, UpdateModelMixin, DestroyMode
         return self.destroy(request, pk)  # DestroyModelMixin
 
 """可用子类  ListAPIView + RetrieveAPIView"""
-class DepartmentListAPIView3(ListAPIView):
-    """查询多个部门"""
+class DepartmentListAPIView3(AdmissionControlMixin, ListAPIView):
+    """查询多个部门(不分页, 限制并发和速率)"""
+    admission_limits = {
+        'get': Limit(concurrency=2, rate=10, burst=20),
+    }
     queryset = Department.objects.all()
     serializer_class = DepartmentSerializer
 
 
-class DepartmentDetailAPIView3(RetrieveAPIView):
-    """查询一个部门"""
+class DepartmentDetailAPIView3(CachedResponseMixin, InstrumentedViewMixin, RetrieveAPIView):
+    """查询一个部门(响应缓存)"""
     queryset = Department.objects.all()
     serializer_class = DepartmentSerializer
 
 """ 在同一个类中实现get请求的两个业务操作 """
-class DepartmentAPIView4(ListModelMixin, RetrieveModelMixin, GenericAPIView):
+class DepartmentAPIView4(AdmissionControlMixin, ListModelMixin, RetrieveModelMixin, GenericAPIView):
+    # AdmissionControlMixin: 列表和详情都是 get, 按不分页的列表限制
+    admission_limits = {
+        'get': Limit(concurrency=2, rate=10, burst=20),
+    }
     queryset = Department.objects.all()
     serializer_class = DepartmentSerializer
 
@@ -152,15 +189,41 @@ class MyPermission(BasePermission):
             return True  # 有权限
 
 
-class LargeResultsSetPagination(PageNumberPagination):
-    page_size = 2  # 每页显示2条
-    page_query_param = 'page'  # 查询关键字名称：第几页
-    page_size_query_param = 'page_size'  # 查询关键字名称：每页多少条
-
-
-class DepartmentViewSet(ListModelMixin, RetrieveModelMixin, GenericViewSet):
+class IncludeDeletedMixin(object):
+    """
+    Department.objects 默认只查询未删除的部门,
+    请求参数 ?include_deleted=1 时包含已删除的部门
+    """
+    include_deleted_query_param = 'include_deleted'
+
+    def get_queryset(self):
+        queryset = super(IncludeDeletedMixin, self).get_queryset()
+        if self.request.query_params.get(self.include_deleted_query_param) in ('1', 'true'):
+            return queryset.model.all_objects.all()
+        return queryset
+
+
+class DepartmentViewSet(AdmissionControlMixin, CachedResponseMixin, InstrumentedViewMixin, QueryPlanMixin,
+                        IncludeDeletedMixin, BulkCreateModelMixin, BulkUpdateDestroyMixin, ChangeFeedMixin, TopNMixin,
+                        ListModelMixin, RetrieveModelMixin, GenericViewSet):
+    # AdmissionControlMixin: 列表(?employees=all 时嵌套所有员工)限制并发和速率, 在缓存之前检查
+    # CachedResponseMixin: list / retrieve 的响应缓存
+    # InstrumentedViewMixin: 按 action 统计耗时, SQL 次数, 序列化和渲染耗时(GET /metrics)
+    # IncludeDeletedMixin: 默认只查询未删除的部门, ?include_deleted=1 时包含已删除的部门
+    # BulkCreateModelMixin: POST /departments5/ 新增一个部门, 请求体为列表时批量新增
+    # BulkUpdateDestroyMixin: PATCH/DELETE /departments5/bulk/ 批量修改, 批量删除
+    # ChangeFeedMixin: GET /departments5/changes/?since= 增量同步, 只返回变化和删除的部门
+    # TopNMixin: GET /departments5/latest/?n= 从内存中返回最新成立的部门(见 users/topn.py)
     queryset = Department.objects.all()
     serializer_class = DepartmentSerializer
+    top_list = 'latest_department'
+    admission_limits = {
+        'list': Limit(concurrency=4, rate=50, burst=100),
+    }
+    # DELETE /departments5/bulk/ 软删除(is_delete=True), 不级联删除员工
+    soft_delete_field = 'is_delete'
+    # ?search= 按名称搜索, 使用 n-gram 索引(见 users/search.py)
+    filter_backends = (IndexedSearchFilter,)
 
     # 权限控制
     # permission_classes = [IsAuthenticated]   # 登录后才能访问,
@@ -168,13 +231,15 @@ class DepartmentViewSet(ListModelMixin, RetrieveModelMixin, GenericViewSet):
 
     # 过滤操作
     filter_fields = ('name',)
-    # 指定分页配置
-    pagination_class = LargeResultsSetPagination
+    # 指定分页配置: 按 (create_date, id) 的键集分页, 不执行 COUNT(*) 和 OFFSET
+    pagination_class = DepartmentKeysetPagination
 
     def get_serializer_class(self):
         """使用不同的序列化器"""
-        if self.action == 'name':  # name为自定义的action(修改部门名称)
+        if self.action == 'update_name':  # update_name为自定义的action(修改部门名称)
             return DepartmentNameSerializer
+        elif self.action == 'stats':
+            return DepartmentStatsSerializer
         else:
             return DepartmentSerializer
 
@@ -183,17 +248,29 @@ class DepartmentViewSet(ListModelMixin, RetrieveModelMixin, GenericViewSet):
     @action(methods=['get'], detail=False)
     def latest(self, request):
         """
-        自定义action: 查询最新成立的部门
+        自定义action: 查询最新成立的部门, ?n=10 时返回最新成立的 10 个部门
+        写穿更新的内存列表, 不查询数据库(见 users/topn.py)
+        """
+        # department = Department.objects.latest('create_date')
+        return self.top_response(request)
+
+    @action(methods=['get'], detail=False)
+    def stats(self, request):
+        """
+        自定义action: 各部门的人数, 平均年龄, 工资总额和平均工资
+        从增量维护的汇总表读取(users/summary.py), 不读取员工, 支持 ?search= 和 ?include_deleted=1
         """
-        department = Department.objects.latest('create_date')
-        serializer = self.get_serializer(department)
+        queryset = self.filter_queryset(self.get_queryset())
+        serializer = self.get_serializer(department_stats(queryset), many=True)
         return Response(serializer.data)
 
     # detail为true表示需要根据主键操作一个模型类对象，
     # 则方法需要添加一个`pk`参数，来接收url传进来的主键
     # True, 配置请求的时候要匹配上ID
-    @action(methods=['put'], detail=True)
-    def name(self, request, pk):
+    # DRF 3.9 的 as_view() 会把视图类的 name 属性设为视图名称, 所以方法不能叫 name,
+    # 用 url_path / url_name 保持原来的路由 /departments5/<pk>/name/
+    @action(methods=['put'], detail=True, url_path='name', url_name='name')
+    def update_name(self, request, pk):
         """
         自定义action: 修改部门名称
         :param request: 请求对象
@@ -207,10 +284,122 @@ class DepartmentViewSet(ListModelMixin, RetrieveModelMixin, GenericViewSet):
         return Response(serializer.data)
 
 
-class EmployeeViewSet(ModelViewSet):
+class EmployeeViewSet(AdmissionControlMixin, InstrumentedViewMixin, QueryPlanMixin, ExportListMixin,
+                      BulkCreateModelMixin, BulkUpdateDestroyMixin, ChangeFeedMixin, TopNMixin, ModelViewSet):
     """
     ModelViewSet封装了: 增删改查(一条,多条)
     只是将其他结果mixin的类封装在了一起,点开源代码就明白了, mixin是内部封装了校验参数这步所以可以直接调用
+    QueryPlanMixin: 根据序列化器自动 select_related / prefetch_related / only, 避免 N+1 查询
+    BulkCreateModelMixin: POST 列表时批量新增
+    BulkUpdateDestroyMixin: PATCH/DELETE /employee5/bulk/ 批量修改, 批量删除
+    ChangeFeedMixin: GET /employee5/changes/?since= 增量同步, 只返回变化和删除的员工
+    TopNMixin: GET /employee5/latest/?n= 从内存中返回最近入职的员工
+    AdmissionControlMixin: 列表(包括导出)和导入限制并发和速率, 超出时立即拒绝, retrieve 等不受影响
+    InstrumentedViewMixin: 按 action 统计耗时, SQL 次数, 序列化和渲染耗时(GET /metrics)
+    ExportListMixin: ?stream= 流式输出, ?format=csv / msgpack / columnar 导出整张表
+    POST /employee5/import/: 上传 CSV / NDJSON 文件批量导入
+    ?expand=department: 列表和详情嵌套输出部门对象(EmployeeSerializer2, 部门从请求的身份映射中取, 见 users/identity.py)
     """
     queryset = Employee.objects.all()
-    serializer_class = EmployeeSerializer
\ No newline at end of file
+    serializer_class = EmployeeSerializer
+    top_list = 'latest_employee'
+    admission_limits = {
+        'list': Limit(concurrency=4, rate=50, burst=100),
+        'import_file': Limit(concurrency=1),
+    }
+    # ?search= 按姓名和备注搜索, 使用 n-gram 索引(见 users/search.py)
+    filter_backends = (IndexedSearchFilter,)
+    # 按 (hire_date, id) 的键集分页
+    pagination_class = EmployeeKeysetPagination
+    # ?expand=department 时嵌套输出部门
+    expand_query_param = 'expand'
+
+    def get_serializer_class(self):
+        """列表和详情 ?expand=department 时使用 EmployeeSerializer2; 导出只支持平铺的字段, 不嵌套"""
+        request = self.request
+        if self.action in ('list', 'retrieve') and request is not None and not self.is_export(request):
+            expand = request.query_params.get(self.expand_query_param, '')
+            if 'department' in expand.split(','):
+                return EmployeeSerializer2
+        return super(EmployeeViewSet, self).get_serializer_class()
+
+    def list(self, request, *args, **kwargs):
+        if self.is_export(request):
+            # 导出整张表(不分页)
+            queryset = self.filter_queryset(self.get_queryset())
+            return self.export_response(queryset, self.get_serializer())
+        # ?stream=json 或 ?stream=ndjson: 分块读取, 流式输出(不分页)
+        stream_format = self.get_stream_format(request)
+        if stream_format:
+            queryset = self.filter_queryset(self.get_queryset())
+            return self.stream_response(queryset, self.get_serializer_class(), stream_format)
+        return super(EmployeeViewSet, self).list(request, *args, **kwargs)
+
+    @action(methods=['get'], detail=False)
+    def latest(self, request):
+        """
+        自定义action: 最近入职的员工, ?n=10 时返回最近入职的 10 个员工
+        """
+        return self.top_response(request)
+
+    @action(methods=['post'], detail=False, url_path='import', url_name='import')
+    def import_file(self, request):
+        """
+        自定义action: 上传文件批量导入员工(multipart, 字段名 file)
+        .csv 为 CSV, .ndjson / .jsonl 为每行一个 JSON 对象, 见 users/importer.py
+        返回导入和拒绝的行数, 以及前 100 条拒绝记录
+        在处理请求的进程中校验(workers=0): 不在 web worker 中 fork 进程池(会复制数据库连接和线程状态),
+        大文件用 import_employees 命令导入
+        """
+        uploaded_file = request.FILES.get('file')
+        if uploaded_file is None:
+            return Response({'file': ['请上传要导入的文件']}, status=400)
+        records = iter_records(open_upload(uploaded_file), guess_format(uploaded_file.name))
+        result = EmployeeImporter(workers=0).run(records)
+        del result['position']
+        return Response(result, status=201 if result['imported'] else 200)
+
+
+class MetricsAPIView(APIView):
+    """
+    性能统计(见 users/metrics.py), 只有管理员可以访问
+    GET    /metrics  每个视图/动作的耗时, SQL 次数和耗时, 序列化和渲染耗时的 p50/p95/p99,
+                     以及启动预热的耗时和准入控制的计数
+    DELETE /metrics  清空统计数据
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        enabled, sample_rate = get_options()
+        return Response({
+            'enabled': enabled,
+            'sample_rate': sample_rate,
+            'views': registry.snapshot(),
+            # 启动预热各阶段的耗时(毫秒), 没有预热时为空
+            'warmup': warmup.last_report(),
+            # 每个接口的准入控制: 通过, 被拒绝的请求数和并发数
+            'admission': admission.registry.snapshot(),
+        })
+
+    def delete(self, request):
+        registry.reset()
+        admission.registry.reset()
+        return Response(status=204)
+
+
+class BatchAPIView(AdmissionControlMixin, InstrumentedViewMixin, APIView):
+    """
+    批量请求(见 users/batch.py)
+    POST /batch  {"requests": [{"method": "GET", "path": "/department/1"}, ...]}
+    返回 {"responses": [{"status": 200, "headers": {...}, "body": ...}, ...]}, 顺序与请求相同
+    一个批量请求可能包含多个慢请求, 限制并发数(子请求另外按各自的接口计算)
+    """
+    admission_limits = {
+        'post': Limit(concurrency=4),
+    }
+
+    def post(self, request):
+        serializer = batch.BatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        results = batch.execute(request, serializer.validated_data['requests'])
+        return HttpResponse(batch.encode_envelope(results), content_type='application/json')
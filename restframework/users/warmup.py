@@ -0,0 +1,185 @@
+"""
+wsgi 进程启动预热
+
+新启动的 worker 处理第一个请求比之后慢好几倍: URL 正则在第一次匹配时才编译, DRF 的 api_settings
+在第一次访问时才导入渲染器/解析器等类, 序列化器字段和编译模式的函数(见 users/compiled.py)在
+第一次序列化时才生成, 数据库在第一次查询时才连接. 发布或扩容后, 每个新 worker 的第一个请求都要付出这些开销.
+
+开启后, restframework/wsgi.py 加载应用时依次执行各阶段, 每个阶段记录耗时:
+    - setup:       导入 Django, django.setup() 和创建 WSGIHandler(加载中间件)
+    - settings:    访问 DRF 的所有配置项, 导入其中的类
+    - urls:        生成根 URLconf 和 users.urls(批量接口使用)的解析器, 编译所有路由的正则
+    - serializers: 路由中视图使用的序列化器绑定字段, 生成编译模式的函数
+    - database:    连接 DATABASES 中的所有数据库(持久连接, 见 CONN_MAX_AGE)
+    - requests:    依次 GET PATHS 中的路径(经过所有中间件), 如 '/departments5/latest/' 同时加载最新部门的列表
+每个阶段的耗时写入日志 users.warmup(INFO), GET /metrics 的 warmup 中也能看到. 某个阶段出错只记录日志, 不影响启动.
+
+注意:
+    - 数据库连接属于当前线程, 只有处理请求的线程就是加载应用的线程时(如 gunicorn 的 sync worker)才能复用
+    - gunicorn --preload 时在 fork 之前加载应用, 子进程不能共用父进程的数据库连接, PHASES 中不要包含 database 和 requests
+    - 单独测量各阶段的耗时: python manage.py warmup
+
+配置(settings.USERS_WARMUP):
+    {
+        'ENABLED': False,
+        'PHASES': ('settings', 'urls', 'serializers', 'database', 'requests'),
+        'PATHS': [],
+    }
+"""
+import logging
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import connections
+from django.urls import get_resolver
+from django.urls.resolvers import RegexURLResolver
+
+logger = logging.getLogger('users.warmup')
+
+PHASES = ('settings', 'urls', 'serializers', 'database', 'requests')
+DEFAULTS = {
+    'ENABLED': False,
+    'PHASES': PHASES,
+    'PATHS': [],
+}
+# 批量接口解析子请求使用的 URLconf(见 users/batch.py)
+URLCONFS = (None, 'users.urls')
+
+# 最近一次预热各阶段的耗时(毫秒)
+_report = OrderedDict()
+
+
+def get_options():
+    options = dict(DEFAULTS)
+    options.update(getattr(settings, 'USERS_WARMUP', {}))
+    return options
+
+
+def last_report():
+    return OrderedDict(_report)
+
+
+def warm_settings():
+    from rest_framework.settings import api_settings
+    for name in api_settings.defaults:
+        getattr(api_settings, name)
+
+
+def iter_patterns(patterns):
+    for pattern in patterns:
+        if isinstance(pattern, RegexURLResolver):
+            for sub_pattern in iter_patterns(pattern.url_patterns):
+                yield sub_pattern
+        else:
+            yield pattern
+
+
+def warm_urls():
+    for urlconf in URLCONFS:
+        resolver = get_resolver(urlconf)
+        # reverse_dict 会遍历所有路由(包括 include 的), 编译每个正则
+        resolver.reverse_dict
+        for pattern in iter_patterns(resolver.url_patterns):
+            pattern.regex
+
+
+def view_serializer_classes():
+    """路由中的 DRF 视图使用的序列化器类(视图集按每个 action 的 get_serializer_class())"""
+    classes = []
+    for pattern in iter_patterns(get_resolver().url_patterns):
+        view_class = getattr(pattern.callback, 'cls', None)
+        if view_class is None or not hasattr(view_class, 'get_serializer_class'):
+            continue
+        actions = getattr(pattern.callback, 'actions', None) or {}
+        for action in set(actions.values()) or (None,):
+            view = view_class(**getattr(pattern.callback, 'initkwargs', {}))
+            view.action = action
+            view.request = None
+            view.format_kwarg = None
+            view.args, view.kwargs = (), {}
+            try:
+                serializer_class = view.get_serializer_class()
+            except Exception:
+                # 没有设置 serializer_class 的视图
+                continue
+            if serializer_class not in classes:
+                classes.append(serializer_class)
+    return classes
+
+
+def warm_serializers():
+    from users.compiled import CompiledSerializerMixin, get_compiled_row, mapping_columns
+
+    for serializer_class in view_serializer_classes():
+        serializer = serializer_class()
+        serializer._readable_fields
+        model = getattr(getattr(serializer, 'Meta', None), 'model', None)
+        if model is None or not isinstance(serializer, CompiledSerializerMixin):
+            continue
+        if mapping_columns(serializer, model) is not None:
+            get_compiled_row(serializer, model, mapping=True)
+        if serializer.is_compiled():
+            get_compiled_row(serializer, model)
+
+
+def warm_database():
+    from users import routers
+
+    interval = routers.get_options()['HEALTH_CHECK_INTERVAL']
+    for alias in connections:
+        routers.check_connection(alias, interval)
+    # 之后的请求按空闲时间检查连接
+    routers.record_last_used(sender=None)
+
+
+def warm_requests(paths):
+    from django.test import Client
+
+    hosts = [host for host in settings.ALLOWED_HOSTS if not host.startswith(('.', '*'))]
+    client = Client(HTTP_HOST=hosts[0] if hosts else 'localhost')
+    for path in paths:
+        response = client.get(path)
+        if response.status_code >= 400:
+            logger.warning('预热请求 %s 返回 %d', path, response.status_code)
+
+
+def run_phase(name, func, *args):
+    start = time.perf_counter()
+    try:
+        func(*args)
+    except Exception:
+        logger.exception('预热阶段 %s 出错', name)
+    elapsed = (time.perf_counter() - start) * 1000
+    _report[name] = elapsed
+    logger.info('预热阶段 %s: %.1fms', name, elapsed)
+    return elapsed
+
+
+def warm_up(started=None, force=False, phases=None):
+    """
+    依次执行 PHASES 中的阶段, 返回各阶段的耗时(毫秒)
+    started: 进程开始加载应用时的 time.perf_counter(), 用于计算 setup 阶段的耗时
+    force: 没有开启(ENABLED 为 False)时也执行
+    phases: 要执行的阶段, 默认为配置中的 PHASES
+    """
+    options = get_options()
+    if not (options['ENABLED'] or force):
+        return None
+    _report.clear()
+    if started is not None:
+        _report['setup'] = (time.perf_counter() - started) * 1000
+        logger.info('预热阶段 setup: %.1fms', _report['setup'])
+
+    steps = {
+        'settings': (warm_settings,),
+        'urls': (warm_urls,),
+        'serializers': (warm_serializers,),
+        'database': (warm_database,),
+        'requests': (warm_requests, options['PATHS']),
+    }
+    for name in phases or options['PHASES']:
+        run_phase(name, *steps[name])
+    total = sum(_report.values())
+    logger.info('预热完成: %.1fms', total)
+    return last_report()